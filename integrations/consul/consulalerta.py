@@ -2,117 +2,273 @@
 
 import json
 import os
+import queue
+import random
 import sys
+import threading
 import time
 
 import consul
 from alertaclient.api import Client
+from requests.adapters import HTTPAdapter
 
 CONSUL_HOST = os.environ.get('CONSUL_HOST', '127.0.0.1')
 CONSUL_PORT = int(os.environ.get('CONSUL_PORT', 8500))
+# maximum time a blocking query waits for a change
+CONSUL_WAIT = os.environ.get('CONSUL_WAIT', '5m')
 
-client = consul.Consul(host=CONSUL_HOST, port=CONSUL_PORT, token=None,
-                       scheme='http', consistency='default', dc=None, verify=True)
+KV_PREFIX = 'alerta/'
 
-j = json.load(sys.stdin)
-print('Request:')
-print(j)
+DEFAULT_CONFIG = {
+    'max_retries': 3,
+    'sleep': 2,
+    'timeout': 900,
+    'origin': 'consul',
+    'alerttype': 'ConsulAlert',
+    'defaultenv': 'Production',
+    'workers': 8,
+    'deadline': 60,
+}
 
-try:
-    url = client.kv.get('alerta/apiurl')[1]['Value']
-except Exception:
-    print('No URL defined, exiting')
-    sys.exit(1)
+SEVERITY_MAP = {
+    'critical': 'critical',
+    'warning': 'warning',
+    'passing': 'ok',
+}
 
-try:
-    key = client.kv.get('alerta/apikey')[1]['Value']
-except Exception:
-    print('No key defined, exiting')
-    sys.exit(1)
 
+def parse_config(items):
+    '''Build the configuration from the keys under the alerta/ prefix,
+    as returned by a single recursive KV read.
+    '''
+    kv = dict()
+    for item in items or []:
+        value = item.get('Value')
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        kv[item['Key'][len(KV_PREFIX):]] = value
 
-try:
-    max_retries = int(client.kv.get('alerta/max_retries')[1]['Value'])
-except TypeError:
-    print('No value defined, using default')
-    max_retries = 3
+    config = dict(DEFAULT_CONFIG)
+    config['apiurl'] = kv.get('apiurl')
+    config['apikey'] = kv.get('apikey')
+    for name in ['max_retries', 'sleep', 'timeout', 'workers', 'deadline']:
+        try:
+            config[name] = int(kv[name])
+        except (KeyError, TypeError, ValueError):
+            print('No value defined for {}, using default'.format(name))
+    for name in ['origin', 'alerttype', 'defaultenv']:
+        if kv.get(name):
+            config[name] = kv[name]
+    config['env'] = {k[len('env/'):]: v for k, v in kv.items() if k.startswith('env/') and v}
+    return config
 
-try:
-    sleep = int(client.kv.get('alerta/sleep')[1]['Value'])
-except TypeError:
-    print('No value defined, using default')
-    sleep = 2
 
-try:
-    timeout = int(client.kv.get('alerta/timeout')[1]['Value'])
-except TypeError:
-    print('No value defined, using default')
-    timeout = 900
+def read_config(client, index=None, wait=None):
+    index, items = client.kv.get(KV_PREFIX, recurse=True, index=index, wait=wait)
+    return index, parse_config(items)
 
-try:
-    origin = client.kv.get('alerta/origin')[1]['Value']
-except TypeError:
-    print('No value defined, using default')
-    origin = 'consul'
 
-try:
-    alerttype = client.kv.get('alerta/alerttype')[1]['Value']
-except TypeError:
-    print('No value defined, using default')
-    alerttype = 'ConsulAlert'
+def make_client(config):
+    '''Alerta API client shared by all workers, with a connection kept
+    open for each.
+    '''
+    api = Client(endpoint=config['apiurl'], key=config['apikey'])
+    adapter = HTTPAdapter(pool_maxsize=config['workers'])
+    api.http.session.mount('http://', adapter)
+    api.http.session.mount('https://', adapter)
+    return api
 
 
-api = Client(endpoint=url, key=key)
+def createalert(data, config, api, deadline=None):
+    '''Send the alert for a check, returning True once it is sent, False
+    if every attempt failed and None if the deadline came first.
+    '''
+    environment = config['env'].get(data['Node'], config['defaultenv'])
 
-SEVERITY_MAP = {
-    'critical': 'critical',
-    'warning': 'warning',
-    'passing': 'ok',
-}
-
-
-def createalert(data):
-    try:
-        environment = client.kv.get(
-            'alerta/env/{}'.format(data['Node']))[1]['Value']
-    except Exception:
+    for attempt in range(config['max_retries']):
+        if attempt:
+            # full jitter exponential backoff, never sleeping past the deadline
+            delay = random.uniform(0, config['sleep'] * 2 ** (attempt - 1))
+            if deadline and time.time() + delay >= deadline:
+                print('Deadline reached, alert for {} {} not sent'.format(data['Node'], data['CheckId']))
+                return None
+            time.sleep(delay)
         try:
-            environment = client.kv.get('alerta/defaultenv')[1]['Value']
-        except Exception:
-            environment = 'Production'
-
-    for _ in range(max_retries):
-        try:
-            print('Response:')
             response = api.send_alert(
                 resource=data['Node'],
                 event=data['CheckId'],
                 value=data['Status'],
-                correlate=SEVERITY_MAP.keys(),
+                correlate=list(SEVERITY_MAP.keys()),
                 environment=environment,
                 service=[data['CheckId']],
                 severity=SEVERITY_MAP[data['Status']],
                 text=data['Output'],
-                timeout=timeout,
-                origin=origin,
-                type=alerttype
+                timeout=config['timeout'],
+                origin=config['origin'],
+                type=config['alerttype']
             )
-            print(response)
+            print('Response: {}'.format(response))
+            return True
         except Exception as e:
             print('HTTP Error: {}'.format(e))
-            time.sleep(sleep)
-            continue
-        else:
-            break
-    else:
-        print('api is down')
+    print('api is down, alert for {} {} not sent after {} attempts'.format(
+        data['Node'], data['CheckId'], config['max_retries']))
+    return False
+
+
+def send_alerts(checks, config, api):
+    '''Send alerts for checks concurrently from at most config['workers']
+    threads and return the checks that were sent. Alerts not sent within
+    config['deadline'] seconds are given up on.
+    '''
+    deadline = time.time() + config['deadline']
+    pending = queue.Queue()
+    for data in checks:
+        pending.put(data)
+    sent = []
+    failed = []
+
+    def worker():
+        while time.time() < deadline:
+            try:
+                data = pending.get_nowait()
+            except queue.Empty:
+                return
+            result = createalert(data, config, api, deadline)
+            if result:
+                sent.append(data)
+            elif result is False:
+                failed.append(data)
+
+    # daemon threads so a request still in progress at the deadline does not delay exit
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(min(config['workers'], len(checks)))]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join(max(deadline - time.time(), 0))
+
+    if failed:
+        print('api is down, {} of {} alerts not sent'.format(len(failed), len(checks)))
+    unsent = len(checks) - len(sent) - len(failed)
+    if unsent:
+        print('Deadline reached, {} of {} alerts not sent'.format(unsent, len(checks)))
+    return sent
+
+
+class Watcher:
+    '''Long-lived alternative to running consul-alerta for each watch
+    event. Health checks and the alerta/ KV prefix are watched with
+    blocking queries, the configuration is kept in memory and only
+    checks whose status or output changed are sent.
+    '''
+
+    def __init__(self, client, wait=CONSUL_WAIT):
+
+        self.client = client
+        self.wait = wait
+        self.config = None
+        self.api = None
+        self.config_index = None
+        self.checks_index = None
+        self.checks = dict()  # (node, check id) -> (status, output)
+
+    def watch_config(self):
+        index, config = read_config(self.client, index=self.config_index, wait=self.wait if self.config_index else None)
+        self.config_index = self._next_index(self.config_index, index)
+        if config != self.config:
+            if not config['apiurl'] or not config['apikey']:
+                print('No URL or key defined, waiting for configuration')
+            elif not self.config or any(config[k] != self.config[k] for k in ['apiurl', 'apikey', 'workers']):
+                self.api = make_client(config)
+            self.config = config
+
+    def watch_checks(self):
+        index, checks = self.client.health.state('any', index=self.checks_index,
+                                                 wait=self.wait if self.checks_index else None)
+        self.checks_index = self._next_index(self.checks_index, index)
+
+        changed = []
+        current = dict()
+        for check in checks:
+            if check['Status'] not in SEVERITY_MAP:
+                continue
+            state = (check['Status'], check['Output'])
+            key = (check['Node'], check['CheckID'])
+            current[key] = state
+            if self.checks.get(key) != state:
+                changed.append({'Node': check['Node'], 'CheckId': check['CheckID'],
+                                'Status': check['Status'], 'Output': check['Output']})
+        # changed checks are only recorded once their alert has been sent
+        self.checks = {key: state for key, state in self.checks.items() if current.get(key) == state}
+        return changed
+
+    def send(self, checks):
+        if not self.api or not checks:
+            return
+        for data in send_alerts(checks, self.config, self.api):
+            self.checks[(data['Node'], data['CheckId'])] = (data['Status'], data['Output'])
+
+    @staticmethod
+    def _next_index(old, new):
+        # a blocking query index going backwards must be reset
+        new = int(new)
+        if old and new < old:
+            return 0
+        return new
+
+    def run(self):
+        self.watch_config()
+
+        def config_loop():
+            while True:
+                try:
+                    self.watch_config()
+                except Exception as e:
+                    print('Consul Error: {}'.format(e))
+                    time.sleep(self.config['sleep'])
+
+        threading.Thread(target=config_loop, name='ConfigWatcher', daemon=True).start()
+
+        while True:
+            try:
+                self.send(self.watch_checks())
+            except Exception as e:
+                print('Consul Error: {}'.format(e))
+                time.sleep(self.config['sleep'])
+
+
+def consul_client():
+    return consul.Consul(host=CONSUL_HOST, port=CONSUL_PORT, token=None,
+                         scheme='http', consistency='default', dc=None, verify=True)
 
 
 def main():
-    for item in enumerate(j):
-        i = item[0]
-        createalert(j[i])
+    client = consul_client()
+
+    j = json.load(sys.stdin)
+    print('Request:')
+    print(j)
+
+    _, config = read_config(client)
+    if not config['apiurl']:
+        print('No URL defined, exiting')
+        sys.exit(1)
+    if not config['apikey']:
+        print('No key defined, exiting')
+        sys.exit(1)
+
+    send_alerts(j, config, make_client(config))
+
+
+def daemon():
+    try:
+        Watcher(consul_client()).run()
+    except (SystemExit, KeyboardInterrupt):
+        sys.exit(0)
 
 
 if __name__ == '__main__':
-    main()
+    if '--daemon' in sys.argv:
+        daemon()
+    else:
+        main()
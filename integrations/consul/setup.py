@@ -20,6 +20,7 @@ setup(
     entry_points={
         'console_scripts': [
             'consul-alerta = consulalerta:main',
+            'consul-alerta-daemon = consulalerta:daemon',
             'consul-heartbeat = consulheartbeat:main'
         ]
     },
@@ -0,0 +1,242 @@
+'''
+Unit test definitions for the consul watcher, run against a stub Consul
+HTTP API
+'''
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from mock import MagicMock, patch
+
+consul = pytest.importorskip('consul')
+consulalerta = pytest.importorskip('consulalerta')
+
+
+class StubConsul:
+    '''
+    Minimal Consul HTTP API serving the alerta/ KV prefix and health
+    checks, with blocking queries
+    '''
+
+    def __init__(self):
+        self.kv = dict()
+        self.checks = []
+        self.index = 1
+        self.requests = []
+        self.cond = threading.Condition()
+
+    def update(self, kv=None, checks=None):
+        with self.cond:
+            if kv is not None:
+                self.kv.update(kv)
+            if checks is not None:
+                self.checks = checks
+            self.index += 1
+            self.cond.notify_all()
+
+    def respond(self, path, query):
+        self.requests.append(path)
+        with self.cond:
+            if 'index' in query and int(query['index'][0]) >= self.index:
+                self.cond.wait(timeout=1)
+            if path.startswith('/v1/kv/'):
+                body = [{'Key': k, 'Value': base64.b64encode(v.encode()).decode(), 'Flags': 0}
+                        for k, v in sorted(self.kv.items())]
+            else:
+                body = list(self.checks)
+            return self.index, body
+
+
+@pytest.fixture
+def stub_consul():
+    stub = StubConsul()
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            index, body = stub.respond(url.path, parse_qs(url.query))
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('X-Consul-Index', str(index))
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub.client = consul.Consul(host='127.0.0.1', port=server.server_address[1])
+    yield stub
+    server.shutdown()
+
+
+def check(node, check_id, status, output=''):
+    return {'Node': node, 'CheckID': check_id, 'Status': status, 'Output': output}
+
+
+def test_parse_config_defaults():
+    '''
+    Test a single recursive KV read gives the config and node environments
+    '''
+    items = [
+        {'Key': 'alerta/apiurl', 'Value': b'http://alerta:8080'},
+        {'Key': 'alerta/apikey', 'Value': b'secret'},
+        {'Key': 'alerta/timeout', 'Value': b'300'},
+        {'Key': 'alerta/max_retries', 'Value': b'not a number'},
+        {'Key': 'alerta/env/db1', 'Value': b'Testing'},
+        {'Key': 'alerta/env/', 'Value': None},
+    ]
+    config = consulalerta.parse_config(items)
+    assert config['apiurl'] == 'http://alerta:8080'
+    assert config['timeout'] == 300
+    assert config['max_retries'] == 3
+    assert config['env'] == {'db1': 'Testing'}
+    assert config['defaultenv'] == 'Production'
+
+
+def test_watcher_sends_changed_checks(stub_consul):
+    '''
+    Test only changed checks are sent and no KV reads are made per event
+    '''
+    stub_consul.update(kv={'alerta/apiurl': 'http://alerta:8080', 'alerta/apikey': 'secret',
+                           'alerta/env/db1': 'Testing'},
+                       checks=[check('web1', 'ping', 'passing'), check('db1', 'ping', 'critical', 'timeout')])
+    api = MagicMock()
+    watcher = consulalerta.Watcher(stub_consul.client, wait='1s')
+    with patch.object(consulalerta, 'Client', return_value=api):
+        watcher.watch_config()
+    del stub_consul.requests[:]
+
+    watcher.send(watcher.watch_checks())
+    assert api.send_alert.call_count == 2
+    sent = {kwargs['resource']: kwargs for _, kwargs in api.send_alert.call_args_list}
+    assert sent['db1']['environment'] == 'Testing'
+    assert sent['db1']['severity'] == 'critical'
+    assert sent['web1']['environment'] == 'Production'
+
+    # blocking query returns when checks change
+    timer = threading.Timer(0.2, stub_consul.update, kwargs={'checks': [
+        check('web1', 'ping', 'passing'), check('db1', 'ping', 'passing', 'ok')]})
+    timer.start()
+    api.reset_mock()
+    watcher.send(watcher.watch_checks())
+    timer.join()
+    assert api.send_alert.call_count == 1
+    assert api.send_alert.call_args[1]['resource'] == 'db1'
+    assert api.send_alert.call_args[1]['severity'] == 'ok'
+    assert all(path.startswith('/v1/health/') for path in stub_consul.requests)
+
+    # config changes are picked up by the KV watch
+    stub_consul.update(kv={'alerta/env/db1': 'Staging'})
+    watcher.watch_config()
+    assert watcher.config['env']['db1'] == 'Staging'
+
+
+def test_watcher_resends_unsent_checks(stub_consul):
+    '''
+    Test checks are sent again until their alert is delivered
+    '''
+    stub_consul.update(checks=[check('web1', 'ping', 'passing'), check('db1', 'ping', 'critical', 'timeout')])
+    api = MagicMock()
+    api.send_alert.side_effect = lambda resource, **kwargs: None if resource == 'web1' else 1 / 0
+    watcher = consulalerta.Watcher(stub_consul.client, wait='1s')
+
+    # checks that change before the API is configured are not lost
+    watcher.watch_config()
+    watcher.send(watcher.watch_checks())
+    assert watcher.api is None
+
+    stub_consul.update(kv={'alerta/apiurl': 'http://alerta:8080', 'alerta/apikey': 'secret',
+                           'alerta/max_retries': '1'})
+    with patch.object(consulalerta, 'Client', return_value=api):
+        watcher.watch_config()
+    watcher.send(watcher.watch_checks())
+    assert sorted(kwargs['resource'] for _, kwargs in api.send_alert.call_args_list) == ['db1', 'web1']
+
+    # the failed alert is sent again though the checks are unchanged
+    api.reset_mock()
+    api.send_alert.side_effect = None
+    watcher.send(watcher.watch_checks())
+    assert [kwargs['resource'] for _, kwargs in api.send_alert.call_args_list] == ['db1']
+
+    api.reset_mock()
+    watcher.send(watcher.watch_checks())
+    assert api.send_alert.call_count == 0
+
+
+def make_config(**kwargs):
+    config = consulalerta.parse_config([{'Key': 'alerta/apiurl', 'Value': b'http://alerta:8080'},
+                                        {'Key': 'alerta/apikey', 'Value': b'secret'}])
+    config.update(kwargs)
+    return config
+
+
+def test_send_alerts_concurrently():
+    '''
+    Test alerts are sent from a bounded number of threads
+    '''
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def send_alert(**kwargs):
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.pop()
+
+    api = MagicMock()
+    api.send_alert.side_effect = send_alert
+    checks = [{'Node': 'web%d' % i, 'CheckId': 'ping', 'Status': 'critical', 'Output': ''} for i in range(40)]
+    assert len(consulalerta.send_alerts(checks, make_config(workers=8), api)) == 40
+    assert max(peak) == 8
+
+
+class FakeClock:
+    '''Stands in for the time module, sleeping only advances the clock.'''
+
+    start = 1000.0
+
+    def __init__(self):
+        self.now = self.start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_send_alerts_backoff_and_deadline(capsys):
+    '''
+    Test failed alerts are retried with backoff until the deadline
+    '''
+    api = MagicMock()
+    api.send_alert.side_effect = [RuntimeError('down'), RuntimeError('down'), None] + [RuntimeError('down')] * 100
+    checks = [{'Node': 'web%d' % i, 'CheckId': 'ping', 'Status': 'passing', 'Output': ''} for i in range(3)]
+    config = make_config(workers=1, max_retries=10, sleep=0.01, deadline=1)
+
+    clock = FakeClock()
+    with patch.object(consulalerta.random, 'uniform', side_effect=lambda a, b: b) as uniform, \
+            patch.object(consulalerta, 'time', clock):
+        assert consulalerta.send_alerts(checks, config, api) == [checks[0]]
+    assert [call[0][1] for call in uniform.call_args_list[:4]] == [0.01, 0.02, 0.01, 0.02]
+    assert clock.now < clock.start + config['deadline']
+
+    capsys.readouterr()
+    api.send_alert.side_effect = RuntimeError('down')
+    with patch.object(consulalerta, 'time', FakeClock()):
+        assert consulalerta.send_alerts(checks, make_config(workers=1, max_retries=2, sleep=0.01), api) == []
+    out = capsys.readouterr().out
+    assert 'api is down, 3 of 3 alerts not sent' in out
+    assert 'Deadline reached' not in out
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import datetime
+import heapq
 import json
 import logging
 import os
@@ -12,16 +13,19 @@ import socket
 import sys
 import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 from configparser import RawConfigParser
+from email.charset import Charset
 from email.header import Header
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from functools import reduce
+from functools import lru_cache
 
 import jinja2
 from alertaclient.api import Client
 from alertaclient.models.alert import Alert
-from kombu import Connection, Exchange, Queue
+from kombu import Connection, Exchange, Queue, compression
 from kombu.mixins import ConsumerMixin
 
 __version__ = '5.2.0'
@@ -34,6 +38,13 @@ try:
 except Exception:
     sys.stdout.write('Python dns.resolver unavailable. The skip_mta option will be forced to False\n')  # nopep8
 
+try:
+    # messages published with lz4 compression by the amqp plugin
+    import lz4.frame
+    compression.register(lz4.frame.compress, lz4.frame.decompress, 'application/x-lz4', aliases=['lz4'])
+except ImportError:
+    pass
+
 
 logging.basicConfig(level=logging.DEBUG)
 LOG = logging.getLogger(__name__)
@@ -50,6 +61,12 @@ DEFAULT_OPTIONS = {
     'amqp_queue_name': '',
     # Exclusive queues may only be consumed by the current connection.
     'amqp_queue_exclusive': True,
+    # Unacknowledged messages the broker may deliver to each consumer. Default 0 is no limit.
+    'amqp_prefetch_count': 0,
+    # Acknowledge messages in batches of this many, or every ACK_INTERVAL seconds.
+    'amqp_ack_batch': 1,
+    # Consumers sharing the queue. More than 1 requires a named queue that is not exclusive.
+    'amqp_consumers': 1,
     'smtp_host': 'smtp.gmail.com',
     'smtp_port': 587,
     # application-specific username if it differs from the specified 'mail_from' user
@@ -59,6 +76,9 @@ DEFAULT_OPTIONS = {
     'smtp_use_ssl': False,  # whether or not SSL is being used for the SMTP connection
     'ssl_key_file': None,  # a PEM formatted private key file for the SSL connection
     'ssl_cert_file': None,  # a certificate chain file for the SSL connection
+    'smtp_pool_size': 1,  # number of SMTP sessions kept open for reuse
+    'smtp_idle_timeout': 60,  # seconds before an unused SMTP session is closed
+    'smtp_noop_interval': 10,  # seconds idle before a session is checked with NOOP
     'mail_from': '',  # alerta@example.com
     'mail_to': [],  # devops@example.com, support@example.com
     'mail_localhost': None,  # fqdn to use in the HELO/EHLO command
@@ -69,19 +89,464 @@ DEFAULT_OPTIONS = {
         '{{ alert.severity|capitalize }} {{ alert.event }} on '
         '{{ alert.service|join(\',\') }} {{ alert.resource }}'
     ),
+    # seconds (alerts due for the same contacts within this window are sent as one digest email, 0 disables)
+    'digest_window': 0,
+    'mail_template_digest': os.path.dirname(__file__) + os.sep + 'email.digest.tmpl',
+    'mail_template_digest_html': os.path.dirname(__file__) + os.sep + 'email.digest.html.tmpl',  # nopep8
+    'mail_subject_digest': (
+        '[{{ alerts|length }} alerts] '
+        '{{ alerts|map(attribute=\'event\')|join(\', \')|truncate(120) }}'
+    ),
     'dashboard_url': 'http://try.alerta.io',
     'debug': False,
     'skip_mta': False,
+    'skip_mta_workers': 4,  # number of domains delivered to in parallel when skip_mta is set
     'email_type': 'text',  # options are: text, html
-    'severities': []
+    'severities': [],
+    'hold_journal': ''  # file to keep alerts on hold in across restarts, eg. /var/lib/alerta/mailer.journal
 }
 
 OPTIONS = {}
 
+UTF8 = Charset('utf-8')
+
 # seconds (hold alert until sending, delete if cleared before end of hold time)
 HOLD_TIME = 30
 
-on_hold = dict()
+# seconds between heartbeats sent by the mail sender
+HEARTBEAT_INTERVAL = 20
+
+# Longest time in seconds received messages wait for a batched ack
+ACK_INTERVAL = 1
+
+# seconds between checks for modified template files
+TEMPLATE_CHECK_INTERVAL = 5
+
+
+class HoldJournal:
+    '''Append-only journal of held alerts, one JSON record per line, so
+    that alerts on hold survive a restart. Records are flushed to the OS
+    as they are written and the journal is rewritten with only the
+    alerts still on hold once most of its records are obsolete.
+    '''
+
+    def __init__(self, path):
+
+        self.path = path
+        self.records = 0
+        self._file = None
+
+    def replay(self):
+        '''Return alerts still on hold as {alertid: (body, release_time)}
+        and open the journal for appending.
+        '''
+        held = dict()
+        if os.path.exists(self.path):
+            complete = 0  # bytes up to the end of the last complete record
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    complete += len(line)
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        LOG.warning('Skipping corrupt hold journal record')
+                        continue
+                    if record[0] == 'hold':
+                        held[record[1]] = (record[3], record[2])
+                    else:
+                        held.pop(record[1], None)
+                    self.records += 1
+            if complete < os.path.getsize(self.path):
+                # a record torn by a crash while appending would swallow the next one
+                LOG.warning('Truncating torn hold journal record')
+                os.truncate(self.path, complete)
+        self._file = open(self.path, 'a')
+        LOG.info('Replayed %d alerts on hold from %s', len(held), self.path)
+        return held
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, default=str) + '\n')
+        self._file.flush()
+        self.records += 1
+
+    def hold(self, alertid, body, release_time):
+        self._write(['hold', alertid, release_time, body])
+
+    def remove(self, alertid):
+        self._write(['remove', alertid])
+
+    def compact(self, held):
+        '''Rewrite the journal with only the given alerts, as
+        {alertid: (body, release_time)}.
+        '''
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for alertid, (body, release_time) in held.items():
+                f.write(json.dumps(['hold', alertid, release_time, body], default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.rename(tmp, self.path)
+        self._file = open(self.path, 'a')
+        self.records = len(held)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+
+class HoldQueue:
+    '''Alerts held until their release time, ordered by a heap of
+    (release time, sequence, alert id) entries. Replaced or cancelled
+    alerts are left in the heap and skipped when they reach the top.
+    '''
+
+    def __init__(self):
+
+        self._heap = []
+        self._held = dict()  # alertid -> (alert, release_time, seq, body)
+        self._seq = 0
+        self._woken = False
+        self._journal = None
+        self._cond = threading.Condition()
+
+    def __contains__(self, alertid):
+        return alertid in self._held
+
+    def __len__(self):
+        return len(self._held)
+
+    def restore(self, journal):
+        '''Hold the alerts replayed from a journal and record all
+        further changes in it.
+        '''
+        with self._cond:
+            for alertid, (body, release_time) in journal.replay().items():
+                try:
+                    alert = Alert.parse(body)
+                except Exception as e:
+                    LOG.warning('Failed to restore alert %s: %s', alertid, e)
+                    continue
+                self._push(alertid, alert, release_time, body)
+            self._journal = journal
+            self._cond.notify()
+
+    def _push(self, alertid, alert, release_time, body):
+        self._seq += 1
+        self._held[alertid] = (alert, release_time, self._seq, body)
+        heapq.heappush(self._heap, (release_time, self._seq, alertid))
+
+    def hold(self, alertid, alert, release_time, body=None):
+        with self._cond:
+            self._push(alertid, alert, release_time, body)
+            if self._journal:
+                self._journal.hold(alertid, body, release_time)
+            self._maybe_compact()
+            if self._heap[0][1] == self._seq:
+                self._cond.notify()
+
+    def cancel(self, alertid):
+        with self._cond:
+            if self._held.pop(alertid, None) is None:
+                return False
+            if self._journal:
+                self._journal.remove(alertid)
+                self._maybe_compact()
+            return True
+
+    def wake(self):
+        with self._cond:
+            self._woken = True
+            self._cond.notify_all()
+
+    def pop_due(self, timeout, horizon=0):
+        '''Wait until at least one alert is due or the timeout expires,
+        and return the alerts that are due, in release order. If other
+        alerts become due within horizon seconds of the earliest one, it
+        is held up to horizon seconds longer so they are released
+        together. No alert is released before its release time.
+        '''
+        deadline = time.time() + timeout
+        with self._cond:
+            try:
+                return self._pop_due(deadline, horizon)
+            finally:
+                # a wake() while alerts were due must not cut short the next wait
+                self._woken = False
+
+    def _pop_due(self, deadline, horizon):
+        while True:
+            self._discard_stale()
+            now = time.time()
+            if self._heap:
+                release = self._release_time(horizon)
+                if release <= now:
+                    break
+            wait = deadline - now
+            if self._heap:
+                wait = min(wait, release - now)
+            if wait <= 0 or self._woken:
+                return []
+            self._cond.wait(wait)
+
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, alertid = heapq.heappop(self._heap)
+            held = self._held.get(alertid)
+            if held is not None and held[2] == seq:
+                del self._held[alertid]
+                if self._journal:
+                    self._journal.remove(alertid)
+                due.append(held[0])
+        self._maybe_compact()
+        return due
+
+    def _release_time(self, horizon):
+        earliest = self._heap[0][0]
+        if horizon <= 0:
+            return earliest
+        # wait for the window to end only if another alert becomes due in it,
+        # looking at the next live entry rather than every held alert
+        limit = earliest + horizon
+        top = heapq.heappop(self._heap)
+        self._discard_stale()
+        following = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, top)
+        if following is not None and following <= limit:
+            return limit
+        return earliest
+
+    def _discard_stale(self):
+        while self._heap:
+            _, seq, alertid = self._heap[0]
+            held = self._held.get(alertid)
+            if held is not None and held[2] == seq:
+                return
+            heapq.heappop(self._heap)
+
+    def _maybe_compact(self):
+        limit = 2 * len(self._held) + 1024
+        if len(self._heap) > limit or (self._journal and self._journal.records > limit):
+            self._compact()
+
+    def _compact(self):
+        self._heap = [(release_time, seq, alertid) for alertid, (_, release_time, seq, _) in self._held.items()]
+        heapq.heapify(self._heap)
+        if self._journal:
+            self._journal.compact({alertid: (body, release_time)
+                                   for alertid, (_, release_time, _, body) in self._held.items()})
+
+
+on_hold = HoldQueue()
+
+
+class SMTPPool:
+    '''Authenticated SMTP sessions kept open and reused across messages.
+    Sessions idle for longer than smtp_idle_timeout are closed, sessions
+    idle for longer than smtp_noop_interval are checked with NOOP before
+    reuse, and a message is retried once on a fresh session if a reused
+    one has been dropped by the server.
+    '''
+
+    def __init__(self, host, port, size=1, authenticate=True):
+
+        self.host = host
+        self.port = port
+        self.size = size
+        self.authenticate = authenticate
+        self._idle = []  # (last_used, session)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if OPTIONS['smtp_use_ssl']:
+            mx = smtplib.SMTP_SSL(self.host,
+                                  self.port,
+                                  local_hostname=OPTIONS['mail_localhost'],
+                                  keyfile=OPTIONS['ssl_key_file'],
+                                  certfile=OPTIONS['ssl_cert_file'])
+        else:
+            mx = smtplib.SMTP(self.host,
+                              self.port,
+                              local_hostname=OPTIONS['mail_localhost'])
+        if OPTIONS['debug']:
+            mx.set_debuglevel(True)
+
+        mx.ehlo()
+
+        if self.authenticate and OPTIONS['smtp_starttls']:
+            mx.starttls()
+            mx.ehlo()
+
+        if self.authenticate and OPTIONS['smtp_password']:
+            mx.login(OPTIONS['smtp_username'], OPTIONS['smtp_password'])
+        LOG.debug('Opened SMTP session to %s:%s', self.host, self.port)
+        return mx
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                last_used, mx = self._idle.pop()
+            idle = time.time() - last_used
+            if idle > OPTIONS['smtp_idle_timeout']:
+                self._close(mx)
+                continue
+            if idle > OPTIONS['smtp_noop_interval']:
+                try:
+                    if mx.noop()[0] != 250:
+                        raise smtplib.SMTPException('NOOP failed')
+                except (smtplib.SMTPException, OSError):
+                    self._close(mx)
+                    continue
+            return mx, True
+        return self._connect(), False
+
+    def _release(self, mx):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((time.time(), mx))
+                return
+        self._close(mx)
+
+    @staticmethod
+    def _close(mx):
+        try:
+            mx.quit()
+        except (smtplib.SMTPException, OSError):
+            mx.close()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        while True:
+            mx, reused = self._acquire()
+            try:
+                mx.sendmail(from_addr, to_addrs, msg)
+            except (smtplib.SMTPServerDisconnected, OSError):
+                mx.close()
+                if reused:
+                    LOG.debug('SMTP session to %s:%s was dropped, reconnecting', self.host, self.port)
+                    continue
+                raise
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                self._release(mx)
+                raise
+            except Exception:
+                self._close(mx)
+                raise
+            self._release(mx)
+            return
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, mx in idle:
+            self._close(mx)
+
+
+REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()')
+
+
+@lru_cache(maxsize=None)
+def compile_regex(regex):
+    '''Compile a rule regex, returning the pattern and its literal prefix
+    (the characters any match must start with) and whether the regex is
+    only a literal. Raises re.error if the regex is not legal.
+    '''
+    pattern = re.compile(regex)
+    if '|' in regex:
+        return pattern, '', False
+    i = 0
+    while i < len(regex) and regex[i] not in REGEX_SPECIAL:
+        i += 1
+    if i == len(regex):
+        return pattern, regex, True
+    if regex[i] in '*?{':
+        i -= 1  # last character is optional
+    return pattern, regex[:max(i, 0)], False
+
+
+class GroupRules:
+    '''Group rules compiled for evaluation. Each distinct field/regex
+    condition is matched at most once per alert, however many rules use
+    it, and literal regexes are matched without the regex engine.
+    '''
+
+    def __init__(self, rules):
+
+        self._conditions = []  # (field, regex, pattern, prefix, literal)
+        self._rules = []  # (name, condition indexes, contacts, exclude)
+        conditions = dict()
+        for rule in rules:
+            indexes = []
+            for field in rule['fields']:
+                key = (field['field'], field['regex'])
+                if key not in conditions:
+                    conditions[key] = len(self._conditions)
+                    self._conditions.append(key + compile_regex(field['regex']))
+                indexes.append(conditions[key])
+            contacts = list(dict.fromkeys(x.strip() for x in rule['contacts']))
+            self._rules.append((rule['name'], indexes, contacts, rule.get('exclude', False)))
+
+    def __len__(self):
+        return len(self._rules)
+
+    def _matches(self, alert, index):
+        field, regex, pattern, prefix, literal = self._conditions[index]
+        value = getattr(alert, field, None)
+        if value is None:
+            LOG.warning('Alert has no attribute %s', field)
+            return None
+        if isinstance(value, list):
+            # at least one item must match from its start
+            for item in value:
+                if not item.startswith(prefix):
+                    continue
+                if literal or pattern.match(item) is not None:
+                    LOG.debug('Regex %s matches item %s', regex, item)
+                    return True
+            return False
+        elif isinstance(value, str):
+            if prefix and prefix not in value:
+                return False
+            return literal or pattern.search(value) is not None
+        LOG.warning('Field type is not supported')
+        return False
+
+    def contacts(self, alert, contacts):
+        '''Return contacts extended, or replaced for "exclude" rules, by
+        the contacts of every rule that matches the alert.
+        '''
+        contacts = list(dict.fromkeys(contacts))
+        seen = set(contacts)
+        results = dict()
+        for name, indexes, rule_contacts, exclude in self._rules:
+            LOG.debug('Evaluating rule %s', name)
+            is_matching = False
+            for index in indexes:
+                if index not in results:
+                    results[index] = self._matches(alert, index)
+                if results[index] is None:
+                    break
+                is_matching = results[index]
+                if not is_matching:
+                    break
+            if not is_matching:
+                continue
+            # Add up any new contacts
+            new_contacts = [x for x in rule_contacts if x not in seen]
+            if new_contacts:
+                if not exclude:
+                    LOG.debug('Extending contact to include %s', new_contacts)
+                    contacts.extend(new_contacts)
+                else:
+                    LOG.info('Clearing initial list of contacts and'
+                             ' adding for this rule only')
+                    contacts = new_contacts
+                    seen.clear()
+                seen.update(new_contacts)
+        return contacts
 
 
 class FanoutConsumer(ConsumerMixin):
@@ -90,6 +555,13 @@ class FanoutConsumer(ConsumerMixin):
 
         self.connection = connection
         self.channel = self.connection.channel()
+        self._unacked = []
+        self._unacked_since = 0
+        self._ack_batch = OPTIONS['amqp_ack_batch']
+        if OPTIONS['amqp_prefetch_count']:
+            self._ack_batch = min(self._ack_batch, OPTIONS['amqp_prefetch_count'])
+        # Virtual transports (redis, sqs, memory...) ignore multiple acks
+        self._ack_multiple = connection.transport.driver_type == 'amqp'
 
     def get_consumers(self, Consumer, channel):
 
@@ -111,10 +583,48 @@ class FanoutConsumer(ConsumerMixin):
         ]
 
         return [
-            Consumer(queues=queues, accept=['json'],
-                     callbacks=[self.on_message])
+            Consumer(queues=queues, accept=['json', 'msgpack'],
+                     callbacks=[self.on_message],
+                     prefetch_count=OPTIONS['amqp_prefetch_count'] or None)
         ]
 
+    def ack(self, message):
+        if self._ack_batch <= 1:
+            message.ack()
+            return
+        if not self._unacked:
+            self._unacked_since = time.time()
+        self._unacked.append(message)
+        if len(self._unacked) >= self._ack_batch:
+            self.flush_acks()
+
+    def flush_acks(self):
+        '''Acknowledge all messages received since the last flush, with a
+        single multiple ack where the transport supports it.
+        '''
+        unacked, self._unacked = self._unacked, []
+        if not unacked:
+            return
+        if self._ack_multiple:
+            unacked[-1].ack(multiple=True)
+        else:
+            for message in unacked:
+                message.ack()
+
+    def on_iteration(self):
+        if self._unacked and time.time() - self._unacked_since >= ACK_INTERVAL:
+            self.flush_acks()
+
+    def on_consume_end(self, connection, channel):
+        try:
+            self.flush_acks()
+        except Exception as e:
+            LOG.warning('Failed to acknowledge messages: %s', e)
+
+    def on_connection_revived(self):
+        # messages from a lost channel are redelivered by the broker
+        self._unacked = []
+
     def on_message(self, body, message):
         sevs = list(OPTIONS['severities'])
         if not sevs:
@@ -125,38 +635,32 @@ class FanoutConsumer(ConsumerMixin):
             alertid = alert.get_id()
         except Exception as e:
             LOG.warn(e)
+            # rejected straight away, or it would hold a prefetch slot forever
+            message.reject()
             return
 
         LOG.debug('Alert received from the queue (id: %s)', alertid)
         if alert.repeat:
             LOG.debug('Ignored alert %s: repeat state', alertid)
-            message.ack()
+            self.ack(message)
             return
 
         if alert.status not in ['open', 'closed']:
             LOG.debug('Ignored alert %s: not in open or closed state', alertid)
-            message.ack()
+            self.ack(message)
             return
 
         if alert.severity not in sevs and alert.previous_severity not in sevs:
             LOG.debug('Ignored alert %s: severity or previous_severity does not matche the severities configuration (%s)',
                       alertid, sevs)
-            message.ack()
+            self.ack(message)
             return
 
-        if alertid in on_hold:
-            if alert.severity in ['normal', 'ok', 'cleared']:
-                try:
-                    del on_hold[alertid]
-                except KeyError:
-                    pass
-                message.ack()
-            else:
-                on_hold[alertid] = (alert, time.time() + HOLD_TIME)
-                message.ack()
+        if alertid in on_hold and alert.severity in ['normal', 'ok', 'cleared']:
+            on_hold.cancel(alertid)
         else:
-            on_hold[alertid] = (alert, time.time() + HOLD_TIME)
-            message.ack()
+            on_hold.hold(alertid, alert, time.time() + HOLD_TIME, body)
+        self.ack(message)
 
 
 class MailSender(threading.Thread):
@@ -169,144 +673,191 @@ class MailSender(threading.Thread):
         self._template_name = os.path.basename(OPTIONS['mail_template'])
         self._subject_template = jinja2.Template(OPTIONS['mail_subject'])
         self._template_env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(self._template_dir),
-            extensions=['jinja2.ext.autoescape'],
+            loader=jinja2.FileSystemLoader([
+                self._template_dir,
+                os.path.dirname(os.path.realpath(__file__))
+            ]),
             autoescape=True
         )
-        if OPTIONS['mail_template_html']:
-            self._template_name_html = os.path.basename(
-                OPTIONS['mail_template_html'])
+        self._template_name_html = os.path.basename(
+            OPTIONS['mail_template_html'] or '')
+        self._digest_subject_template = jinja2.Template(
+            OPTIONS['mail_subject_digest'])
+        self._template_name_digest = os.path.basename(
+            OPTIONS['mail_template_digest'])
+        self._template_name_digest_html = os.path.basename(
+            OPTIONS['mail_template_digest_html'] or '')
+        self._templates = dict()  # name -> (template, last checked)
+        for name in (self._template_name, self._template_name_html):
+            if name:
+                self._get_template(name)
+        self._template_vars = {
+            'dashboard_url': OPTIONS['dashboard_url'],
+            'program': os.path.basename(sys.argv[0]),
+            'hostname': platform.uname()[1]
+        }
+        self._mail_from = OPTIONS['mail_from']
+        self._group_rules = GroupRules(OPTIONS.get('group_rules') or [])
+        self._smtp_pool = SMTPPool(OPTIONS['smtp_host'],
+                                   OPTIONS['smtp_port'],
+                                   size=OPTIONS['smtp_pool_size'])
+        self._mx_cache = dict()  # domain -> (mxhost, expiration)
+        self._mx_pools = dict()  # mxhost -> SMTPPool
+        self._mx_lock = threading.Lock()
+        self._mx_executor = None
 
         super().__init__()
 
     def run(self):
 
         api = Client(endpoint=OPTIONS['endpoint'], key=OPTIONS['key'])
-        keep_alive = 0
+        next_heartbeat = time.time() + HEARTBEAT_INTERVAL
 
         while not self.should_stop:
-            for alertid in list(on_hold.keys()):
-                try:
-                    (alert, hold_time) = on_hold[alertid]
-                except KeyError:
-                    continue
-                if time.time() > hold_time:
-                    self.send_email(alert)
-                    try:
-                        del on_hold[alertid]
-                    except KeyError:
-                        continue
+            # sleeps until the next alert is due or a heartbeat is needed
+            self.send_emails(on_hold.pop_due(timeout=next_heartbeat - time.time(),
+                                             horizon=OPTIONS['digest_window']))
 
-            if keep_alive >= 10:
+            if time.time() >= next_heartbeat:
                 try:
                     origin = '{}/{}'.format('alerta-mailer',
                                             OPTIONS['smtp_host'])
                     api.heartbeat(origin, tags=[__version__])
                 except Exception:
-                    time.sleep(5)
+                    next_heartbeat = time.time() + 5
                     continue
-                keep_alive = 0
-            keep_alive += 1
-            time.sleep(2)
+                next_heartbeat = time.time() + HEARTBEAT_INTERVAL
+
+        self._smtp_pool.close()
+        for pool in list(self._mx_pools.values()):
+            pool.close()
+        if self._mx_executor:
+            self._mx_executor.shutdown()
 
-    def _rule_matches(self, regex, value):
-        '''Checks if a rule matches the regex to
-        its provided value considering its type
+    def stop(self):
+        self.should_stop = True
+        on_hold.wake()
+
+    def _get_template(self, name):
+        '''Return a compiled template, reloading it if the template file
+        has changed since it was last checked.
         '''
-        if isinstance(value, list):
-            LOG.debug('%s is a list, at least one item must match %s',
-                      value, regex)
-            for item in value:
-                if re.match(regex, item) is not None:
-                    LOG.debug('Regex %s matches item %s', regex, item)
-                    return True
-            LOG.debug('Regex %s matches nothing', regex)
-            return False
-        elif isinstance(value, str):  # pylint: disable=undefined-variable
-            LOG.debug('Trying to match %s to %s',
-                      value, regex)
-            return re.search(regex, value) is not None
-        LOG.warning('Field type is not supported')
-        return False
+        now = time.time()
+        cached = self._templates.get(name)
+        if cached is not None:
+            template, checked = cached
+            if now - checked < TEMPLATE_CHECK_INTERVAL:
+                return template
+            if template.is_up_to_date:
+                self._templates[name] = (template, now)
+                return template
+            LOG.info('Template %s has changed, reloading', name)
+        template = self._template_env.get_template(name)
+        self._templates[name] = (template, now)
+        return template
+
+    def get_contacts(self, alert):
+        """Return the list of contacts for the provided alert, starting
+        from mail_to and applying any matching group rules
+        """
+        contacts = list(OPTIONS['mail_to'])
+        LOG.debug('Initial contact list: %s', contacts)
+        if len(self._group_rules) > 0:
+            LOG.debug('Checking %d group rules' % len(self._group_rules))
+            contacts = self._group_rules.contacts(alert, contacts)
+        return contacts
+
+    def send_emails(self, alerts):
+        """Send emails for alerts released from hold. If digest_window is
+        set, alerts for the same contacts are sent as one digest email
+        """
+        if OPTIONS['digest_window'] <= 0 or len(alerts) < 2:
+            for alert in alerts:
+                self.send_email(alert)
+            return
 
-    def send_email(self, alert):
+        groups = dict()
+        for alert in alerts:
+            contacts = self.get_contacts(alert)
+            if not contacts:
+                continue
+            groups.setdefault(frozenset(contacts), (contacts, []))[1].append(alert)
+
+        for contacts, group in groups.values():
+            if len(group) == 1:
+                self.send_email(group[0], contacts)
+            else:
+                self.send_digest(group, contacts)
+
+    def send_email(self, alert, contacts=None):
         """Attempt to send an email for the provided alert, compiling
         the subject and text template and using all the other smtp settings
         that were specified in the configuration file
         """
-        contacts = list(OPTIONS['mail_to'])
-        LOG.debug('Initial contact list: %s', contacts)
-        if 'group_rules' in OPTIONS and len(OPTIONS['group_rules']) > 0:
-            LOG.debug('Checking %d group rules' % len(OPTIONS['group_rules']))
-            for rule in OPTIONS['group_rules']:
-                LOG.info('Evaluating rule %s', rule['name'])
-                is_matching = False
-                for field in rule['fields']:
-                    LOG.debug('Evaluating rule field %s', field)
-                    value = getattr(alert, field['field'], None)
-                    if value is None:
-                        LOG.warning('Alert has no attribute %s',
-                                    field['field'])
-                        break
-                    if self._rule_matches(field['regex'], value):
-                        is_matching = True
-                    else:
-                        is_matching = False
-                        break
-                if is_matching:
-                    # Add up any new contacts
-                    new_contacts = [x.strip() for x in rule['contacts']
-                                    if x.strip() not in contacts]
-                    if len(new_contacts) > 0:
-                        if not rule.get('exclude', False):
-                            LOG.debug('Extending contact to include %s' % (
-                                new_contacts))
-                            contacts.extend(new_contacts)
-                        else:
-                            LOG.info('Clearing initial list of contacts and'
-                                     ' adding for this rule only')
-                            del contacts[:]
-                            contacts.extend(new_contacts)
+        if contacts is None:
+            contacts = self.get_contacts(alert)
 
         # Don't loose time (and try to send an email) if there is no contact...
         if not contacts:
             return
 
-        template_vars = {
-            'alert': alert,
-            'mail_to': contacts,
-            'dashboard_url': OPTIONS['dashboard_url'],
-            'program': os.path.basename(sys.argv[0]),
-            'hostname': platform.uname()[1],
-            'now': datetime.datetime.utcnow()
-        }
+        template_vars = dict(self._template_vars,
+                             alert=alert,
+                             mail_to=contacts,
+                             now=datetime.datetime.utcnow())
 
         subject = self._subject_template.render(alert=alert)
-        text = self._template_env.get_template(
-            self._template_name).render(**template_vars)
+        text = self._get_template(self._template_name).render(template_vars)
 
         if OPTIONS['email_type'] == 'html' and self._template_name_html:
-            html = self._template_env.get_template(
-                self._template_name_html).render(**template_vars)
+            html = self._get_template(
+                self._template_name_html).render(template_vars)
+        else:
+            html = None
+
+        return self._deliver(subject, text, html, contacts, alert.get_id())
+
+    def send_digest(self, alerts, contacts):
+        """Attempt to send a single email listing all the provided alerts
+        using the digest subject and templates
+        """
+        template_vars = dict(self._template_vars,
+                             alerts=alerts,
+                             mail_to=contacts,
+                             now=datetime.datetime.utcnow())
+
+        subject = self._digest_subject_template.render(alerts=alerts)
+        text = self._get_template(
+            self._template_name_digest).render(template_vars)
+
+        if OPTIONS['email_type'] == 'html' and self._template_name_digest_html:
+            html = self._get_template(
+                self._template_name_digest_html).render(template_vars)
         else:
             html = None
 
-        msg = MIMEMultipart('alternative')
+        return self._deliver(subject, text, html, contacts,
+                             ','.join(alert.get_id() for alert in alerts))
+
+    def _deliver(self, subject, text, html, contacts, alertids):
+        # a unique boundary saves scanning the bodies for a collision
+        msg = MIMEMultipart('alternative',
+                            boundary='=====' + uuid.uuid4().hex + '==')
         msg['Subject'] = Header(subject, 'utf-8').encode()
-        msg['From'] = OPTIONS['mail_from']
+        msg['From'] = self._mail_from
         msg['To'] = ', '.join(contacts)
         msg.preamble = msg['Subject']
 
         # by default we are going to assume that the email is going to be text
-        msg_text = MIMEText(text, 'plain', 'utf-8')
+        msg_text = MIMEText(text, 'plain', UTF8)
         msg.attach(msg_text)
         if html:
-            msg_html = MIMEText(html, 'html', 'utf-8')
+            msg_html = MIMEText(html, 'html', UTF8)
             msg.attach(msg_html)
 
         try:
             self._send_email_message(msg, contacts)
-            LOG.debug('{} : Email sent to {}'.format(alert.get_id(),
+            LOG.debug('{} : Email sent to {}'.format(alertids,
                                                      ','.join(contacts)))
             return (msg, contacts)
         except smtplib.SMTPException as e:
@@ -323,60 +874,58 @@ class MailSender(threading.Thread):
 
     def _send_email_message(self, msg, contacts):
         if OPTIONS['skip_mta'] and DNS_RESOLVER_AVAILABLE:
+            domains = dict()
             for dest in contacts:
-                try:
-                    (_, ehost) = dest.split('@')
-                    dns_answers = dns.resolver.query(ehost, 'MX')
-
-                    if len(dns_answers) <= 0:
-                        raise Exception('Failed to find mail exchange for {}'.format(dest))  # nopep8
-
-                    mxhost = reduce(lambda x, y: x if x.preference >= y.preference else y, dns_answers).exchange.to_text()  # nopep8
-                    msg['To'] = dest
-                    if OPTIONS['smtp_use_ssl']:
-                        mx = smtplib.SMTP_SSL(mxhost,
-                                              OPTIONS['smtp_port'],
-                                              local_hostname=OPTIONS['mail_localhost'],
-                                              keyfile=OPTIONS['ssl_key_file'],
-                                              certfile=OPTIONS['ssl_cert_file'])
-                    else:
-                        mx = smtplib.SMTP(mxhost,
-                                          OPTIONS['smtp_port'],
-                                          local_hostname=OPTIONS['mail_localhost'])
-                    if OPTIONS['debug']:
-                        mx.set_debuglevel(True)
-                    mx.sendmail(OPTIONS['mail_from'], dest, msg.as_string())
-                    mx.close()
-                    LOG.debug('Sent notification email to {} (mta={})'.format(dest, mxhost))  # nopep8
-                except Exception as e:
-                    LOG.error('Failed to send email to address {} (mta={}): {}'.format(dest, mxhost, str(e)))  # nopep8
+                domains.setdefault(dest.rsplit('@', 1)[-1].lower(), []).append(dest)
+
+            if self._mx_executor is None:
+                self._mx_executor = ThreadPoolExecutor(
+                    max_workers=OPTIONS['skip_mta_workers'])
+            futures = []
+            for domain, rcpts in domains.items():
+                del msg['To']
+                msg['To'] = ', '.join(rcpts)
+                futures.append(self._mx_executor.submit(
+                    self._send_to_domain, domain, rcpts, msg.as_string()))
+            wait(futures)
 
         else:
-            if OPTIONS['smtp_use_ssl']:
-                mx = smtplib.SMTP_SSL(OPTIONS['smtp_host'],
-                                      OPTIONS['smtp_port'],
-                                      local_hostname=OPTIONS['mail_localhost'],
-                                      keyfile=OPTIONS['ssl_key_file'],
-                                      certfile=OPTIONS['ssl_cert_file'])
-            else:
-                mx = smtplib.SMTP(OPTIONS['smtp_host'],
-                                  OPTIONS['smtp_port'],
-                                  local_hostname=OPTIONS['mail_localhost'])
-            if OPTIONS['debug']:
-                mx.set_debuglevel(True)
-
-            mx.ehlo()
-
-            if OPTIONS['smtp_starttls']:
-                mx.starttls()
-
-            if OPTIONS['smtp_password']:
-                mx.login(OPTIONS['smtp_username'], OPTIONS['smtp_password'])
-
-            mx.sendmail(OPTIONS['mail_from'],
-                        contacts,
-                        msg.as_string())
-            mx.close()
+            self._smtp_pool.sendmail(OPTIONS['mail_from'],
+                                     contacts,
+                                     msg.as_string())
+
+    def _resolve_mx(self, domain):
+        with self._mx_lock:
+            cached = self._mx_cache.get(domain)
+        if cached and cached[1] > time.time():
+            return cached[0]
+
+        dns_answers = dns.resolver.query(domain, 'MX')
+        if len(dns_answers) <= 0:
+            raise Exception('Failed to find mail exchange for {}'.format(domain))  # nopep8
+
+        # lowest preference is the most preferred mail exchange
+        mxhost = min(dns_answers, key=lambda x: x.preference).exchange.to_text()
+        expiration = getattr(dns_answers, 'expiration', time.time() + 300)
+        with self._mx_lock:
+            self._mx_cache[domain] = (mxhost, expiration)
+        return mxhost
+
+    def _send_to_domain(self, domain, rcpts, msg):
+        mxhost = None
+        try:
+            mxhost = self._resolve_mx(domain)
+            with self._mx_lock:
+                if mxhost not in self._mx_pools:
+                    self._mx_pools[mxhost] = SMTPPool(mxhost,
+                                                      OPTIONS['smtp_port'],
+                                                      size=OPTIONS['smtp_pool_size'],
+                                                      authenticate=False)
+                pool = self._mx_pools[mxhost]
+            pool.sendmail(OPTIONS['mail_from'], rcpts, msg)
+            LOG.debug('Sent notification email to {} (mta={})'.format(', '.join(rcpts), mxhost))  # nopep8
+        except Exception as e:
+            LOG.error('Failed to send email to address {} (mta={}): {}'.format(', '.join(rcpts), mxhost, str(e)))  # nopep8
 
 
 def validate_rules(rules):
@@ -392,7 +941,6 @@ def validate_rules(rules):
             LOG.warning('Invalid rule %s, must be dict', rule)
             continue
         valid = True
-        # TODO: This could be optimized to use sets instead
         for key in ['name', 'fields', 'contacts']:
             if key not in rule:
                 LOG.warning('Invalid rule %s, must have %s', rule, key)
@@ -410,8 +958,10 @@ def validate_rules(rules):
                                 rule, key)
                     valid = False
                     break
+            if valid is False:
+                break
             try:
-                re.compile(field['regex'])
+                compile_regex(field['regex'])
             except re.error:
                 LOG.warning('Invalid rule %s, regex %s is not legal',
                             rule, field['regex'])
@@ -448,6 +998,11 @@ def on_sigterm(x, y):
     raise SystemExit
 
 
+def consume():
+    with Connection(OPTIONS['amqp_url']) as conn:
+        FanoutConsumer(connection=conn).run()
+
+
 def main():
     global OPTIONS
 
@@ -515,6 +1070,9 @@ def main():
     if group_rules is not None:
         OPTIONS['group_rules'] = group_rules
 
+    if OPTIONS['hold_journal']:
+        on_hold.restore(HoldJournal(OPTIONS['hold_journal']))
+
     # Registering action for SIGTERM signal handling
     signal.signal(signal.SIGTERM, on_sigterm)
 
@@ -531,17 +1089,23 @@ def main():
     loginfo = 'DEBUG' if OPTIONS['debug'] else 'INFO'
     setup_logging(loglevel=loginfo, loggers=[''])
 
-    with Connection(OPTIONS['amqp_url']) as conn:
-        try:
-            consumer = FanoutConsumer(connection=conn)
-            consumer.run()
-        except (SystemExit, KeyboardInterrupt):
-            mailer.should_stop = True
-            mailer.join()
-            sys.exit(0)
-        except Exception as e:
-            print(str(e))
-            sys.exit(1)
+    consumers = OPTIONS['amqp_consumers']
+    if consumers > 1 and (not OPTIONS['amqp_queue_name'] or OPTIONS['amqp_queue_exclusive']):
+        LOG.warning('amqp_consumers requires a named queue that is not exclusive, using 1 consumer')
+        consumers = 1
+
+    for i in range(1, consumers):
+        threading.Thread(target=consume, name='Consumer-%d' % i, daemon=True).start()
+
+    try:
+        consume()
+    except (SystemExit, KeyboardInterrupt):
+        mailer.stop()
+        mailer.join()
+        sys.exit(0)
+    except Exception as e:
+        print(str(e))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
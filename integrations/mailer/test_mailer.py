@@ -0,0 +1,478 @@
+'''
+Unit test definitions for the mail sender
+'''
+import os
+import socket
+import threading
+import time
+from email.header import decode_header, make_header
+from email.mime.text import MIMEText
+
+import mailer
+import pytest
+from alertaclient.models.alert import Alert
+from mock import MagicMock, patch
+
+
+def test_hold_queue_release_order():
+    '''
+    Test held alerts are released in order of release time
+    '''
+    held = mailer.HoldQueue()
+    now = time.time()
+    held.hold('b', 'alert-b', now - 1)
+    held.hold('a', 'alert-a', now - 2)
+    held.hold('c', 'alert-c', now + 60)
+    assert len(held) == 3
+    assert held.pop_due(timeout=0) == ['alert-a', 'alert-b']
+    assert 'c' in held and 'a' not in held
+
+
+def test_hold_queue_replace_and_cancel():
+    '''
+    Test re-held alerts use the latest release time and cancelled
+    alerts are never released
+    '''
+    held = mailer.HoldQueue()
+    now = time.time()
+    held.hold('a', 'alert-a1', now - 1)
+    held.hold('a', 'alert-a2', now + 60)
+    held.hold('b', 'alert-b', now - 1)
+    assert held.cancel('b') is True
+    assert held.cancel('b') is False
+    assert held.pop_due(timeout=0) == []
+    assert len(held) == 1
+
+    held.hold('a', 'alert-a3', now - 1)
+    assert held.pop_due(timeout=0) == ['alert-a3']
+    assert len(held) == 0
+
+
+def test_hold_queue_many_alerts():
+    '''
+    Test stale heap entries are compacted when alerts are re-held
+    '''
+    held = mailer.HoldQueue()
+    now = time.time()
+    for i in range(100000):
+        held.hold(i % 1000, i, now + 60 + i)
+    assert len(held) == 1000
+    assert len(held._heap) <= 2 * len(held) + 1024
+    held.hold('due', 'alert-due', now - 1)
+    assert held.pop_due(timeout=0) == ['alert-due']
+
+
+def test_hold_queue_wakes_sender():
+    '''
+    Test a waiting sender is woken when an earlier alert is held
+    '''
+    held = mailer.HoldQueue()
+    held.hold('later', 'alert-later', time.time() + 60)
+    released = []
+
+    def sender():
+        released.extend(held.pop_due(timeout=10))
+
+    t = threading.Thread(target=sender)
+    t.start()
+    time.sleep(0.1)
+    held.hold('soon', 'alert-soon', time.time() + 0.1)
+    t.join(timeout=5)
+    assert not t.is_alive()
+    assert released == ['alert-soon']
+
+
+def test_hold_queue_wake_returns_nothing():
+    '''
+    Test wake() interrupts a waiting sender so it can stop
+    '''
+    held = mailer.HoldQueue()
+    t = threading.Thread(target=held.pop_due, kwargs={'timeout': 10})
+    t.start()
+    time.sleep(0.1)
+    held.wake()
+    t.join(timeout=5)
+    assert not t.is_alive()
+
+    # a wake while an alert is due does not cut short the next wait
+    held.hold('due', 'alert-due', time.time() - 1)
+    held.wake()
+    assert held.pop_due(timeout=0) == ['alert-due']
+    held.hold('soon', 'alert-soon', time.time() + 0.2)
+    assert held.pop_due(timeout=5) == ['alert-soon']
+
+
+class SMTPRecorder:
+    '''
+    aiosmtpd handler recording delivered messages and SMTP sessions
+    '''
+
+    def __init__(self):
+        self.sessions = set()
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.add(session.peer)
+        self.messages.append((envelope.mail_from, envelope.rcpt_tos))
+        return '250 OK'
+
+
+@pytest.fixture
+def smtp_server():
+    controller_mod = pytest.importorskip('aiosmtpd.controller')
+    handler = SMTPRecorder()
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        handler.port = s.getsockname()[1]
+    controller = controller_mod.Controller(handler, hostname='127.0.0.1', port=handler.port)
+    controller.start()
+    yield handler
+    controller.stop()
+
+
+def smtp_options(port):
+    options = dict(mailer.DEFAULT_OPTIONS)
+    options.update(smtp_host='127.0.0.1', smtp_port=port, smtp_starttls=False)
+    return options
+
+
+def test_smtp_pool_reuses_session(smtp_server):
+    '''
+    Test messages are sent over a single pooled SMTP session
+    '''
+    with patch.dict(mailer.OPTIONS, smtp_options(smtp_server.port)):
+        pool = mailer.SMTPPool('127.0.0.1', smtp_server.port)
+        for i in range(20):
+            pool.sendmail('alerta@example.com', ['ops@example.com'], 'Subject: %d\n\nbody' % i)
+        pool.close()
+    assert len(smtp_server.messages) == 20
+    assert len(smtp_server.sessions) == 1
+
+
+def test_smtp_pool_reconnects(smtp_server):
+    '''
+    Test a dropped or long idle session is replaced by a new one
+    '''
+    with patch.dict(mailer.OPTIONS, smtp_options(smtp_server.port)):
+        pool = mailer.SMTPPool('127.0.0.1', smtp_server.port)
+        pool.sendmail('alerta@example.com', ['ops@example.com'], 'Subject: 1\n\nbody')
+
+        # pooled session is dropped
+        _, mx = pool._idle[0]
+        mx.sock.shutdown(socket.SHUT_RDWR)
+        pool.sendmail('alerta@example.com', ['ops@example.com'], 'Subject: 2\n\nbody')
+
+        # session idle for longer than the NOOP interval is checked first
+        mailer.OPTIONS['smtp_noop_interval'] = -1
+        pool.sendmail('alerta@example.com', ['ops@example.com'], 'Subject: 3\n\nbody')
+        pool.close()
+    assert len(smtp_server.messages) == 3
+    assert len(smtp_server.sessions) == 2
+
+
+def test_digest_groups_alerts_by_contacts():
+    '''
+    Test alerts released together are sent as one digest per contact list
+    '''
+    rules = [{'name': 'db',
+              'fields': [{'field': 'resource', 'regex': r'db-\d+'}],
+              'contacts': ['dba@example.com'],
+              'exclude': True}]
+    alerts = [Alert.parse({'id': str(i), 'resource': resource, 'event': 'down',
+                           'environment': 'Production', 'service': ['Web']})
+              for i, resource in enumerate(['web-1', 'db-1', 'web-2', 'db-2', 'web-3'])]
+
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS):
+        mailer.OPTIONS.update(mail_to=['ops@example.com'], group_rules=rules, digest_window=5)
+        mail_sender = mailer.MailSender()
+        with patch.object(mail_sender, '_send_email_message') as _sem:
+            mail_sender.send_emails(alerts)
+
+    assert _sem.call_count == 2
+    sent = {tuple(contacts): msg for (msg, contacts), _ in _sem.call_args_list}
+    assert str(make_header(decode_header(sent[('ops@example.com',)]['Subject']))) == '[3 alerts] down, down, down'
+    assert str(make_header(decode_header(sent[('dba@example.com',)]['Subject']))) == '[2 alerts] down, down'
+    body = sent[('dba@example.com',)].get_payload()[0].get_payload(decode=True).decode('utf-8')
+    assert 'db-1' in body and 'db-2' in body and 'web-1' not in body
+
+
+def test_hold_queue_digest_horizon():
+    '''
+    Test alerts due within the digest window are released together, but
+    never before their release time
+    '''
+    held = mailer.HoldQueue()
+    now = time.time()
+    held.hold('a', 'alert-a', now - 0.5)
+    held.hold('b', 'alert-b', now + 0.2)
+    held.hold('c', 'alert-c', now + 60)
+    assert held.pop_due(timeout=0, horizon=1) == []  # a is delayed for b
+    assert held.pop_due(timeout=5, horizon=1) == ['alert-a', 'alert-b']
+    assert time.time() >= now + 0.5
+
+    # cleared while the earliest alert is delayed
+    now = time.time()
+    held.hold('d', 'alert-d', now - 0.5)
+    held.hold('e', 'alert-e', now + 0.2)
+    held.cancel('e')
+    assert held.pop_due(timeout=5, horizon=1) == ['alert-d']
+
+    # nothing else due within the window
+    held.hold('f', 'alert-f', time.time() - 1)
+    assert held.pop_due(timeout=0, horizon=5) == ['alert-f']
+
+    # a replaced alert no longer due within the window does not delay it
+    now = time.time()
+    held.hold('g', 'alert-g', now - 1)
+    held.hold('h', 'alert-h', now + 0.2)
+    held.hold('h', 'alert-h', now + 60)
+    assert held.pop_due(timeout=0, horizon=1) == ['alert-g']
+
+
+class MXAnswer(list):
+    expiration = time.time() + 3600
+
+
+def mx_record(preference, exchange):
+    record = MagicMock(preference=preference)
+    record.exchange.to_text.return_value = exchange
+    return record
+
+
+def test_skip_mta_delivers_per_domain(smtp_server):
+    '''
+    Test skip_mta delivers one transaction per domain and caches MX lookups
+    '''
+    options = smtp_options(smtp_server.port)
+    options.update(skip_mta=True, mail_from='alerta@example.com')
+    answers = {
+        'example.com': MXAnswer([mx_record(20, 'backup.invalid'), mx_record(10, '127.0.0.1')]),
+        'example.org': MXAnswer([mx_record(10, '127.0.0.1')]),
+    }
+    contacts = ['a@example.com', 'b@example.com', 'c@example.org']
+
+    with patch.dict(mailer.OPTIONS, options), \
+            patch.object(mailer, 'DNS_RESOLVER_AVAILABLE', True), \
+            patch.object(mailer, 'dns', create=True) as dns:
+        dns.resolver.query.side_effect = lambda domain, rdtype: answers[domain]
+        mail_sender = mailer.MailSender()
+        for _ in range(2):
+            msg = MIMEText('body')
+            mail_sender._send_email_message(msg, contacts)
+        mail_sender._mx_executor.shutdown()
+
+    assert dns.resolver.query.call_count == 2
+    rcpts = sorted(sorted(rcpt_tos) for _, rcpt_tos in smtp_server.messages)
+    assert rcpts == [['a@example.com', 'b@example.com']] * 2 + [['c@example.org']] * 2
+
+
+def test_render_10k_alerts_uses_cached_templates():
+    '''
+    Test rendering many alerts loads each template once
+    '''
+    alerts = [Alert.parse({'id': '%08d-0000-0000-0000-000000000000' % i, 'resource': 'web%d' % i,
+                           'event': 'down', 'environment': 'Production', 'service': ['Web']})
+              for i in range(10000)]
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS):
+        mailer.OPTIONS.update(mail_to=['ops@example.com'])
+        mail_sender = mailer.MailSender()
+        templates = {name: template for name, (template, _) in mail_sender._templates.items()}
+        with patch.object(mail_sender, '_send_email_message') as _sem, \
+                patch.object(mail_sender._template_env, 'get_template') as get_template, \
+                patch.object(mail_sender, '_get_template', wraps=mail_sender._get_template) as cached, \
+                patch.object(mailer.platform, 'uname') as uname:
+            for alert in alerts:
+                mail_sender.send_email(alert)
+
+    assert _sem.call_count == 10000
+    # every render was a cache hit on the template compiled at startup
+    assert cached.call_count >= 10000
+    assert get_template.call_count == 0
+    assert {name: template for name, (template, _) in mail_sender._templates.items()} == templates
+    assert uname.call_count == 0
+    msg, _ = _sem.call_args[0]
+    assert 'web9999' in msg.get_payload()[0].get_payload(decode=True).decode('utf-8')
+
+
+def test_template_reloaded_when_changed(tmp_path):
+    '''
+    Test a modified template file is reloaded
+    '''
+    template = tmp_path / 'email.tmpl'
+    template.write_text('version 1 {{ alert.resource }}')
+    alert = Alert.parse({'resource': 'web1', 'event': 'down'})
+
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer, 'TEMPLATE_CHECK_INTERVAL', 0):
+        mailer.OPTIONS.update(mail_to=['ops@example.com'], mail_template=str(template))
+        mail_sender = mailer.MailSender()
+        with patch.object(mail_sender, '_send_email_message'):
+            msg, _ = mail_sender.send_email(alert)
+            assert msg.get_payload()[0].get_payload(decode=True) == b'version 1 web1'
+
+            template.write_text('version 2 {{ alert.resource }}')
+            mtime = time.time() + 10
+            os.utime(str(template), (mtime, mtime))
+            msg, _ = mail_sender.send_email(alert)
+            assert msg.get_payload()[0].get_payload(decode=True) == b'version 2 web1'
+
+
+def test_hold_journal_restored_after_restart(tmp_path):
+    '''
+    Test alerts on hold are restored from the journal after a restart
+    '''
+    path = str(tmp_path / 'mailer.journal')
+    now = time.time()
+    held = mailer.HoldQueue()
+    held.restore(mailer.HoldJournal(path))
+    for name in ['a', 'b', 'c']:
+        held.hold(name, None, now + 60, {'id': name, 'resource': name, 'event': 'down'})
+    held.cancel('b')
+    held.hold('d', 'alert-d', now - 1, {'id': 'd', 'resource': 'd', 'event': 'down'})
+    assert held.pop_due(timeout=0) == ['alert-d']
+    held._journal.close()
+
+    # torn record from a crash while appending
+    with open(path, 'a') as f:
+        f.write('["hold", "e", ')
+
+    restarted = mailer.HoldQueue()
+    restarted.restore(mailer.HoldJournal(path))
+    assert len(restarted) == 2
+    assert 'a' in restarted and 'c' in restarted and 'b' not in restarted
+    alert, release_time, _, _ = restarted._held['a']
+    assert alert.resource == 'a' and release_time == now + 60
+
+    # records written after the torn record survive the next restarts
+    restarted.hold('f', None, now + 60, {'id': 'f', 'resource': 'f', 'event': 'down'})
+    restarted._journal.close()
+    for _ in range(2):
+        restarted = mailer.HoldQueue()
+        restarted.restore(mailer.HoldJournal(path))
+        restarted._journal.close()
+        assert sorted(restarted._held) == ['a', 'c', 'f']
+
+
+def test_hold_journal_compacted(tmp_path):
+    '''
+    Test the journal is rewritten once most of its records are obsolete
+    '''
+    path = str(tmp_path / 'mailer.journal')
+    held = mailer.HoldQueue()
+    held.restore(mailer.HoldJournal(path))
+    now = time.time()
+    for i in range(10000):
+        held.hold(i % 10, None, now + 60 + i, {'id': str(i % 10), 'resource': str(i), 'event': 'down'})
+    assert held._journal.records <= 2 * len(held) + 1024
+    with open(path) as f:
+        assert sum(1 for _ in f) == held._journal.records
+
+    restarted = mailer.HoldQueue()
+    restarted.restore(mailer.HoldJournal(path))
+    assert sorted(restarted._held) == list(range(10))
+    assert restarted._held[9][0].resource == '9999'
+
+
+def alert_body(i, severity='major'):
+    return {'id': '%08d-0000-0000-0000-000000000000' % i, 'resource': 'web%d' % i,
+            'event': 'down', 'severity': severity, 'status': 'open'}
+
+
+def test_consumer_batches_acks():
+    '''
+    Test messages are acknowledged with a single multiple ack per batch
+    '''
+    conn = MagicMock()
+    conn.transport.driver_type = 'amqp'
+    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS), \
+            patch.object(mailer, 'on_hold', mailer.HoldQueue()) as held:
+        mailer.OPTIONS.update(amqp_ack_batch=10, amqp_prefetch_count=100)
+        consumer = mailer.FanoutConsumer(conn)
+        messages = [MagicMock() for _ in range(25)]
+        for i, message in enumerate(messages):
+            consumer.on_message(alert_body(i), message)
+        assert len(held) == 25
+
+        acked = [i for i, message in enumerate(messages) if message.ack.called]
+        assert acked == [9, 19]
+        messages[19].ack.assert_called_once_with(multiple=True)
+
+        consumer.on_iteration()
+        assert not messages[24].ack.called
+        with patch.object(mailer, 'ACK_INTERVAL', 0):
+            consumer.on_iteration()
+        messages[24].ack.assert_called_once_with(multiple=True)
+
+
+def test_consumer_memory_transport():
+    '''
+    Test batched acks on a transport without multiple acks
+    '''
+    from kombu import Connection, Exchange, Producer
+
+    options = dict(mailer.DEFAULT_OPTIONS)
+    options.update(amqp_url='memory://', amqp_queue_name='mailer', amqp_queue_exclusive=False,
+                   amqp_ack_batch=8, amqp_prefetch_count=16)
+    with patch.dict(mailer.OPTIONS, options), \
+            patch.object(mailer, 'on_hold', mailer.HoldQueue()) as held, \
+            Connection('memory://') as conn:
+        consumer = mailer.FanoutConsumer(conn)
+        with consumer.consumer_context() as (connection, channel, _):
+            producer = Producer(connection.channel(), exchange=Exchange('notify', type='fanout'))
+            for i in range(20):
+                producer.publish(alert_body(i), serializer='json')
+            for _ in range(20):
+                connection.drain_events(timeout=1)
+            unacked = lambda: len(channel.qos._delivered) - len(channel.qos._dirty)  # noqa: E731
+            assert unacked() == 4
+            consumer.flush_acks()
+            assert unacked() == 0
+    assert len(held) == 20
+
+
+def test_consumer_rejects_malformed_messages():
+    '''
+    Test malformed messages do not use up the prefetch window
+    '''
+    from kombu import Connection, Exchange, Producer
+
+    options = dict(mailer.DEFAULT_OPTIONS)
+    options.update(amqp_url='memory://', amqp_queue_name='mailer-malformed', amqp_queue_exclusive=False,
+                   amqp_prefetch_count=2)
+    with patch.dict(mailer.OPTIONS, options), \
+            patch.object(mailer, 'on_hold', mailer.HoldQueue()) as held, \
+            Connection('memory://') as conn:
+        consumer = mailer.FanoutConsumer(conn)
+        with consumer.consumer_context() as (connection, channel, _):
+            producer = Producer(connection.channel(), exchange=Exchange('notify', type='fanout'))
+            producer.publish('not an alert', serializer='json')
+            producer.publish({'resource': 'web0'}, serializer='json')
+            producer.publish(alert_body(0), serializer='json')
+            for _ in range(3):
+                connection.drain_events(timeout=1)
+    assert len(held) == 1
+
+
+@pytest.mark.parametrize('serializer,compression', [('msgpack', None), ('msgpack', 'zlib'), ('json', 'lz4')])
+def test_consumer_decodes_compact_payloads(serializer, compression):
+    '''
+    Test messages serialised with msgpack or compressed are decoded
+    '''
+    pytest.importorskip('msgpack')
+    pytest.importorskip('lz4')
+    from kombu import Connection, Exchange, Producer
+
+    options = dict(mailer.DEFAULT_OPTIONS)
+    options.update(amqp_url='memory://', amqp_queue_name='mailer-compact', amqp_queue_exclusive=False)
+    with patch.dict(mailer.OPTIONS, options), \
+            patch.object(mailer, 'on_hold', mailer.HoldQueue()) as held, \
+            Connection('memory://') as conn:
+        consumer = mailer.FanoutConsumer(conn)
+        with consumer.consumer_context() as (connection, channel, _):
+            producer = Producer(connection.channel(), exchange=Exchange('notify', type='fanout'))
+            for i in range(3):
+                producer.publish(alert_body(i), serializer=serializer, compression=compression)
+            for _ in range(3):
+                connection.drain_events(timeout=1)
+    assert len(held) == 3
+    assert held._held['00000001-0000-0000-0000-000000000000'][3] == alert_body(1)
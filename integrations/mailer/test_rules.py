@@ -132,20 +132,28 @@ def test_rules_evaluation(alert_spec, input_rules, expected_contacts):
             assert emailed_contacts == expected_contacts
 
 
+def group_rules_with_pattern(field, regex, pattern):
+    '''
+    Group rules for a single condition, evaluated with a mock pattern
+    '''
+    rules = mailer.GroupRules([{'name': 'rule', 'fields': [{'field': field, 'regex': regex}], 'contacts': []}])
+    _, _, _, prefix, literal = rules._conditions[0]
+    rules._conditions[0] = (field, regex, pattern, prefix, literal)
+    return rules
+
+
 def test_rule_matches_list():
     '''
     Test regex matching is working properly
     for a list
     '''
-    # Mock options to instantiate mailer
-    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS):
-        mail_sender = mailer.MailSender()
-        with patch.object(mailer, 're') as regex:
-            regex.match.side_effect = [MagicMock(), None]
-            assert mail_sender._rule_matches('regex', ['item1']) is True
-            regex.match.assert_called_with('regex', 'item1')
-            assert mail_sender._rule_matches('regex', ['item2']) is False
-            regex.match.assert_called_with('regex', 'item2')
+    pattern = MagicMock()
+    pattern.match.side_effect = [MagicMock(), None]
+    rules = group_rules_with_pattern('tags', r'item\d', pattern)
+    assert rules._matches(Alert.parse({'resource': 'r', 'event': 'e', 'tags': ['item1']}), 0) is True
+    pattern.match.assert_called_with('item1')
+    assert rules._matches(Alert.parse({'resource': 'r', 'event': 'e', 'tags': ['item2']}), 0) is False
+    pattern.match.assert_called_with('item2')
 
 
 def test_rule_matches_string():
@@ -153,12 +161,63 @@ def test_rule_matches_string():
     Test regex matching is working properly
     for a string
     '''
-    # Mock options to instantiate mailer
-    with patch.dict(mailer.OPTIONS, mailer.DEFAULT_OPTIONS):
-        mail_sender = mailer.MailSender()
-        with patch.object(mailer, 're') as regex:
-            regex.search.side_effect = [MagicMock(), None]
-            assert mail_sender._rule_matches('regex', 'value1') is True
-            regex.search.assert_called_with('regex', 'value1')
-            assert mail_sender._rule_matches('regex', 'value2') is False
-            regex.search.assert_called_with('regex', 'value2')
+    pattern = MagicMock()
+    pattern.search.side_effect = [MagicMock(), None]
+    rules = group_rules_with_pattern('resource', r'value\d', pattern)
+    assert rules._matches(Alert.parse({'resource': 'value1', 'event': 'e'}), 0) is True
+    pattern.search.assert_called_with('value1')
+    assert rules._matches(Alert.parse({'resource': 'value2', 'event': 'e'}), 0) is False
+    pattern.search.assert_called_with('value2')
+
+
+@pytest.mark.parametrize('regex, prefix, literal', [
+    ('atag', 'atag', True),
+    (r'db-\w+', 'db-', False),
+    (r'(\w.*)?\d{4}', '', False),
+    ('abc?', 'ab', False),
+    ('ab{2}', 'a', False),
+    ('prod|staging', '', False),
+    ('^web', '', False),
+])
+def test_compile_regex_prefix(regex, prefix, literal):
+    '''
+    Test literal prefixes used to skip regex evaluation
+    '''
+    _, res_prefix, res_literal = mailer.compile_regex(regex)
+    assert res_prefix == prefix
+    assert res_literal is literal
+
+
+GROUP_RULES_DATA = [
+    # list fields match from the start of any item
+    ({'resource': 'web1', 'event': 'down', 'tags': ['x-atag', 'atag2']},
+     [{'name': 'tags', 'fields': [{'field': 'tags', 'regex': 'atag'}],
+       'contacts': ['tags@example.com']}],
+     ['ops@example.com', 'tags@example.com']),
+    # string fields match anywhere, all fields must match
+    ({'resource': 'host-db-01', 'event': 'down', 'environment': 'Production'},
+     [{'name': 'db', 'fields': [{'field': 'resource', 'regex': r'db-\d+'},
+                                {'field': 'environment', 'regex': 'Prod'}],
+       'contacts': [' dba@example.com', 'ops@example.com', 'dba@example.com']},
+      {'name': 'no-match', 'fields': [{'field': 'resource', 'regex': 'web'}],
+       'contacts': ['web@example.com']}],
+     ['ops@example.com', 'dba@example.com']),
+    # exclude replaces earlier contacts
+    ({'resource': 'db-01', 'event': 'down'},
+     [{'name': 'db', 'fields': [{'field': 'resource', 'regex': 'db'}],
+       'contacts': ['dba@example.com']},
+      {'name': 'only', 'fields': [{'field': 'event', 'regex': 'down'}],
+       'contacts': ['oncall@example.com'], 'exclude': True}],
+     ['oncall@example.com']),
+]
+
+
+@pytest.mark.parametrize('alert_spec, input_rules, expected_contacts',
+                         GROUP_RULES_DATA)
+def test_group_rules_contacts(alert_spec, input_rules, expected_contacts):
+    '''
+    Test compiled group rules give the same contacts as rule evaluation
+    '''
+    group_rules = mailer.GroupRules(mailer.validate_rules(input_rules))
+    alert = Alert.parse(alert_spec)
+    assert group_rules.contacts(alert, ['ops@example.com']) == expected_contacts
@@ -4,8 +4,10 @@ import os
 import platform
 import re
 import sys
+from itertools import islice
 
 from alertaclient.api import Client
+from oidindex import OidIndex
 
 __version__ = '5.0.0'
 
@@ -15,11 +17,45 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s: %(levelname)s - %(message)s', level=logging.DEBUG)
 
 
+def iter_varbinds(data, start=0):
+    """Yield (oid, value) pairs from varbinds separated by '~%~', starting
+    at offset start and stopping at the first empty varbind."""
+    while True:
+        end = data.find('~%~', start)
+        varbind = data[start:end] if end != -1 else data[start:]
+        if varbind == '':
+            return
+        try:
+            oid, value = varbind.split(None, 1)
+        except ValueError:
+            oid, value = varbind, ''
+        yield oid, value
+        if end == -1:
+            return
+        start = end + 3
+
+
 class SnmpTrapHandler:
 
     def __init__(self):
 
         self.api = None
+        self.oids = None
+
+        oid_index = os.environ.get('SNMPTRAP_OID_INDEX')
+        if oid_index:
+            try:
+                self.oids = OidIndex(oid_index)
+            except Exception as e:
+                LOG.warning('Failed to load OID index %s: %s', oid_index, e)
+
+    def translate(self, oid):
+        if self.oids:
+            name = self.oids.translate(oid)
+            if name:
+                LOG.debug('Translated %s -> %s', oid, name)
+                return name
+        return oid
 
     def run(self):
 
@@ -71,14 +107,14 @@ class SnmpTrapHandler:
     def parse_snmptrap(self, data):
 
         pdu_data = data.splitlines()
-        varbind_list = pdu_data[:]
 
         trapvars = dict()
+        specials = 0
         for line in pdu_data:
             if line.startswith('$'):
                 special, value = line.split(None, 1)
                 trapvars[special] = value
-                varbind_list.pop(0)
+                specials += 1
 
         if '$s' in trapvars:
             if trapvars['$s'] == '0':
@@ -95,27 +131,16 @@ class SnmpTrapHandler:
             return
 
         # Get varbinds
-        varbinds = dict()
         idx = 0
-        for varbind in '\n'.join(varbind_list).split('~%~'):
-            if varbind == '':
-                break
+        for oid, value in iter_varbinds('\n'.join(islice(pdu_data, specials, None))):
             idx += 1
-            try:
-                oid, value = varbind.split(None, 1)
-            except ValueError:
-                oid = varbind
-                value = ''
-            varbinds[oid] = value
             trapvars['$' + str(idx)] = value  # $n
-            LOG.debug('$%s %s', str(idx), value)
+            LOG.debug('$%s %s %s', idx, oid, value)
 
         trapvars['$q'] = trapvars['$q'].lstrip(
             '.')  # if numeric, remove leading '.'
         trapvars['$#'] = str(idx)
 
-        LOG.debug('varbinds = %s', varbinds)
-
         correlate = list()
         if trap_version == 'SNMPv1':
             if trapvars['$w'] == '0':
@@ -136,34 +161,35 @@ class SnmpTrapHandler:
                 trapvars['$O'] = 'egpNeighborLoss'
             elif trapvars['$w'] == '6':  # enterpriseSpecific(6)
                 if trapvars['$q'].isdigit():  # XXX - specific trap number was not decoded
-                    trapvars['$O'] = '{}.0.{}'.format(
-                        trapvars['$N'], trapvars['$q'])
+                    trapvars['$O'] = self.translate('{}.0.{}'.format(
+                        trapvars['$N'], trapvars['$q']))
                 else:
                     trapvars['$O'] = trapvars['$q']
 
         elif trap_version == 'SNMPv2c':
-            if 'coldStart' in trapvars['$2']:
+            snmp_trap_oid = self.translate(trapvars['$2'])
+            if 'coldStart' in snmp_trap_oid:
                 trapvars['$w'] = '0'
                 trapvars['$W'] = 'Cold Start'
-            elif 'warmStart' in trapvars['$2']:
+            elif 'warmStart' in snmp_trap_oid:
                 trapvars['$w'] = '1'
                 trapvars['$W'] = 'Warm Start'
-            elif 'linkDown' in trapvars['$2']:
+            elif 'linkDown' in snmp_trap_oid:
                 trapvars['$w'] = '2'
                 trapvars['$W'] = 'Link Down'
-            elif 'linkUp' in trapvars['$2']:
+            elif 'linkUp' in snmp_trap_oid:
                 trapvars['$w'] = '3'
                 trapvars['$W'] = 'Link Up'
-            elif 'authenticationFailure' in trapvars['$2']:
+            elif 'authenticationFailure' in snmp_trap_oid:
                 trapvars['$w'] = '4'
                 trapvars['$W'] = 'Authentication Failure'
-            elif 'egpNeighborLoss' in trapvars['$2']:
+            elif 'egpNeighborLoss' in snmp_trap_oid:
                 trapvars['$w'] = '5'
                 trapvars['$W'] = 'EGP Neighbor Loss'
             else:
                 trapvars['$w'] = '6'
                 trapvars['$W'] = 'Enterprise Specific'
-            trapvars['$O'] = trapvars['$2']  # SNMPv2-MIB::snmpTrapOID.0
+            trapvars['$O'] = snmp_trap_oid  # SNMPv2-MIB::snmpTrapOID.0
         LOG.debug('trapvars = %s', trapvars)
 
         LOG.info('%s-Trap-PDU %s from %s at %s %s', trap_version,
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+
+LOG = logging.getLogger('alerta.snmptrap')
+
+# File layout (all integers little-endian):
+#
+#   header   magic(4s) version(H) reserved(H) node_count(I) names_offset(I)
+#   nodes    node_count * (arc(I) name_offset(I) first_child(I) child_count(I))
+#   names    length-prefixed utf-8 labels, length(H) + bytes
+#
+# Node 0 is the root of the OID tree and has no label. The children of any
+# node are stored contiguously and sorted by arc so that each step of a
+# lookup is a binary search over a small slice of the node table.
+MAGIC = b'OIDX'
+VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+NODE = struct.Struct('<IIII')
+LABEL_LEN = struct.Struct('<H')
+NO_NAME = 0xFFFFFFFF
+
+# matches output of "snmptranslate -Tz", eg. "linkDown"	"1.3.6.1.6.3.1.1.5.3"
+MIB_LINE = re.compile(r'^\s*"?([^"\s]+)"?\s+"?([.\d]+)"?\s*$')
+
+
+def oid_to_arcs(oid):
+    """Convert a numeric OID (optionally with leading '.' or 'iso.') to a
+    tuple of integer arcs, or return None if the OID is not numeric."""
+    oid = oid.strip().lstrip('.')
+    if oid.startswith('iso.'):
+        oid = '1.' + oid[4:]
+    try:
+        return tuple(int(arc) for arc in oid.split('.'))
+    except ValueError:
+        return None
+
+
+def build_index(lines, path):
+    """Build a compiled OID index file from "name oid" pairs."""
+    root = {}
+    labels = {}
+    for line in lines:
+        m = MIB_LINE.match(line)
+        if not m:
+            continue
+        name, oid = m.groups()
+        arcs = oid_to_arcs(oid)
+        if not arcs:
+            continue
+        node = root
+        for arc in arcs:
+            node = node.setdefault(arc, {})
+        labels[arcs] = name
+
+    # breadth-first so that every node's children are contiguous
+    nodes = [(0, (), root)]
+    table = []
+    names = bytearray()
+    i = 0
+    while i < len(nodes):
+        arc, arcs, children = nodes[i]
+        name = labels.get(arcs)
+        if name is not None:
+            name_offset = len(names)
+            encoded = name.encode('utf-8')
+            names += LABEL_LEN.pack(len(encoded)) + encoded
+        else:
+            name_offset = NO_NAME
+        table.append([arc, name_offset, len(nodes), len(children)])
+        for child in sorted(children):
+            nodes.append((child, arcs + (child,), children[child]))
+        i += 1
+
+    names_offset = HEADER.size + NODE.size * len(table)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(table), names_offset))
+        for row in table:
+            f.write(NODE.pack(*row))
+        f.write(names)
+    os.rename(tmp, path)
+    LOG.info('Wrote %d OIDs (%d nodes) to %s', len(labels), len(table), path)
+    return len(labels)
+
+
+class OidIndex:
+
+    def __init__(self, path):
+
+        with open(path, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self._count, self._names = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self._buf.close()
+            raise ValueError('{} is not a compiled OID index'.format(path))
+
+    def close(self):
+        self._buf.close()
+
+    def _node(self, idx):
+        return NODE.unpack_from(self._buf, HEADER.size + idx * NODE.size)
+
+    def _label(self, offset):
+        (length,) = LABEL_LEN.unpack_from(self._buf, self._names + offset)
+        start = self._names + offset + LABEL_LEN.size
+        return self._buf[start:start + length].decode('utf-8')
+
+    def _child(self, first, count, arc):
+        lo, hi = first, first + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_arc = self._node(mid)[0]
+            if mid_arc < arc:
+                lo = mid + 1
+            elif mid_arc > arc:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def translate(self, oid):
+        """Return the longest matching MIB label for a numeric OID with any
+        unmatched arcs appended (eg. "ifIndex.3"), or None if not found."""
+        arcs = oid_to_arcs(oid)
+        if not arcs:
+            return None
+
+        _, _, first, count = self._node(0)
+        best = None
+        depth = 0
+        for i, arc in enumerate(arcs):
+            idx = self._child(first, count, arc)
+            if idx is None:
+                break
+            _, name_offset, first, count = self._node(idx)
+            if name_offset != NO_NAME:
+                best = name_offset
+                depth = i + 1
+
+        if best is None:
+            return None
+        return '.'.join([self._label(best)] + [str(arc) for arc in arcs[depth:]])
+
+
+def main():
+
+    if len(sys.argv) != 3:
+        sys.stderr.write('Usage: {} <snmptranslate -Tz output|-> <index file>\n'.format(
+            os.path.basename(sys.argv[0])))
+        sys.exit(2)
+
+    logging.basicConfig(level=logging.INFO)
+    src, dst = sys.argv[1:]
+    if src == '-':
+        build_index(sys.stdin, dst)
+    else:
+        with open(src) as f:
+            build_index(f, dst)
+
+
+if __name__ == '__main__':
+    main()
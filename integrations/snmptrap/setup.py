@@ -10,7 +10,7 @@ setuptools.setup(
     license='MIT',
     author='Nick Satterly',
     author_email='nick.satterly@theguardian.com',
-    py_modules=['handler'],
+    py_modules=['handler', 'oidindex'],
     install_requires=[
         'alerta'
     ],
@@ -18,7 +18,8 @@ setuptools.setup(
     zip_safe=False,
     entry_points={
         'console_scripts': [
-            'alerta-snmptrap = handler:main'
+            'alerta-snmptrap = handler:main',
+            'alerta-snmptrap-oidindex = oidindex:main'
         ]
     },
     keywords='alerta snmp trap monitoring',
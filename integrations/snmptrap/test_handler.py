@@ -0,0 +1,121 @@
+'''
+Unit test definitions for the SNMP trap handler
+'''
+import oidindex
+
+import handler
+
+MIBS = [
+    '"iso"\t\t\t"1"',
+    '"org"\t\t\t"1.3"',
+    '"coldStart"\t\t\t"1.3.6.1.6.3.1.1.5.1"',
+    '"linkDown"\t\t\t"1.3.6.1.6.3.1.1.5.3"',
+    '"ciscoSyslogMIB"\t\t\t"1.3.6.1.4.1.9.9.41"',
+    '"clogMessageGenerated"\t\t\t"1.3.6.1.4.1.9.9.41.2.0.1"',
+]
+
+V1_ENTERPRISE_TRAP = '\n'.join([
+    '$a 10.0.0.1',
+    '$A 10.0.0.1',
+    '$s 0',
+    '$b UDP: [10.0.0.1]:161->[10.0.0.2]:162',
+    '$B router1',
+    '$x 2016-12-18',
+    '$X 15:05:45',
+    '$N .1.3.6.1.4.1.9.9.41.2',
+    '$q 1',
+    '$P TRAP, SNMP v1, community public',
+    '$t 1482073545',
+    '$T 0',
+    '$w 6',
+    '$W Enterprise Specific',
+    'iso.3.6.1.2.1.1.3.0 0:1:41:43.19~%~',
+])
+
+
+def test_oid_index_translate(tmp_path):
+    '''
+    Test compiled OID index longest-prefix lookups
+    '''
+    path = str(tmp_path / 'oids.idx')
+    assert oidindex.build_index(MIBS, path) == 6
+
+    oids = oidindex.OidIndex(path)
+    assert oids.translate('.1.3.6.1.4.1.9.9.41.2.0.1') == 'clogMessageGenerated'
+    assert oids.translate('iso.3.6.1.6.3.1.1.5.3') == 'linkDown'
+    assert oids.translate('1.3.6.1.4.1.9.9.41.5.7') == 'ciscoSyslogMIB.5.7'
+    assert oids.translate('2.25') is None
+    assert oids.translate('SNMPv2-MIB::coldStart') is None
+    oids.close()
+
+
+def test_enterprise_trap_translated(tmp_path, monkeypatch):
+    '''
+    Test undecoded enterprise specific traps are translated
+    '''
+    _, event, _, _, _ = handler.SnmpTrapHandler().parse_snmptrap(V1_ENTERPRISE_TRAP)
+    assert event == '.1.3.6.1.4.1.9.9.41.2.0.1'
+
+    path = str(tmp_path / 'oids.idx')
+    oidindex.build_index(MIBS, path)
+    monkeypatch.setenv('SNMPTRAP_OID_INDEX', path)
+    resource, event, _, trap_version, _ = handler.SnmpTrapHandler().parse_snmptrap(V1_ENTERPRISE_TRAP)
+    assert resource == 'router1'
+    assert event == 'clogMessageGenerated'
+    assert trap_version == 'SNMPv1'
+
+
+def legacy_parse_varbinds(data):
+    '''
+    Varbind parsing as implemented before iter_varbinds(), used as a
+    reference for the trap corpus below
+    '''
+    pdu_data = data.splitlines()
+    varbind_list = pdu_data[:]
+    trapvars = dict()
+    for line in pdu_data:
+        if line.startswith('$'):
+            special, value = line.split(None, 1)
+            trapvars[special] = value
+            varbind_list.pop(0)
+    idx = 0
+    for varbind in '\n'.join(varbind_list).split('~%~'):
+        if varbind == '':
+            break
+        idx += 1
+        try:
+            _, value = varbind.split(None, 1)
+        except ValueError:
+            value = ''
+        trapvars['$' + str(idx)] = value
+    trapvars['$#'] = str(idx)
+    return trapvars
+
+
+def make_trap(varbinds, sep='\n'):
+    header = V1_ENTERPRISE_TRAP.rsplit('\n', 1)[0]
+    return header + sep + '~%~'.join(varbinds) + sep
+
+
+TRAP_CORPUS = [
+    make_trap([]),
+    make_trap(['']),
+    make_trap(['iso.3.6.1.2.1.1.3.0 0:1:41:43.19']),
+    make_trap(['iso.3.6.1.2.1.1.3.0 0:1:41:43.19', '']),
+    make_trap(['iso.3.6.1.2.1.1.3.0', '   ', 'oid "multi\nline\r\nvalue"', 'oid2 x']),
+    make_trap(['oid "trailing sep"', '', 'ignored after empty varbind'], sep='\r\n'),
+    make_trap(['iso.3.6.1.4.1.9.9.41.1.2.3.1.%d "value %d"' % (i, i) for i in range(5000)]),
+    make_trap(['iso.3.6.1.4.1.2021.%d "line %d\ncontinued\n"' % (i, i) for i in range(5000)]),
+]
+
+
+def test_varbind_parser_matches_legacy():
+    '''
+    Test single-pass varbind parsing produces identical trapvars
+    '''
+    trap_handler = handler.SnmpTrapHandler()
+    for data in TRAP_CORPUS:
+        expected = legacy_parse_varbinds(data)
+        _, _, _, _, trapvars = trap_handler.parse_snmptrap(data)
+        varbinds = {k: v for k, v in trapvars.items() if k[1:].isdigit() or k == '$#'}
+        assert varbinds == {k: v for k, v in expected.items() if k[1:].isdigit() or k == '$#'}
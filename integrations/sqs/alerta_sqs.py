@@ -1,12 +1,15 @@
 #!/usr/bin/env python
 
+import json
 import logging
 import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
-import boto.sqs
-from boto.sqs.message import RawMessage
+import boto3
+from alertaclient.api import Client
+from botocore.exceptions import BotoCoreError, ClientError
 from flask.config import Config
 
 LOG = logging.getLogger('alerta.sqs')
@@ -26,46 +29,118 @@ AWS_SECRET_ACCESS_KEY = os.environ.get(
     'AWS_SECRET_ACCESS_KEY') or config.get('AWS_SECRET_ACCESS_KEY')
 AWS_SQS_QUEUE = os.environ.get('AWS_SQS_QUEUE') or config.get(
     'AWS_SQS_QUEUE', DEFAULT_AWS_SQS_QUEUE)
+# eg. http://localhost:9324 for ElasticMQ
+AWS_SQS_ENDPOINT_URL = os.environ.get(
+    'AWS_SQS_ENDPOINT_URL') or config.get('AWS_SQS_ENDPOINT_URL')
+
+SQS_MAX_MESSAGES = int(os.environ.get('SQS_MAX_MESSAGES') or config.get('SQS_MAX_MESSAGES', 10))  # 1-10
+SQS_WAIT_TIME = int(os.environ.get('SQS_WAIT_TIME') or config.get('SQS_WAIT_TIME', 20))
+SQS_VISIBILITY_TIMEOUT = int(os.environ.get('SQS_VISIBILITY_TIMEOUT') or config.get('SQS_VISIBILITY_TIMEOUT', 30))
+SQS_WORKERS = int(os.environ.get('SQS_WORKERS') or config.get('SQS_WORKERS', 4))
+
+ALERTA_ENDPOINT = os.environ.get('ALERTA_ENDPOINT', 'http://localhost:8080')
+ALERTA_API_KEY = os.environ.get('ALERTA_API_KEY', None)
+
+ALERT_ATTRIBUTES = [
+    'id', 'environment', 'severity', 'correlate', 'service', 'group', 'value', 'text',
+    'tags', 'attributes', 'origin', 'type', 'timeout', 'customer'
+]
 
 
 class Worker:
 
-    def __init__(self):
+    def __init__(self, sqs=None, api=None):
 
-        try:
-            connection = boto.sqs.connect_to_region(
-                AWS_REGION,
-                aws_access_key_id=AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-            )
-        except boto.exception.SQSError as e:
-            LOG.error('SQS: ERROR - %s' % e)
-            sys.exit(1)
+        self.sqs = sqs or boto3.client(
+            'sqs',
+            region_name=AWS_REGION,
+            endpoint_url=AWS_SQS_ENDPOINT_URL,
+            aws_access_key_id=AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+        )
+        self.api = api or Client(endpoint=ALERTA_ENDPOINT, key=ALERTA_API_KEY)
 
         try:
-            self.sqs = connection.create_queue(AWS_SQS_QUEUE)
-            self.sqs.set_message_class(RawMessage)
-        except boto.exception.SQSError as e:
+            self.queue_url = self.sqs.create_queue(QueueName=AWS_SQS_QUEUE)['QueueUrl']
+        except (BotoCoreError, ClientError) as e:
             LOG.error('SQS: ERROR - %s' % e)
             sys.exit(1)
 
+        self.pool = ThreadPoolExecutor(max_workers=SQS_WORKERS)
+
     def run(self):
 
         while True:
-            LOG.debug('Waiting for alert on SQS queue "%s"...' % AWS_SQS_QUEUE)
+            LOG.debug('Waiting for alerts on SQS queue "%s"...' % AWS_SQS_QUEUE)
             try:
-                message = self.sqs.read(wait_time_seconds=20)
-            except boto.exception.SQSError as e:
+                self.poll()
+            except (BotoCoreError, ClientError) as e:
                 LOG.error('SQS: ERROR - %s' % e)
                 time.sleep(20)
-                continue
 
-            if message:
-                self.process_message(message)
+    def poll(self):
+        '''Receive a batch of messages, send them as alerts in parallel and
+        delete the ones that were sent with a single batch request.
+        '''
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=SQS_MAX_MESSAGES,
+            WaitTimeSeconds=SQS_WAIT_TIME,
+            VisibilityTimeout=SQS_VISIBILITY_TIMEOUT
+        )
+        messages = response.get('Messages', [])
+        if not messages:
+            return 0
+
+        futures = {self.pool.submit(self.process_message, m): m for m in messages}
+        pending = set(futures)
+        while pending:
+            # messages taking longer than half the visibility timeout are hidden for longer
+            done, pending = wait(pending, timeout=SQS_VISIBILITY_TIMEOUT / 2)
+            if pending:
+                self.extend_visibility([futures[f] for f in pending])
+
+        processed = [futures[f] for f in futures if f.result()]
+        self.delete_messages(processed)
+        return len(processed)
 
     def process_message(self, message):
-        LOG.info('SQS: Received message - %s' % message.get_body())
-        self.sqs.delete_message(message)
+        LOG.debug('SQS: Received message - %s' % message['Body'])
+        try:
+            body = json.loads(message['Body'])
+            if body.get('Type') == 'Notification':  # delivered by an SNS subscription
+                body = json.loads(body['Message'])
+            alert = {k: body[k] for k in ALERT_ATTRIBUTES if k in body}
+            resource, event = body['resource'], body['event']
+        except (ValueError, TypeError, AttributeError, KeyError) as e:
+            LOG.warning('SQS: Invalid alert in message %s - %s' % (message['MessageId'], e))
+            return True  # delete, it will never succeed
+
+        try:
+            self.api.send_alert(resource=resource, event=event, raw_data=message['Body'], **alert)
+        except Exception as e:
+            LOG.error('SQS: Failed to process message %s - %s' % (message['MessageId'], e))
+            return False  # keep, it is received again after the visibility timeout
+        return True
+
+    def extend_visibility(self, messages):
+        response = self.sqs.change_message_visibility_batch(
+            QueueUrl=self.queue_url,
+            Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle'], 'VisibilityTimeout': SQS_VISIBILITY_TIMEOUT}
+                     for i, m in enumerate(messages)]
+        )
+        for failed in response.get('Failed', []):
+            LOG.warning('SQS: Failed to extend visibility timeout - %s' % failed.get('Message'))
+
+    def delete_messages(self, messages):
+        if not messages:
+            return
+        response = self.sqs.delete_message_batch(
+            QueueUrl=self.queue_url,
+            Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(messages)]
+        )
+        for failed in response.get('Failed', []):
+            LOG.warning('SQS: Failed to delete message - %s' % failed.get('Message'))
 
 
 def main():
@@ -15,7 +15,7 @@ setuptools.setup(
     py_modules=['alerta_sqs'],
     install_requires=[
         'alerta',
-        'boto'
+        'boto3'
     ],
     include_package_data=True,
     zip_safe=False,
@@ -0,0 +1,93 @@
+'''
+Unit test definitions for the SQS integration, run against moto
+'''
+import json
+import time
+
+import pytest
+from mock import MagicMock, patch
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_sqs
+alerta_sqs = pytest.importorskip('alerta_sqs')
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with mock_aws():
+        yield boto3.client('sqs', region_name=alerta_sqs.AWS_REGION)
+
+
+def alert_message(i):
+    return json.dumps({'resource': 'web%d' % i, 'event': 'down', 'environment': 'Production',
+                       'severity': 'major', 'service': ['Web'], 'lastReceiveTime': '2026-01-01T00:00:00Z'})
+
+
+def test_batch_receive_and_delete(sqs):
+    '''
+    Test messages are received, sent as alerts and deleted in batches
+    '''
+    api = MagicMock()
+    worker = alerta_sqs.Worker(sqs=sqs, api=api)
+    for i in range(23):
+        sqs.send_message(QueueUrl=worker.queue_url, MessageBody=alert_message(i))
+    sns = {'Type': 'Notification', 'Message': alert_message(23)}
+    sqs.send_message(QueueUrl=worker.queue_url, MessageBody=json.dumps(sns))
+    sqs.send_message(QueueUrl=worker.queue_url, MessageBody='not an alert')
+
+    with patch.object(alerta_sqs, 'SQS_WAIT_TIME', 0), \
+            patch.object(worker.sqs, 'delete_message_batch', wraps=worker.sqs.delete_message_batch) as delete:
+        received = sum(worker.poll() for _ in range(5))
+
+    assert received == 25
+    assert api.send_alert.call_count == 24
+    assert delete.call_count == 3
+    resources = sorted(int(kwargs['resource'][3:]) for _, kwargs in api.send_alert.call_args_list)
+    assert resources == list(range(24))
+    assert 'lastReceiveTime' not in api.send_alert.call_args[1]
+    attrs = sqs.get_queue_attributes(QueueUrl=worker.queue_url, AttributeNames=['All'])['Attributes']
+    assert attrs['ApproximateNumberOfMessages'] == '0'
+    assert attrs['ApproximateNumberOfMessagesNotVisible'] == '0'
+
+
+def test_slow_alert_visibility_extended(sqs):
+    '''
+    Test slow messages are kept hidden and failed messages are not deleted
+    '''
+    def send_alert(resource, **kwargs):
+        if resource == 'web0':
+            time.sleep(1.5)
+        if resource == 'web1':
+            raise RuntimeError('alerta unavailable')
+
+    api = MagicMock()
+    api.send_alert.side_effect = send_alert
+    worker = alerta_sqs.Worker(sqs=sqs, api=api)
+    for i in range(3):
+        sqs.send_message(QueueUrl=worker.queue_url, MessageBody=alert_message(i))
+
+    with patch.object(alerta_sqs, 'SQS_WAIT_TIME', 0), \
+            patch.object(alerta_sqs, 'SQS_VISIBILITY_TIMEOUT', 2), \
+            patch.object(worker.sqs, 'change_message_visibility_batch',
+                         wraps=worker.sqs.change_message_visibility_batch) as extend:
+        assert worker.poll() == 2
+
+    assert extend.call_count == 1
+    assert len(extend.call_args[1]['Entries']) == 1
+    attrs = sqs.get_queue_attributes(QueueUrl=worker.queue_url, AttributeNames=['All'])['Attributes']
+    assert attrs['ApproximateNumberOfMessagesNotVisible'] == '1'
+
+
+def test_failed_alert_not_deleted():
+    '''
+    Test a message is not marked for deletion when the alert cannot be sent
+    '''
+    api = MagicMock()
+    api.send_alert.side_effect = RuntimeError('alerta unavailable')
+    worker = alerta_sqs.Worker(sqs=MagicMock(), api=api)
+    message = {'MessageId': '1', 'ReceiptHandle': 'r1', 'Body': alert_message(0)}
+
+    assert worker.process_message(message) is False
@@ -1,11 +1,36 @@
 #!/usr/bin/env python
 
 import json
+import os
 import platform
 import sys
+import threading
+import time
+from collections import OrderedDict, deque
 
 from alertaclient.api import Client
 
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1  # seconds, doubled after each failed attempt
+MAX_BACKOFF = 30
+
+# processes restarted FLAP_THRESHOLD times within FLAP_WINDOW seconds are flapping
+FLAP_WINDOW = int(os.environ.get('SUPERVISOR_FLAP_WINDOW', 300))
+FLAP_THRESHOLD = int(os.environ.get('SUPERVISOR_FLAP_THRESHOLD', 3))
+HEARTBEAT_INTERVAL = int(os.environ.get('SUPERVISOR_HEARTBEAT_INTERVAL', 60))
+
+CORRELATE = [
+    'PROCESS_STATE_STARTING',
+    'PROCESS_STATE_RUNNING',
+    'PROCESS_STATE_BACKOFF',
+    'PROCESS_STATE_STOPPING',
+    'PROCESS_STATE_EXITED',
+    'PROCESS_STATE_STOPPED',
+    'PROCESS_STATE_FATAL',
+    'PROCESS_STATE_UNKNOWN',
+    'PROCESS_FLAPPING'
+]
+
 
 class Listener:
 
@@ -21,68 +46,180 @@ class Listener:
         sys.stdout.flush()
 
     def log_stderr(self, s):
-        sys.stderr.write(s)
+        sys.stderr.write('{}\n'.format(s))
         sys.stderr.flush()
 
 
-def main():
+class ProcessStates:
+    '''Tracks the state of each process to decide which events are sent.
+    While a process is flapping a single PROCESS_FLAPPING event is sent
+    instead of each of its state changes, until it has not been restarted
+    for FLAP_WINDOW seconds or it is stopped or given up on. Heartbeats
+    are sent at most once every HEARTBEAT_INTERVAL seconds.
+    '''
 
-    api = Client()
-    listener = Listener()
+    def __init__(self):
 
-    while True:
-        listener.send_cmd('READY\n')
-        headers, body = listener.wait()
+        self._processes = dict()  # processname -> {'event', 'restarts', 'flapping'}
+        self._last_heartbeat = 0
+
+    def update(self, headers, body, now=None):
+        '''Return the events to send for an event from supervisord.'''
+        now = time.time() if now is None else now
         event = headers['eventname']
 
         if event.startswith('TICK'):
+            events = self._unflap(now)
+            if now - self._last_heartbeat >= HEARTBEAT_INTERVAL:
+                self._last_heartbeat = now
+                events.append((headers, body))
+            return events
+
+        if not event.startswith('PROCESS_STATE'):
+            return [(headers, body)]
+
+        process = self._processes.setdefault(
+            body['processname'], {'event': None, 'restarts': deque(), 'flapping': False})
+        process['event'] = (headers, body)
+        restarts = process['restarts']
+        if event == 'PROCESS_STATE_STARTING' and body.get('from_state') in ('BACKOFF', 'EXITED'):
+            restarts.append(now)
+        while restarts and restarts[0] < now - FLAP_WINDOW:
+            restarts.popleft()
+
+        if event in ('PROCESS_STATE_STOPPED', 'PROCESS_STATE_FATAL'):
+            process['flapping'] = False
+            restarts.clear()
+        elif len(restarts) >= FLAP_THRESHOLD:
+            if process['flapping']:
+                return []
+            process['flapping'] = True
+            return [self._flapping(headers, body, len(restarts))]
+        # restarts have dropped out of the window so it is no longer flapping
+        process['flapping'] = False
+        return [(headers, body)]
+
+    def _unflap(self, now):
+        events = []
+        for process in self._processes.values():
+            restarts = process['restarts']
+            if process['flapping'] and (not restarts or restarts[-1] < now - FLAP_WINDOW):
+                process['flapping'] = False
+                process['restarts'].clear()
+                events.append(process['event'])
+        return events
+
+    @staticmethod
+    def _flapping(headers, body, restarts):
+        headers = dict(headers, eventname='PROCESS_FLAPPING')
+        body = dict(body, restarts=str(restarts))
+        return headers, body
+
+
+class Sender(threading.Thread):
+    '''Sends events to Alerta in the background so the listener can
+    acknowledge them straight away. Only the latest event for each
+    process (and the latest heartbeat) is kept while waiting to be sent.
+    '''
+
+    def __init__(self, api, listener):
+
+        self.api = api
+        self.listener = listener
+        self._pending = OrderedDict()  # key -> (headers, body)
+        self._cond = threading.Condition()
+
+        super().__init__(name='Sender', daemon=True)
+
+    def submit(self, headers, body):
+        key = body.get('processname', 'heartbeat')
+        with self._cond:
+            self._pending.pop(key, None)
+            self._pending[key] = (headers, body)
+            self._cond.notify()
+
+    @property
+    def pending(self):
+        '''Number of events waiting to be sent.'''
+        with self._cond:
+            return len(self._pending)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                key, event = self._pending.popitem(last=False)
+            self.deliver(key, event)
+
+    def deliver(self, key, event):
+        backoff = RETRY_BACKOFF
+        for attempt in range(MAX_RETRIES):
+            if attempt:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                with self._cond:
+                    if key in self._pending:
+                        return  # superseded by a later event
             try:
-                origin = '{}/{}'.format('supervisord', platform.uname()[1])
-                api.heartbeat(origin, tags=[headers['ver'], event])
+                self.send(*event)
+                return
             except Exception as e:
-                listener.log_stderr(e)
-                listener.send_cmd('RESULT 4\nFAIL')
-            else:
-                listener.send_cmd('RESULT 2\nOK')
+                self.listener.log_stderr(e)
+        self.listener.log_stderr('Failed to send {} event for {}'.format(event[0]['eventname'], key))
+
+    def send(self, headers, body):
+        event = headers['eventname']
+
+        if event.startswith('TICK'):
+            origin = '{}/{}'.format('supervisord', platform.uname()[1])
+            self.api.heartbeat(origin, tags=[headers['ver'], event])
+            return
+
+        if event.endswith('FATAL'):
+            severity = 'critical'
+        elif event == 'PROCESS_FLAPPING':
+            severity = 'major'
+        elif event.endswith('BACKOFF'):
+            severity = 'warning'
+        elif event.endswith('EXITED'):
+            severity = 'minor'
         else:
-            if event.endswith('FATAL'):
-                severity = 'critical'
-            elif event.endswith('BACKOFF'):
-                severity = 'warning'
-            elif event.endswith('EXITED'):
-                severity = 'minor'
-            else:
-                severity = 'normal'
-            try:
-                api.send_alert(
-                    resource='{}:{}'.format(
-                        platform.uname()[1], body['processname']),
-                    environment='Production',
-                    service=['supervisord'],
-                    event=event,
-                    correlate=[
-                        'PROCESS_STATE_STARTING',
-                        'PROCESS_STATE_RUNNING',
-                        'PROCESS_STATE_BACKOFF',
-                        'PROCESS_STATE_STOPPING',
-                        'PROCESS_STATE_EXITED',
-                        'PROCESS_STATE_STOPPED',
-                        'PROCESS_STATE_FATAL',
-                        'PROCESS_STATE_UNKNOWN'
-                    ],
-                    value='serial=%s' % headers['serial'],
-                    severity=severity,
-                    origin=headers['server'],
-                    text='State changed from {} to {}.'.format(
-                        body['from_state'], event),
-                    raw_data='{}\n\n{}'.format(
-                        json.dumps(headers), json.dumps(body))
-                )
-            except Exception as e:
-                listener.log_stderr(e)
-                listener.send_cmd('RESULT 4\nFAIL')
-            else:
-                listener.send_cmd('RESULT 2\nOK')
+            severity = 'normal'
+        if event == 'PROCESS_FLAPPING':
+            text = 'Restarted {} times in {} seconds.'.format(body['restarts'], FLAP_WINDOW)
+        else:
+            text = 'State changed from {} to {}.'.format(body['from_state'], event)
+        self.api.send_alert(
+            resource='{}:{}'.format(
+                platform.uname()[1], body['processname']),
+            environment='Production',
+            service=['supervisord'],
+            event=event,
+            correlate=CORRELATE,
+            value='serial=%s' % headers['serial'],
+            severity=severity,
+            origin=headers['server'],
+            text=text,
+            raw_data='{}\n\n{}'.format(
+                json.dumps(headers), json.dumps(body))
+        )
+
+
+def main():
+
+    api = Client()
+    listener = Listener()
+    sender = Sender(api, listener)
+    sender.start()
+    states = ProcessStates()
+
+    while True:
+        listener.send_cmd('READY\n')
+        headers, body = listener.wait()
+        for event in states.update(headers, body):
+            sender.submit(*event)
+        listener.send_cmd('RESULT 2\nOK')
 
 
 if __name__ == '__main__':
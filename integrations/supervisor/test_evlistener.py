@@ -0,0 +1,113 @@
+'''
+Unit test definitions for the supervisor event listener
+'''
+import threading
+import time
+
+from mock import MagicMock, patch
+
+import evlistener
+
+
+def state_event(serial, processname, state, from_state):
+    headers = {'ver': '3.0', 'server': 'supervisor', 'serial': str(serial), 'pool': 'alerta',
+               'poolserial': str(serial), 'eventname': 'PROCESS_STATE_' + state, 'len': '0'}
+    body = {'processname': processname, 'groupname': processname, 'from_state': from_state, 'pid': '100'}
+    return headers, body
+
+
+def test_sender_coalesces_per_process():
+    '''
+    Test only the latest state of a process is sent while alerta is slow
+    '''
+    release = threading.Event()
+    api = MagicMock()
+    api.send_alert.side_effect = lambda **kwargs: release.wait(5)
+    sender = evlistener.Sender(api, MagicMock())
+    sender.start()
+
+    sender.submit(*state_event(1, 'web', 'STARTING', 'STOPPED'))
+    time.sleep(0.1)  # first event is being sent
+    for serial, state in enumerate(['RUNNING', 'EXITED', 'BACKOFF', 'STARTING', 'RUNNING'], 2):
+        sender.submit(*state_event(serial, 'web', state, 'STARTING'))
+    sender.submit(*state_event(10, 'db', 'FATAL', 'BACKOFF'))
+    assert sender.pending == 2
+    release.set()
+
+    for _ in range(50):
+        if api.send_alert.call_count == 3:
+            break
+        time.sleep(0.1)
+    events = [(kwargs['resource'].split(':')[1], kwargs['event']) for _, kwargs in api.send_alert.call_args_list]
+    assert events == [('web', 'PROCESS_STATE_STARTING'), ('web', 'PROCESS_STATE_RUNNING'), ('db', 'PROCESS_STATE_FATAL')]
+
+
+def test_sender_retries():
+    '''
+    Test a failed event is retried unless a later event supersedes it
+    '''
+    api = MagicMock()
+    api.send_alert.side_effect = [RuntimeError('down'), None]
+    sender = evlistener.Sender(api, MagicMock())
+    with patch.object(evlistener, 'RETRY_BACKOFF', 0):
+        sender.deliver('web', state_event(1, 'web', 'EXITED', 'RUNNING'))
+    assert api.send_alert.call_count == 2
+
+    api.reset_mock()
+    api.send_alert.side_effect = RuntimeError('down')
+    sender.submit(*state_event(2, 'web', 'RUNNING', 'STARTING'))
+    with patch.object(evlistener, 'RETRY_BACKOFF', 0):
+        sender.deliver('web', state_event(1, 'web', 'EXITED', 'RUNNING'))
+    assert api.send_alert.call_count == 1
+
+
+def tick_event(serial):
+    headers = {'ver': '3.0', 'server': 'supervisor', 'serial': str(serial), 'pool': 'alerta',
+               'poolserial': str(serial), 'eventname': 'TICK_5', 'len': '0'}
+    return headers, {'when': '0'}
+
+
+def test_flapping_process_sends_single_alert():
+    '''
+    Test a crash looping process sends one flapping alert until it is stable
+    '''
+    states = evlistener.ProcessStates()
+    sent = []
+    now = 1000
+    for loop in range(10):
+        for state, from_state in [('STARTING', 'BACKOFF' if loop else 'STOPPED'), ('RUNNING', 'STARTING'),
+                                  ('EXITED', 'RUNNING'), ('BACKOFF', 'EXITED')]:
+            now += 1
+            sent.extend(h['eventname'] for h, _ in states.update(*state_event(now, 'web', state, from_state), now=now))
+    loop = ['PROCESS_STATE_STARTING', 'PROCESS_STATE_RUNNING', 'PROCESS_STATE_EXITED', 'PROCESS_STATE_BACKOFF']
+    assert sent == loop * 3 + ['PROCESS_FLAPPING']
+
+    # latest state is sent once the process has not restarted for the window
+    now += 1
+    assert states.update(*state_event(now, 'web', 'STARTING', 'BACKOFF'), now=now) == []
+    now += 1
+    assert states.update(*state_event(now, 'web', 'RUNNING', 'STARTING'), now=now) == []
+    assert [h['eventname'] for h, _ in states.update(*tick_event(now), now=now + 10)] == ['TICK_5']
+    events = states.update(*tick_event(now), now=now + evlistener.FLAP_WINDOW + 1)
+    assert [h['eventname'] for h, _ in events] == ['PROCESS_STATE_RUNNING', 'TICK_5']
+
+    # a state change after the restarts have left the window is sent
+    states = evlistener.ProcessStates()
+    sent = []
+    for now in [0, 10, 20]:
+        sent.extend(states.update(*state_event(now, 'db', 'STARTING', 'BACKOFF'), now=now))
+    assert [h['eventname'] for h, _ in sent] == ['PROCESS_STATE_STARTING', 'PROCESS_STATE_STARTING',
+                                                 'PROCESS_FLAPPING']
+    events = states.update(*state_event(321, 'db', 'EXITED', 'RUNNING'), now=321)
+    assert [h['eventname'] for h, _ in events] == ['PROCESS_STATE_EXITED']
+    events = states.update(*tick_event(360), now=360)
+    assert [h['eventname'] for h, _ in events] == ['TICK_5']
+
+
+def test_heartbeats_sent_on_coarser_schedule():
+    '''
+    Test TICK events are sent as heartbeats at most once per interval
+    '''
+    states = evlistener.ProcessStates()
+    heartbeats = [now for now in range(1000, 1300, 5) if states.update(*tick_event(now), now=now)]
+    assert heartbeats == list(range(1000, 1300, evlistener.HEARTBEAT_INTERVAL))
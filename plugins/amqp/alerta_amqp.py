@@ -1,10 +1,26 @@
+import atexit
 import logging
 import os
+import threading
+import weakref
+from collections import deque
 
 from alerta.plugins import PluginBase
-from kombu import BrokerConnection, Exchange, Producer
+from alerta.utils.format import DateTime
+from amqp import spec
+from amqp.exceptions import MessageNacked
+from kombu import BrokerConnection, Exchange, compression
+from kombu.exceptions import SerializerNotInstalled
+from kombu.pools import producers
+from kombu.serialization import dumps
 from kombu.utils.debug import setup_logging
 
+try:
+    import lz4.frame
+    compression.register(lz4.frame.compress, lz4.frame.decompress, 'application/x-lz4', aliases=['lz4'])
+except ImportError:
+    pass
+
 try:
     from alerta.plugins import app  # alerta >= 5.0
 except ImportError:
@@ -21,11 +37,165 @@ AMQP_URL = os.environ.get('REDIS_URL') or os.environ.get(
 AMQP_TOPIC = os.environ.get('AMQP_TOPIC') or app.config.get(
     'AMQP_TOPIC', DEFAULT_AMQP_TOPIC)
 
+# Payload profile: 'minimal', 'standard' (no history) or 'full' (with history).
+# Default is 'full' or 'standard' depending on AMQP_SEND_ALERT_HISTORY.
+AMQP_PAYLOAD = os.environ.get('AMQP_PAYLOAD') or app.config.get('AMQP_PAYLOAD', None)
+# 'json' or 'msgpack', and optionally 'zlib', 'lz4', 'bzip2' or 'lzma' compression
+AMQP_SERIALIZER = os.environ.get('AMQP_SERIALIZER') or app.config.get('AMQP_SERIALIZER', 'json')
+AMQP_COMPRESSION = os.environ.get('AMQP_COMPRESSION') or app.config.get('AMQP_COMPRESSION', None)
+
+MINIMAL_PAYLOAD = [
+    'id', 'resource', 'event', 'environment', 'severity', 'previousSeverity', 'status', 'service', 'group',
+    'value', 'text', 'tags', 'origin', 'type', 'customer', 'createTime', 'lastReceiveTime', 'duplicateCount',
+    'repeat'
+]
+
+# Messages are published by AMQP_PUBLISHERS background threads in batches of
+# up to AMQP_BATCH_SIZE messages. At most AMQP_QUEUE_SIZE messages are kept
+# waiting to be published, the oldest are dropped first.
+AMQP_PUBLISHERS = int(os.environ.get('AMQP_PUBLISHERS') or app.config.get('AMQP_PUBLISHERS', 2))
+AMQP_BATCH_SIZE = int(os.environ.get('AMQP_BATCH_SIZE') or app.config.get('AMQP_BATCH_SIZE', 100))
+AMQP_QUEUE_SIZE = int(os.environ.get('AMQP_QUEUE_SIZE') or app.config.get('AMQP_QUEUE_SIZE', 10000))
+# wait for the broker to confirm each batch (RabbitMQ only)
+AMQP_CONFIRM_PUBLISH = True if os.environ.get('AMQP_CONFIRM_PUBLISH', 'False') == 'True' else app.config.get(
+    'AMQP_CONFIRM_PUBLISH', False)
+AMQP_CONFIRM_TIMEOUT = float(os.environ.get('AMQP_CONFIRM_TIMEOUT') or app.config.get('AMQP_CONFIRM_TIMEOUT', 10))
+
+AMQP_RETRY_POLICY = {
+    'max_retries': 3,
+    'interval_start': 0,
+    'interval_step': 1,
+    'interval_max': 5,
+}
+
+
+class AsyncPublisher:
+    '''Publishes messages from background threads, so publishing only
+    appends the message to a bounded buffer. Each thread publishes a
+    batch at a time with a producer from the kombu producer pool, as
+    channels must not be shared between threads.
+    '''
+
+    def __init__(self, connection, exchange, threads=AMQP_PUBLISHERS, batch_size=AMQP_BATCH_SIZE,
+                 buffer_size=AMQP_QUEUE_SIZE, confirm=AMQP_CONFIRM_PUBLISH, serializer='json', compression=None):
+
+        self.connection = connection
+        self.exchange = exchange
+        self.serializer = serializer
+        self.compression = compression
+        self.threads = threads
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.confirm = confirm
+        self.dropped = 0
+
+        self._buffer = deque()
+        self._publishing = 0
+        self._cond = threading.Condition()
+        self._pid = None
+        self._delivery_tags = weakref.WeakKeyDictionary()  # channel -> last delivery tag
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def publish(self, body):
+        with self._cond:
+            self._start()
+            self._buffer.append(body)
+            if len(self._buffer) > self.buffer_size:
+                self._buffer.popleft()
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    LOG.warning('AMQP publish buffer full, %d messages dropped', self.dropped)
+            self._cond.notify()
+
+    def flush(self, timeout=None):
+        '''Wait until all buffered messages have been published.'''
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._buffer and not self._publishing, timeout)
+
+    def _start(self):
+        # publisher threads do not survive a fork so are started by the process using them
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        for i in range(self.threads):
+            threading.Thread(target=self._run, name='AMQPPublisher-%d' % i, daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._buffer:
+                    self._cond.wait()
+                batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+                self._publishing += len(batch)
+
+            try:
+                self._publish(batch)
+            except Exception as e:
+                LOG.error('Failed to publish %d messages to AMQP topic "%s": %s', len(batch), self.exchange.name, e)
+                with self._cond:
+                    self.dropped += len(batch)
+            finally:
+                with self._cond:
+                    self._publishing -= len(batch)
+                    self._cond.notify_all()
+
+    def _publish(self, batch):
+        with producers[self.connection].acquire(block=True) as producer:
+            confirm = self.confirm and producer.connection.transport.driver_type == 'amqp'
+            if confirm:
+                channel = producer.channel
+                first = self._confirm_select(channel)
+            published = 0
+            try:
+                for body in batch:
+                    producer.publish(body, exchange=self.exchange, declare=[self.exchange],
+                                     serializer=self.serializer, compression=self.compression,
+                                     retry=True, retry_policy=AMQP_RETRY_POLICY)
+                    published += 1
+            except Exception:
+                if confirm:
+                    # messages published before the failure still used up delivery tags
+                    self._delivery_tags[channel] = first + published - 1
+                raise
+            if confirm:
+                self._wait_for_confirms(channel, first, len(batch))
+
+    def _confirm_select(self, channel):
+        '''Put the channel in confirm mode, if not already, and return the
+        delivery tag of the next message published on it.
+        '''
+        if not channel._confirm_selected:
+            channel._confirm_selected = True
+            channel.confirm_select()
+            self._delivery_tags[channel] = 0
+        return self._delivery_tags.get(channel, 0) + 1
+
+    def _wait_for_confirms(self, channel, first, count):
+        # one wait for the whole batch instead of a round trip for each message
+        last = first + count - 1
+        self._delivery_tags[channel] = last
+        pending = set(range(first, last + 1))
+
+        def on_confirm(method, delivery_tag, multiple):
+            if delivery_tag < first:
+                return  # late confirm for a batch that already failed
+            if method == spec.Basic.Nack:
+                raise MessageNacked('message {} was not accepted by the broker'.format(delivery_tag))
+            if multiple:
+                pending.difference_update(range(first, delivery_tag + 1))
+            else:
+                pending.discard(delivery_tag)
+
+        while pending:
+            channel.wait([spec.Basic.Ack, spec.Basic.Nack], callback=on_confirm, timeout=AMQP_CONFIRM_TIMEOUT)
+
 
 class FanoutPublisher(PluginBase):
 
     def __init__(self, name=None):
-        if app.config['DEBUG']:
+        if app.config.get('DEBUG'):
             setup_logging(loglevel='DEBUG', loggers=[''])
 
         self.connection = BrokerConnection(AMQP_URL)
@@ -34,13 +204,23 @@ class FanoutPublisher(PluginBase):
         except Exception as e:
             LOG.error('Failed to connect to AMQP transport %s: %s', AMQP_URL, e)
             raise RuntimeError
+        finally:
+            # connections for publishing are taken from the kombu connection pool
+            self.connection.release()
 
-        self.channel = self.connection.channel()
-        self.exchange_name = AMQP_TOPIC
+        try:
+            dumps({}, serializer=AMQP_SERIALIZER)
+            if AMQP_COMPRESSION:
+                compression.get_encoder(AMQP_COMPRESSION)
+        except (SerializerNotInstalled, KeyError) as e:
+            LOG.error('AMQP serializer %s or compression %s not available: %s', AMQP_SERIALIZER, AMQP_COMPRESSION, e)
+            raise RuntimeError
 
-        self.exchange = Exchange(
-            name=self.exchange_name, type='fanout', channel=self.channel)
-        self.producer = Producer(exchange=self.exchange, channel=self.channel)
+        self.exchange_name = AMQP_TOPIC
+        self.exchange = Exchange(name=self.exchange_name, type='fanout')
+        self.publisher = AsyncPublisher(self.connection, self.exchange,
+                                        serializer=AMQP_SERIALIZER, compression=AMQP_COMPRESSION)
+        atexit.register(self.publisher.flush, timeout=5)
 
         super().__init__(name)
 
@@ -52,10 +232,25 @@ class FanoutPublisher(PluginBase):
     def post_receive(self, alert, **kwargs):
         LOG.info('Sending message %s to AMQP topic "%s"',
                  alert.get_id(), AMQP_TOPIC)
-        body = alert.get_body(history=self.get_config(
-            'AMQP_SEND_ALERT_HISTORY', default=DEFAULT_AMQP_SEND_ALERT_HISTORY, type=bool, **kwargs))
+        body = self.get_payload(alert, **kwargs)
         LOG.debug('Message: %s', body)
-        self.producer.publish(body, declare=[self.exchange], retry=True)
+        self.publisher.publish(body)
+
+    def get_payload(self, alert, **kwargs):
+        profile = self.get_config('AMQP_PAYLOAD', default=AMQP_PAYLOAD, **kwargs)
+        if not profile:
+            history = self.get_config(
+                'AMQP_SEND_ALERT_HISTORY', default=DEFAULT_AMQP_SEND_ALERT_HISTORY, type=bool, **kwargs)
+            profile = 'full' if history else 'standard'
+
+        body = alert.get_body(history=profile == 'full')
+        for h in body['history']:
+            # only JSON can serialise datetimes
+            if h.get('updateTime'):
+                h['updateTime'] = DateTime.iso8601(h['updateTime'])
+        if profile == 'minimal':
+            return {k: body[k] for k in MINIMAL_PAYLOAD if k in body}
+        return body
 
     def status_change(self, alert, status, text, **kwargs):
         return
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 
-from kombu import Connection, Exchange, Queue
+from kombu import Connection, Exchange, Queue, compression
 from kombu.mixins import ConsumerMixin
 
+try:
+    import lz4.frame
+    compression.register(lz4.frame.compress, lz4.frame.decompress, 'application/x-lz4', aliases=['lz4'])
+except ImportError:
+    pass
+
 AMQP_URL = 'mongodb://localhost:27017/kombu'
 AMQP_TOPIC = 'notify'
 
@@ -30,7 +36,7 @@ class FanoutConsumer(ConsumerMixin):
         ]
         return [
             Consumer(queues=queues, accept=[
-                     'json'], callbacks=[self.on_message])
+                     'json', 'msgpack'], callbacks=[self.on_message])
         ]
 
     def on_message(self, body, message):
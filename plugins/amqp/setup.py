@@ -16,6 +16,10 @@ setup(
         'kombu',
         'pytz'
     ],
+    extras_require={
+        'msgpack': ['msgpack'],
+        'lz4': ['lz4']
+    },
     include_package_data=True,
     zip_safe=True,
     entry_points={
@@ -0,0 +1,221 @@
+import os
+import struct
+import time
+import unittest
+import unittest.mock
+from datetime import datetime
+
+import amqp
+from amqp import serialization, spec
+from amqp.exceptions import MessageNacked
+from flask import Flask
+from kombu import Connection, Producer, Queue, compression
+from kombu.serialization import dumps
+
+import alerta_amqp
+
+
+class FanoutPublisherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['ALERT_TIMEOUT'] = 86400
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.patch = unittest.mock.patch.multiple(alerta_amqp, AMQP_URL='memory://', AMQP_TOPIC='test.notify')
+        self.patch.start()
+
+        self.plugin = alerta_amqp.FanoutPublisher()
+        self.conn = Connection('memory://')
+        self.queue = Queue('test.notify.received', exchange=self.plugin.exchange)
+        self.queue(self.conn.default_channel).declare()
+
+    def tearDown(self):
+        self.queue(self.conn.default_channel).delete()
+        self.conn.release()
+        self.patch.stop()
+        self.ctx.pop()
+
+    def make_alert(self, i):
+        from alerta.models.alert import Alert
+        return Alert(resource='host%d' % i, event='diskUtil', environment='Production', severity='major',
+                     service=['Web'], value='98%', create_time=datetime(2017, 5, 19, 21, 13, 41))
+
+    def received(self):
+        queue = self.queue(self.conn.default_channel)
+        messages = []
+        while True:
+            message = queue.get(no_ack=True)
+            if message is None:
+                return messages
+            messages.append(message.decode())
+
+    def test_messages_published(self):
+
+        alerts = [self.make_alert(i) for i in range(1000)]
+        for alert in alerts:
+            self.plugin.post_receive(alert)
+        self.assertTrue(self.plugin.publisher.flush(timeout=5))
+
+        messages = self.received()
+        self.assertEqual(len(messages), 1000)
+        self.assertEqual({m['id'] for m in messages}, {alert.id for alert in alerts})
+        self.assertEqual(messages[0]['environment'], 'Production')
+
+    @unittest.skipUnless(os.environ.get('BENCHMARK'), 'set BENCHMARK=1 to run benchmarks')
+    def test_publish_benchmark(self):
+
+        alerts = [self.make_alert(i) for i in range(5000)]
+
+        # one shared producer, publishing in the request thread
+        producer = Producer(self.conn.channel(), exchange=self.plugin.exchange)
+        start = time.perf_counter()
+        for alert in alerts:
+            producer.publish(alert.get_body(history=True), declare=[self.plugin.exchange], retry=True)
+        sync = time.perf_counter() - start
+        self.assertEqual(len(self.received()), 5000)
+
+        start = time.perf_counter()
+        for alert in alerts:
+            self.plugin.post_receive(alert)
+        queued = time.perf_counter() - start
+        self.assertTrue(self.plugin.publisher.flush(timeout=10))
+        total = time.perf_counter() - start
+        self.assertEqual(len(self.received()), 5000)
+
+        print('sync: {:.0f} msg/s, post_receive: {:.0f} msg/s, async total: {:.0f} msg/s'.format(
+            5000 / sync, 5000 / queued, 5000 / total))
+
+    def test_buffer_bounded(self):
+
+        publisher = alerta_amqp.AsyncPublisher(self.conn, self.plugin.exchange, threads=0, buffer_size=10)
+        for i in range(15):
+            publisher.publish({'id': i})
+        self.assertEqual(len(publisher), 10)
+        self.assertEqual(publisher.dropped, 5)
+        self.assertEqual(list(publisher._buffer)[0], {'id': 5})
+
+    def make_alert_with_history(self):
+        from alerta.models.alert import Alert
+        from alerta.models.history import History
+        history = [History(id='1234', event='diskUtil', severity='major', status='open', value='%d%%' % i,
+                           text='Disk utilisation is high on /var', change_type='severity',
+                           update_time=datetime(2017, 5, 19, 21, i // 60, i % 60)) for i in range(100)]
+        return Alert(id='1234', resource='host1', event='diskUtil', environment='Production', severity='major',
+                     service=['Web'], value='98%', text='Disk utilisation is high on /var',
+                     raw_data='Filesystem /var 98% used ' * 20, attributes={'region': 'eu-west-1'},
+                     create_time=datetime(2017, 5, 19, 21, 13, 41), history=history)
+
+    def test_payload_profiles(self):
+
+        alert = self.make_alert_with_history()
+        full = self.plugin.get_payload(alert, config={'AMQP_PAYLOAD': 'full'})
+        standard = self.plugin.get_payload(alert, config={'AMQP_PAYLOAD': 'standard'})
+        minimal = self.plugin.get_payload(alert, config={'AMQP_PAYLOAD': 'minimal'})
+
+        self.assertEqual(len(full['history']), 100)
+        self.assertEqual(standard['history'], [])
+        self.assertEqual(standard['rawData'], full['rawData'])
+        self.assertEqual(set(minimal), set(alerta_amqp.MINIMAL_PAYLOAD))
+        self.assertEqual(minimal['createTime'], '2017-05-19T21:13:41.000Z')
+
+        # AMQP_SEND_ALERT_HISTORY still selects the profile when none is set
+        self.assertEqual(self.plugin.get_payload(alert, config={'AMQP_SEND_ALERT_HISTORY': False}), standard)
+        self.assertEqual(self.plugin.get_payload(alert, config={}), full)
+
+        def size(body, serializer, method=None):
+            data = dumps(body, serializer=serializer)[2]
+            return len(compression.compress(data, method)[0] if method else data)
+
+        sizes = [
+            ('full json', size(full, 'json')),
+            ('standard json', size(standard, 'json')),
+            ('standard msgpack zlib', size(standard, 'msgpack', 'zlib')),
+            ('minimal msgpack lz4', size(minimal, 'msgpack', 'lz4')),
+        ]
+        self.assertEqual([s[1] for s in sizes], sorted([s[1] for s in sizes], reverse=True))
+
+    def test_compact_messages_decoded(self):
+
+        with unittest.mock.patch.multiple(alerta_amqp, AMQP_SERIALIZER='msgpack', AMQP_COMPRESSION='lz4'):
+            plugin = alerta_amqp.FanoutPublisher()
+        alert = self.make_alert_with_history()
+        plugin.post_receive(alert, config={'AMQP_PAYLOAD': 'standard'})
+        plugin.post_receive(alert, config={'AMQP_PAYLOAD': 'full'})
+        self.assertTrue(plugin.publisher.flush(timeout=5))
+
+        messages = [self.queue(self.conn.default_channel).get(no_ack=True, accept=['json', 'msgpack'])
+                    for _ in range(2)]
+        for message in messages:
+            self.assertEqual(message.content_type, 'application/x-msgpack')
+            self.assertEqual(message.headers['compression'], 'application/x-lz4')
+        self.assertEqual(messages[0].decode(), alert.get_body(history=False))
+        self.assertEqual(messages[1].decode()['history'][0]['updateTime'], '2017-05-19T21:00:00.000Z')
+
+    def test_unavailable_compression(self):
+
+        with unittest.mock.patch.object(alerta_amqp, 'AMQP_COMPRESSION', 'snappy'):
+            with self.assertRaises(RuntimeError):
+                alerta_amqp.FanoutPublisher()
+
+
+class PublisherConfirmsTestCase(unittest.TestCase):
+
+    @staticmethod
+    def channel(confirms):
+        '''py-amqp channel, on a connection that is never opened, that
+        receives the given (method, delivery tag, multiple) confirm frames.
+        '''
+        channel = amqp.Channel(amqp.Connection(), 1)
+        channel.send_method = unittest.mock.Mock()
+        confirms = list(confirms)
+
+        def drain_events(timeout=None):
+            method, delivery_tag, multiple = confirms.pop(0)
+            payload = struct.pack('>HH', *method) + serialization.dumps('Lb', (delivery_tag, multiple))
+            channel.dispatch_method(method, payload, None)
+
+        channel.connection.drain_events = unittest.mock.Mock(side_effect=drain_events)
+        return channel
+
+    def test_batch_confirmed(self):
+
+        publisher = alerta_amqp.AsyncPublisher(None, None)
+        channel = self.channel([(spec.Basic.Ack, 100, True), (spec.Basic.Ack, 102, False),
+                                (spec.Basic.Ack, 101, False)])
+        self.assertEqual(publisher._confirm_select(channel), 1)
+        channel.send_method.assert_called_once()
+        self.assertEqual(channel.send_method.call_args[0][0], spec.Confirm.Select)
+        publisher._wait_for_confirms(channel, 1, 100)
+        self.assertEqual(channel.connection.drain_events.call_count, 1)
+
+        self.assertEqual(publisher._confirm_select(channel), 101)
+        channel.send_method.assert_called_once()
+        publisher._wait_for_confirms(channel, 101, 2)
+        self.assertEqual(channel.connection.drain_events.call_count, 3)
+
+    def test_batch_nacked(self):
+
+        publisher = alerta_amqp.AsyncPublisher(None, None)
+        channel = self.channel([(spec.Basic.Ack, 1, False), (spec.Basic.Nack, 2, False)])
+        first = publisher._confirm_select(channel)
+        with self.assertRaises(MessageNacked):
+            publisher._wait_for_confirms(channel, first, 3)
+
+    def test_failed_batch_keeps_delivery_tags(self):
+
+        publisher = alerta_amqp.AsyncPublisher('memory://', None, confirm=True)
+        channel = self.channel([(spec.Basic.Nack, 2, False), (spec.Basic.Ack, 5, True)])
+        producer = unittest.mock.MagicMock(channel=channel)
+        producer.connection.transport.driver_type = 'amqp'
+        producer.publish.side_effect = [None, None, OSError('connection reset'), None, None, None]
+        pool = unittest.mock.MagicMock()
+        pool.acquire.return_value.__enter__.return_value = producer
+
+        with unittest.mock.patch.object(alerta_amqp, 'producers', {'memory://': pool}):
+            with self.assertRaises(OSError):
+                publisher._publish([{'id': 1}, {'id': 2}, {'id': 3}])
+            # two messages went out before the failure, the next batch starts at tag 3
+            self.assertEqual(publisher._confirm_select(channel), 3)
+            publisher._publish([{'id': 3}, {'id': 4}, {'id': 5}])
+        self.assertEqual(channel.connection.drain_events.call_count, 2)
@@ -1,9 +1,21 @@
+import atexit
 import logging
 import os
-from datetime import datetime
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from functools import lru_cache
 
 from alerta.plugins import PluginBase
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+
+try:
+    from influxdb_client import InfluxDBClient as InfluxDBClientV2
+    from influxdb_client import WriteOptions, WritePrecision
+except ImportError:  # only needed for InfluxDB 2.x
+    InfluxDBClientV2 = None
 
 try:
     from alerta.plugins import app  # alerta >= 5.0
@@ -21,87 +33,286 @@ INFLUXDB_DSN = os.environ.get('INFLUXDB_DSN') or app.config.get(
 INFLUXDB_DATABASE = os.environ.get(
     'INFLUXDB_DATABASE') or app.config.get('INFLUXDB_DATABASE', None)
 
+# InfluxDB 2.x (and 3.x) is written to instead when INFLUXDB_URL is set
+INFLUXDB_URL = os.environ.get('INFLUXDB_URL') or app.config.get('INFLUXDB_URL', None)
+INFLUXDB_ORG = os.environ.get('INFLUXDB_ORG') or app.config.get('INFLUXDB_ORG', None)
+INFLUXDB_BUCKET = os.environ.get('INFLUXDB_BUCKET') or app.config.get('INFLUXDB_BUCKET', 'alerta')
+INFLUXDB_TOKEN = os.environ.get('INFLUXDB_TOKEN') or app.config.get('INFLUXDB_TOKEN', None)
+
 # Specify the name of a measurement to which all alerts will be logged
 INFLUXDB_MEASUREMENT = os.environ.get(
     'INFLUXDB_MEASUREMENT') or app.config.get('INFLUXDB_MEASUREMENT', 'event')
 
+# Points are written in batches of up to INFLUXDB_BATCH_SIZE points at least
+# every INFLUXDB_FLUSH_INTERVAL seconds. At most INFLUXDB_BUFFER_SIZE points
+# are kept while InfluxDB is unavailable, the oldest are dropped first.
+INFLUXDB_BATCH_SIZE = int(os.environ.get(
+    'INFLUXDB_BATCH_SIZE') or app.config.get('INFLUXDB_BATCH_SIZE', 5000))
+INFLUXDB_FLUSH_INTERVAL = float(os.environ.get(
+    'INFLUXDB_FLUSH_INTERVAL') or app.config.get('INFLUXDB_FLUSH_INTERVAL', 1))
+INFLUXDB_BUFFER_SIZE = int(os.environ.get(
+    'INFLUXDB_BUFFER_SIZE') or app.config.get('INFLUXDB_BUFFER_SIZE', 100000))
+INFLUXDB_MAX_BACKOFF = 30  # seconds
 
-class InfluxDBWrite(PluginBase):
 
-    def __init__(self, name=None):
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = EPOCH.replace(tzinfo=timezone.utc)
 
-        self.client = InfluxDBClient.from_dsn(INFLUXDB_DSN, timeout=2)
 
-        dbname = INFLUXDB_DATABASE or self.client._database
-        try:
-            if dbname:
-                self.client.switch_database(dbname)
-                self.client.create_database(dbname)
-        except Exception as e:
-            LOG.error('InfluxDB: ERROR - %s' % e)
+@lru_cache(maxsize=10000)
+def escape_tag(tag):
+    '''Escape a measurement, tag key or tag value for line protocol.'''
+    return tag.replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,').replace('=', '\\=').replace('\n', '\\n')
 
-        super().__init__(name)
 
-    def pre_receive(self, alert):
-        return alert
+def escape_field(value):
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, int):
+        return str(value) + 'i'
+    if isinstance(value, float):
+        return repr(value)
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+
+def timestamp_ms(time):
+    delta = time - (EPOCH if time.tzinfo is None else EPOCH_UTC)
+    ns = delta.days * 86400 * 10 ** 9 + delta.seconds * 10 ** 9 + delta.microseconds * 10 ** 3
+    return int(ns / 10 ** 6)  # as the influxdb client does
+
 
-    def _influxdb_prepare_point(self, alert, status=None, text=None):
-        tags = {}
+def encode_point(alert, status=None, text=None, measurement=None):
+    '''Encode an alert as a line of line protocol, identical to the
+    line the influxdb client writes for the same point.
+    '''
+    tags = dict()
+    for tag in alert.tags:
+        k, sep, v = tag.partition('=')
+        if sep:
+            tags[k] = v
+    tags['event'] = alert.event
+    tags['resource'] = alert.resource
+    tags['environment'] = alert.environment
+    tags['severity'] = alert.severity
+    tags['status'] = status if status else alert.status
+    tags['service'] = ','.join(alert.service)
+    if alert.customer:
+        tags['customer'] = alert.customer
+
+    line = [escape_tag(measurement or INFLUXDB_MEASUREMENT)]
+    for k in sorted(tags):
+        v = tags[k]
+        if v is None or not k:
+            continue
+        v = escape_tag(v if isinstance(v, str) else str(v))
+        if v:
+            line.append(',')
+            line.append(escape_tag(k))
+            line.append('=')
+            line.append(v)
+
+    value = alert.value if isinstance(alert.value, (float, int)) else str(alert.value)
+    line.append(' ')
+    if text:
+        line.append('text=')
+        line.append(escape_field(text))
+        line.append(',')
+    line.append('value=')
+    line.append(escape_field(value))
+    time = datetime.utcnow() if status else alert.create_time
+    if time is not None:
+        line.append(' ')
+        line.append(str(timestamp_ms(time)))
+    return ''.join(line)
+
+
+class BatchWriter:
+    '''Buffers points and writes them to InfluxDB from a background
+    thread in batches, so writing a point only appends it to the buffer.
+    Batches that fail are kept at the front of the buffer and retried
+    with exponential backoff, unless InfluxDB rejected them as invalid.
+    '''
+
+    def __init__(self, write, batch_size=INFLUXDB_BATCH_SIZE, flush_interval=INFLUXDB_FLUSH_INTERVAL,
+                 buffer_size=INFLUXDB_BUFFER_SIZE):
+
+        self._write = write
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.dropped = 0
+
+        self._buffer = deque()
+        self._writing = 0
+        self._backoff = 0
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def write(self, point):
+        with self._cond:
+            self._start()
+            self._buffer.append(point)
+            if len(self._buffer) > self.buffer_size:
+                self._buffer.popleft()
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    LOG.warning('InfluxDB: buffer full, %d points dropped', self.dropped)
+            if len(self._buffer) == self.batch_size:
+                self._cond.notify()
+
+    def flush(self, timeout=None):
+        '''Wait until all buffered points have been written.'''
+        with self._cond:
+            self._cond.notify()
+            return self._cond.wait_for(lambda: not self._buffer and not self._writing, timeout)
+
+    def _start(self):
+        # the writer thread does not survive a fork so is started by the process using it
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name='InfluxDBWriter', daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.time() + max(self.flush_interval, self._backoff)
+                while len(self._buffer) < self.batch_size or self._backoff:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if not self._buffer:
+                    continue
+                batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+                self._writing = len(batch)
 
-        for tag in alert.tags:
             try:
-                k, v = tag.split('=', 1)
-                tags[k] = v
-            except ValueError:
-                pass
-
-        tags.update(
-            event=alert.event,
-            resource=alert.resource,
-            environment=alert.environment,
-            severity=alert.severity,
-            status=status if status else alert.status,
-            service=','.join(alert.service)
+                self._write(batch)
+                self._backoff = 0
+            except InfluxDBClientError as e:
+                if e.code and 400 <= e.code < 500 and e.code != 429:
+                    # eg. a field type conflict, that would fail again however often it is retried
+                    LOG.error('InfluxDB: ERROR - %s, %d points rejected', e, len(batch))
+                    self._backoff = 0
+                    with self._cond:
+                        self.dropped += len(batch)
+                else:
+                    self._retry(batch, e)
+            except Exception as e:
+                self._retry(batch, e)
+            finally:
+                with self._cond:
+                    self._writing = 0
+                    self._cond.notify_all()
+
+    def _retry(self, batch, e):
+        LOG.warning('InfluxDB: ERROR - %s, retrying %d points', e, len(batch))
+        self._backoff = min(self._backoff * 2 or 1, INFLUXDB_MAX_BACKOFF)
+        with self._cond:
+            # keep the batch for the next attempt, within the buffer size
+            room = max(self.buffer_size - len(self._buffer), 0)
+            keep = batch[-room:] if room else []
+            self.dropped += len(batch) - len(keep)
+            self._buffer.extendleft(reversed(keep))
+
+
+class BucketWriter:
+    '''Writes points to an InfluxDB 2.x bucket with the batching write
+    API of the influxdb-client package, which buffers points and writes
+    them in batches from a background thread, retrying failed batches.
+    '''
+
+    def __init__(self, url, org, bucket, token, batch_size=INFLUXDB_BATCH_SIZE,
+                 flush_interval=INFLUXDB_FLUSH_INTERVAL):
+
+        self.bucket = bucket
+        self.org = org
+        self.client = InfluxDBClientV2(url=url, token=token, org=org, timeout=10000, enable_gzip=True)
+        self.options = WriteOptions(
+            batch_size=batch_size,
+            flush_interval=int(flush_interval * 1000),
+            retry_interval=1000,
+            max_retry_delay=INFLUXDB_MAX_BACKOFF * 1000
         )
-        if alert.customer:
-            tags.update(customer=alert.customer)
-
-        # event data
-        point = {
-            'measurement': INFLUXDB_MEASUREMENT,
-            'time': datetime.utcnow() if status else alert.create_time,
-            'tags': tags,
-            'fields': {}
-        }
-
-        # make sure we store the value in its original format
-        if isinstance(alert.value, float) or isinstance(alert.value, int):
-            point['fields']['value'] = alert.value
+
+        self._write_api = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def write(self, point):
+        with self._lock:
+            # the write API thread does not survive a fork so is created by the process using it
+            if self._write_api is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._write_api = self.client.write_api(write_options=self.options,
+                                                        error_callback=self._on_error)
+            self._write_api.write(self.bucket, self.org, record=point, write_precision=WritePrecision.MS)
+
+    def flush(self, timeout=None):
+        '''Write all buffered points. The write API can only be flushed by
+        closing it, so a new one is created by the next write.
+        '''
+        with self._lock:
+            write_api, self._write_api = self._write_api, None
+            if write_api is None or self._pid != os.getpid():
+                return True
+            if timeout is not None:
+                self.options.max_close_wait = int(timeout * 1000)
+            write_api.close()
+            return True
+
+    @staticmethod
+    def _on_error(conf, data, e):
+        LOG.warning('InfluxDB: ERROR - %s, %d points not written', e, len(data.splitlines()))
+
+
+class InfluxDBWrite(PluginBase):
+
+    def __init__(self, name=None):
+
+        if INFLUXDB_URL:
+            if InfluxDBClientV2 is None:
+                raise RuntimeError('InfluxDB: influxdb-client package is required to write to INFLUXDB_URL')
+            self.client = None
+            self.writer = BucketWriter(INFLUXDB_URL, INFLUXDB_ORG, INFLUXDB_BUCKET, INFLUXDB_TOKEN)
         else:
-            point['fields']['value'] = str(alert.value)
+            self.client = InfluxDBClient.from_dsn(INFLUXDB_DSN, timeout=2, gzip=True)
+            if INFLUXDB_DATABASE:
+                self.client.switch_database(INFLUXDB_DATABASE)
+            self.writer = BatchWriter(self._write_points)
+        atexit.register(self.writer.flush, timeout=5)
 
-        if text:
-            point['fields']['text'] = text
+        super().__init__(name)
 
-        return point
+    def pre_receive(self, alert):
+        return alert
+
+    def _write_points(self, lines):
+        try:
+            self.client.write_points(lines, time_precision='ms', protocol='line')
+        except InfluxDBClientError as e:
+            # the database is only created when it is found to be missing
+            if e.code != 404 or not self.client._database:
+                raise
+            LOG.info('InfluxDB: creating database %s', self.client._database)
+            self.client.create_database(self.client._database)
+            self.client.write_points(lines, time_precision='ms', protocol='line')
 
     def post_receive(self, alert):
-        point = self._influxdb_prepare_point(alert)
-        LOG.debug('InfluxDB: point=%s', point)
+        line = encode_point(alert)
+        LOG.debug('InfluxDB: line=%s', line)
 
-        try:
-            self.client.write_points([point], time_precision='ms')
-        except Exception as e:
-            raise RuntimeError('InfluxDB: ERROR - %s' % e)
+        self.writer.write(line)
 
     def status_change(self, alert, status, text):
         if status not in ['ack', 'assign']:
             return
 
-        point = self._influxdb_prepare_point(alert, status, text)
-        LOG.debug('InfluxDB: point=%s', point)
+        line = encode_point(alert, status, text)
+        LOG.debug('InfluxDB: line=%s', line)
 
-        try:
-            self.client.write_points([point], time_precision='ms')
-        except Exception as e:
-            raise RuntimeError('InfluxDB: ERROR - %s' % e)
+        self.writer.write(line)
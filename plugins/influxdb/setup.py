@@ -15,6 +15,9 @@ setup(
     install_requires=[
         'influxdb>=5.0.0'
     ],
+    extras_require={
+        'v2': ['influxdb-client>=1.18.0']
+    },
     include_package_data=True,
     zip_safe=True,
     entry_points={
@@ -1,7 +1,15 @@
+import atexit
 import json
 import logging
 import os
+import select
 import socket
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime
 
 from alerta.plugins import PluginBase
 
@@ -21,37 +29,233 @@ LOGSTASH_HOST = os.environ.get('LOGSTASH_HOST') or app.config.get(
 LOGSTASH_PORT = os.environ.get('LOGSTASH_PORT') or app.config.get(
     'LOGSTASH_PORT', DEFAULT_LOGSTASH_PORT)
 
+# 'tcp' for JSON lines over a persistent connection, or 'udp' for JSON and
+# 'gelf' for GELF datagrams sent without waiting for Logstash
+LOGSTASH_PROTOCOL = os.environ.get('LOGSTASH_PROTOCOL') or app.config.get(
+    'LOGSTASH_PROTOCOL', 'tcp')
 
-class LogStashOutput(PluginBase):
+# Alerts are written to the TCP connection by a background thread. At most
+# LOGSTASH_QUEUE_SIZE alerts are kept while Logstash is unavailable, the
+# oldest are dropped first.
+LOGSTASH_QUEUE_SIZE = int(os.environ.get(
+    'LOGSTASH_QUEUE_SIZE') or app.config.get('LOGSTASH_QUEUE_SIZE', 10000))
+LOGSTASH_TIMEOUT = 2  # seconds
+LOGSTASH_MAX_BACKOFF = 30  # seconds
+LOGSTASH_MAX_WRITE = 65536  # bytes written with a single sendall
+
+EPOCH = datetime(1970, 1, 1)
+
+GELF_CHUNK_SIZE = 8154
+GELF_MAX_CHUNKS = 128
+
+SYSLOG_LEVELS = {
+    'security': 0,
+    'critical': 2,
+    'major': 3,
+    'minor': 4,
+    'warning': 4,
+    'indeterminate': 5,
+    'informational': 6,
+    'debug': 7,
+    'trace': 7,
+}
+
+
+def gelf_message(alert):
+    '''GELF 1.1 message for an alert, with the alert attributes as
+    additional fields.
+    '''
+    body = alert.get_body(history=False)
+    message = {
+        'version': '1.1',
+        'host': alert.origin or alert.resource,
+        'short_message': alert.text or '{} {} is {}'.format(alert.resource, alert.event, alert.severity),
+        'timestamp': (alert.create_time - EPOCH).total_seconds(),
+        'level': SYSLOG_LEVELS.get(alert.severity, 5),
+        '_alert_id': body['id'],  # _id is reserved
+    }
+    for k in ['resource', 'event', 'environment', 'severity', 'status', 'group', 'value', 'origin', 'type',
+              'customer', 'duplicateCount', 'previousSeverity']:
+        if body.get(k) is not None:
+            message['_' + k] = body[k]
+    message['_service'] = ','.join(alert.service)
+    message['_tags'] = ','.join(alert.tags)
+    return message
+
+
+def gelf_chunks(data, chunk_size=GELF_CHUNK_SIZE):
+    '''Split a compressed GELF message into datagrams of at most
+    chunk_size bytes, chunked if necessary.
+    '''
+    if len(data) <= chunk_size:
+        return [data]
+    count = (len(data) + chunk_size - 1) // chunk_size
+    if count > GELF_MAX_CHUNKS:
+        raise ValueError('GELF message too large: %d bytes' % len(data))
+    message_id = os.urandom(8)
+    return [b'\x1e\x0f' + message_id + struct.pack('BB', i, count) + data[i * chunk_size:(i + 1) * chunk_size]
+            for i in range(count)]
+
+
+class TcpSender:
+    '''Writes lines to a persistent TCP connection from a background
+    thread, so sending a line only appends it to a buffer. Buffered lines
+    are written together with sendall. The connection is re-established
+    with exponential backoff and the unsent lines are written again.
+    '''
+
+    def __init__(self, host, port, queue_size=LOGSTASH_QUEUE_SIZE):
+
+        self.address = (host, port)
+        self.queue_size = queue_size
+        self.dropped = 0
 
-    def __init__(self, name=None):
         self.sock = None
-        super().__init__(name)
+        self._buffer = deque()
+        self._sending = 0
+        self._backoff = 0
+        self._cond = threading.Condition()
+        self._pid = None
 
-    def pre_receive(self, alert):
-        return alert
+    def __len__(self):
+        return len(self._buffer)
 
-    def post_receive(self, alert):
+    def send(self, line):
+        with self._cond:
+            self._start()
+            self._buffer.append(line)
+            if len(self._buffer) > self.queue_size:
+                self._buffer.popleft()
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    LOG.warning('Logstash: buffer full, %d alerts dropped', self.dropped)
+            if len(self._buffer) == 1:
+                self._cond.notify()
+
+    def flush(self, timeout=None):
+        '''Wait until all buffered lines have been written.'''
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._buffer and not self._sending, timeout)
+
+    def _start(self):
+        # the sender thread does not survive a fork so is started by the process using it
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.sock = None
+        threading.Thread(target=self._run, name='LogstashSender', daemon=True).start()
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, timeout=LOGSTASH_TIMEOUT)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return sock
+
+    def _run(self):
+        while True:
+            if self._backoff:
+                time.sleep(self._backoff)
+            with self._cond:
+                # lines sent while the last write was in progress are written together
+                self._cond.wait_for(lambda: self._buffer)
+                lines = []
+                size = 0
+                while self._buffer and size < LOGSTASH_MAX_WRITE:
+                    lines.append(self._buffer.popleft())
+                    size += len(lines[-1])
+                self._sending = len(lines)
+
+            try:
+                # Logstash never writes to the connection, so it is only readable once closed
+                if self.sock is not None and select.select([self.sock], [], [], 0)[0]:
+                    self._close()
+                if self.sock is None:
+                    self.sock = self._connect()
+                self.sock.sendall(b''.join(lines))
+                self._backoff = 0
+            except OSError as e:
+                LOG.warning('Logstash: TCP connection error - %s, retrying %d alerts', e, len(lines))
+                self._close()
+                self._backoff = min(self._backoff * 2 or 1, LOGSTASH_MAX_BACKOFF)
+                with self._cond:
+                    # write again after reconnecting, within the queue size
+                    room = max(self.queue_size - len(self._buffer), 0)
+                    keep = lines[-room:] if room else []
+                    self.dropped += len(lines) - len(keep)
+                    self._buffer.extendleft(reversed(keep))
+            finally:
+                with self._cond:
+                    self._sending = 0
+                    self._cond.notify_all()
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+
+class UdpSender:
+    '''Sends each datagram straight away without waiting for Logstash,
+    so alerts are lost if it is unavailable.
+    '''
+
+    def __init__(self, host, port):
+
+        self.address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.dropped = 0
+
+    def send(self, *datagrams):
+        for datagram in datagrams:
+            try:
+                self.sock.sendto(datagram, self.address)
+            except OSError as e:
+                self.dropped += 1
+                LOG.warning('Logstash: UDP send error - %s', e)
+
+    def flush(self, timeout=None):
+        return True
+
+
+class LogStashOutput(PluginBase):
+
+    def __init__(self, name=None):
         try:
             logstash_port = int(LOGSTASH_PORT)
         except Exception as e:
             LOG.error("Alerta_logstash: Could not parse 'LOGSTASH_PORT': %s", e)
             raise RuntimeError("Could not parse 'LOGSTASH_PORT': %s" % e)
 
-        try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((LOGSTASH_HOST, logstash_port))
-        except Exception as e:
-            raise RuntimeError('Logstash TCP connection error: %s' % str(e))
+        self.protocol = LOGSTASH_PROTOCOL.lower()
+        if self.protocol == 'tcp':
+            self.sender = TcpSender(LOGSTASH_HOST, logstash_port)
+        elif self.protocol in ('udp', 'gelf'):
+            self.sender = UdpSender(LOGSTASH_HOST, logstash_port)
+        else:
+            raise RuntimeError("Unknown 'LOGSTASH_PROTOCOL': %s" % LOGSTASH_PROTOCOL)
+        atexit.register(self.sender.flush, timeout=5)
 
-        try:
-            self.sock.send(b'%s\r\n' % json.dumps(
-                alert.get_body(history=False)).encode('utf-8'))
-        except Exception as e:
-            LOG.exception(e)
-            raise RuntimeError('logstash exception')
+        super().__init__(name)
+
+    def pre_receive(self, alert):
+        return alert
+
+    def post_receive(self, alert):
+        if self.protocol == 'gelf':
+            data = zlib.compress(json.dumps(gelf_message(alert)).encode('utf-8'))
+            try:
+                self.sender.send(*gelf_chunks(data))
+            except ValueError as e:
+                LOG.warning('Logstash: %s', e)
+            return
 
-        self.sock.close()
+        data = json.dumps(alert.get_body(history=False)).encode('utf-8')
+        if self.protocol == 'udp':
+            self.sender.send(data)
+        else:
+            self.sender.send(b'%s\r\n' % data)
 
     def status_change(self, alert, status, text):
         return
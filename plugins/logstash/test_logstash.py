@@ -0,0 +1,199 @@
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+import unittest
+import unittest.mock
+import zlib
+from datetime import datetime
+
+from flask import Flask
+
+import alerta_logstash
+
+
+class TcpSink:
+    """
+    Local TCP server standing in for the Logstash tcp input, recording
+    the lines received on each connection.
+    """
+
+    class Server(socketserver.ThreadingTCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+        request_queue_size = 1024
+
+    def __init__(self, port=0):
+        self.connections = []
+        self.sockets = []
+        self.lock = threading.Lock()
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                lines = []
+                with sink.lock:
+                    sink.connections.append(lines)
+                    sink.sockets.append(self.connection)
+                for line in self.rfile:
+                    lines.append(line)
+
+        self.server = self.Server(('127.0.0.1', port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def lines(self):
+        with self.lock:
+            return [line for lines in self.connections for line in lines]
+
+    def wait_for(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.lines) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return len(self.lines)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class LogstashPluginTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['ALERT_TIMEOUT'] = 86400
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.sink = TcpSink()
+        self.patch = unittest.mock.patch.multiple(alerta_logstash, LOGSTASH_HOST='127.0.0.1',
+                                                  LOGSTASH_PORT=self.sink.port, LOGSTASH_PROTOCOL='tcp')
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.sink.close()
+        self.ctx.pop()
+
+    def make_alert(self, i, **kwargs):
+        from alerta.models.alert import Alert
+        alert = dict(resource='host%d' % i, event='diskUtil', environment='Production', severity='major',
+                     service=['Web'], value='98%', text='Disk utilisation is high', origin='test',
+                     create_time=datetime(2017, 5, 19, 21, 13, 41, 494000))
+        alert.update(kwargs)
+        return Alert(**alert)
+
+    def test_alerts_sent_on_one_connection(self):
+
+        plugin = alerta_logstash.LogStashOutput()
+        for i in range(1000):
+            plugin.post_receive(self.make_alert(i))
+        self.assertTrue(plugin.sender.flush(timeout=5))
+
+        self.assertEqual(self.sink.wait_for(1000), 1000)
+        self.assertEqual(len(self.sink.connections), 1)
+        alerts = [json.loads(line) for line in self.sink.lines]
+        self.assertEqual([a['resource'] for a in alerts], ['host%d' % i for i in range(1000)])
+        self.assertTrue(all(line.endswith(b'\r\n') for line in self.sink.lines))
+
+    def test_reconnect_after_logstash_restarted(self):
+
+        plugin = alerta_logstash.LogStashOutput()
+        plugin.post_receive(self.make_alert(0))
+        self.assertEqual(self.sink.wait_for(1), 1)
+
+        port = self.sink.port
+        self.sink.close()
+        plugin.sender.sock.getpeername()  # still connected to the closed sink
+        for i in range(1, 5):
+            plugin.post_receive(self.make_alert(i))
+        time.sleep(0.2)
+
+        self.sink = TcpSink(port)
+        self.assertTrue(plugin.sender.flush(timeout=5))
+        self.assertEqual(self.sink.wait_for(4), 4)
+        self.assertEqual([json.loads(line)['resource'] for line in self.sink.lines],
+                         ['host%d' % i for i in range(1, 5)])
+
+    @unittest.skipUnless(os.environ.get('BENCHMARK'), 'set BENCHMARK=1 to run benchmarks')
+    def test_throughput_benchmark(self):
+
+        alerts = [self.make_alert(i) for i in range(2000)]
+
+        # a connection for each alert, as before
+        start = time.perf_counter()
+        for alert in alerts:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect(('127.0.0.1', self.sink.port))
+            sock.send(b'%s\r\n' % json.dumps(alert.get_body(history=False)).encode('utf-8'))
+            sock.close()
+        per_alert = time.perf_counter() - start
+        self.assertEqual(self.sink.wait_for(2000), 2000)
+
+        plugin = alerta_logstash.LogStashOutput()
+        start = time.perf_counter()
+        for alert in alerts:
+            plugin.post_receive(alert)
+        queued = time.perf_counter() - start
+        self.assertTrue(plugin.sender.flush(timeout=10))
+        persistent = time.perf_counter() - start
+        self.assertEqual(self.sink.wait_for(4000), 4000)
+
+        print('connection per alert: {:.0f} alerts/s, post_receive: {:.0f} alerts/s, '
+              'persistent connection: {:.0f} alerts/s'.format(2000 / per_alert, 2000 / queued, 2000 / persistent))
+
+    def test_gelf_datagrams(self):
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(2)
+        with unittest.mock.patch.multiple(alerta_logstash, LOGSTASH_PORT=receiver.getsockname()[1],
+                                          LOGSTASH_PROTOCOL='gelf'):
+            plugin = alerta_logstash.LogStashOutput()
+
+        plugin.post_receive(self.make_alert(1, tags=['a', 'b']))
+        message = json.loads(zlib.decompress(receiver.recv(65536)))
+        self.assertEqual(message['version'], '1.1')
+        self.assertEqual(message['host'], 'test')
+        self.assertEqual(message['short_message'], 'Disk utilisation is high')
+        self.assertEqual(message['timestamp'], 1495228421.494)
+        self.assertEqual(message['level'], 3)
+        self.assertEqual(message['_resource'], 'host1')
+        self.assertEqual(message['_service'], 'Web')
+        self.assertEqual(message['_tags'], 'a,b')
+        self.assertNotIn('_id', message)
+
+        # large messages are chunked
+        plugin.post_receive(self.make_alert(2, text=os.urandom(20000).hex()))
+        chunks = [receiver.recv(65536)]
+        count = chunks[0][11]
+        chunks += [receiver.recv(65536) for _ in range(count - 1)]
+        receiver.close()
+        self.assertGreater(count, 1)
+        self.assertTrue(all(c[:2] == b'\x1e\x0f' and c[2:10] == chunks[0][2:10] for c in chunks))
+        self.assertTrue(all(len(c) <= 8192 for c in chunks))
+        self.assertEqual([struct.unpack('BB', c[10:12]) for c in chunks], [(i, count) for i in range(count)])
+        message = json.loads(zlib.decompress(b''.join(c[12:] for c in chunks)))
+        self.assertEqual(message['_resource'], 'host2')
+
+    def test_udp_json(self):
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(2)
+        with unittest.mock.patch.multiple(alerta_logstash, LOGSTASH_PORT=receiver.getsockname()[1],
+                                          LOGSTASH_PROTOCOL='udp'):
+            plugin = alerta_logstash.LogStashOutput()
+
+        plugin.post_receive(self.make_alert(1))
+        self.assertEqual(json.loads(receiver.recv(65536))['resource'], 'host1')
+        receiver.close()
@@ -2,10 +2,15 @@ import ast
 import json
 import logging
 import os
+import threading
+import time
 import traceback
+from collections import OrderedDict, deque
+from functools import lru_cache
 
 import requests
 from alerta.plugins import PluginBase
+from requests.adapters import HTTPAdapter
 
 LOG = logging.getLogger('alerta.plugins.slack')
 
@@ -73,6 +78,378 @@ SLACK_HEADERS = {
     'Content-Type': 'application/json'
 }
 
+SLACK_QUEUE_SIZE = int(os.environ.get('SLACK_QUEUE_SIZE') or app.config.get('SLACK_QUEUE_SIZE', 1000))
+SLACK_WORKERS = int(os.environ.get('SLACK_WORKERS') or app.config.get('SLACK_WORKERS', 2))
+SLACK_RETRIES = int(os.environ.get('SLACK_RETRIES') or app.config.get('SLACK_RETRIES', 3))
+SLACK_TIMEOUT = 2  # seconds
+SLACK_BACKOFF = 1  # seconds, doubled after each failed attempt
+
+# messages per second (and burst) allowed for each channel and each webhook URL
+SLACK_CHANNEL_RATE = float(os.environ.get('SLACK_CHANNEL_RATE') or app.config.get('SLACK_CHANNEL_RATE', 1))
+SLACK_CHANNEL_BURST = int(os.environ.get('SLACK_CHANNEL_BURST') or app.config.get('SLACK_CHANNEL_BURST', 5))
+SLACK_WEBHOOK_RATE = float(os.environ.get('SLACK_WEBHOOK_RATE') or app.config.get('SLACK_WEBHOOK_RATE', 5))
+SLACK_WEBHOOK_BURST = int(os.environ.get('SLACK_WEBHOOK_BURST') or app.config.get('SLACK_WEBHOOK_BURST', 20))
+
+# Web API only: 'update' the message already posted for an alert or reply in its 'thread'
+SLACK_UPDATE_MODE = os.environ.get('SLACK_UPDATE_MODE') or app.config.get('SLACK_UPDATE_MODE', '')
+SLACK_MESSAGE_STORE = os.environ.get('SLACK_MESSAGE_STORE') or app.config.get('SLACK_MESSAGE_STORE', '')
+SLACK_MESSAGE_STORE_SIZE = int(os.environ.get('SLACK_MESSAGE_STORE_SIZE') or app.config.get('SLACK_MESSAGE_STORE_SIZE', 10000))
+
+# messages with the highest value are dropped first when the queue is full
+SLACK_SEVERITY_PRIORITY = {'security': 0,
+                           'critical': 1,
+                           'major': 2,
+                           'minor': 3,
+                           'warning': 4,
+                           'indeterminate': 5,
+                           'informational': 6,
+                           'normal': 7,
+                           'ok': 7,
+                           'cleared': 7,
+                           'debug': 8,
+                           'trace': 9}
+
+
+class TokenBucket:
+    '''Allows rate messages per second on average with bursts of up to
+    burst messages.
+    '''
+
+    def __init__(self, rate, burst):
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        '''Seconds until a message is allowed, 0 if it is allowed now.'''
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return max(self.updated - now, 0) + (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        '''Allow no messages for seconds, eg. after a 429 Retry-After.'''
+        self.tokens = 0
+        self.updated = max(self.updated, now + seconds)
+
+
+class RateLimited(Exception):
+    '''Raised when Slack rejects a message with a 429.'''
+
+
+class SlackDispatcher:
+    '''Posts messages to Slack from a pool of background threads sharing
+    a keep-alive session, so that sending an alert to Slack never blocks
+    the request that received it. When the queue is full the message with
+    the lowest severity is dropped.
+
+    Messages to each channel and webhook URL are rate limited by token
+    buckets. Messages over the limit are merged into a single summary post
+    for the channel that is sent as soon as the limit allows. Messages
+    rejected by Slack with a 429 are sent again, before any others to the
+    channel, once the Retry-After time has passed.
+    '''
+
+    def __init__(self, queue_size=SLACK_QUEUE_SIZE, workers=SLACK_WORKERS, retries=SLACK_RETRIES):
+
+        self.queue_size = queue_size
+        self.workers = workers
+        self.retries = retries
+        self.dropped = 0
+
+        self._queue = deque()  # (priority, url, payload, headers, label, alert id)
+        self._buckets = dict()  # url or (url, channel) -> TokenBucket
+        self._summaries = dict()  # (url, channel) -> (payload, headers, {label: count})
+        self._retries = dict()  # (url, channel) -> deque of (url, payload, headers, label, alert id)
+        self._inflight = 0
+        self._cond = threading.Condition()
+        self._pid = None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def submit(self, url, payload, headers, severity, label=None, alert_id=None):
+        priority = SLACK_SEVERITY_PRIORITY.get(severity, 10)
+        with self._cond:
+            self._start()
+            if len(self._queue) >= self.queue_size:
+                # oldest of the least important messages
+                i = max(range(len(self._queue)), key=lambda i: (self._queue[i][0], -i))
+                self.dropped += 1
+                if priority >= self._queue[i][0]:
+                    LOG.warning('Slack queue full, dropped %s message', severity)
+                    return
+                LOG.warning('Slack queue full, dropped earlier message with lower severity')
+                del self._queue[i]
+            self._queue.append((priority, url, payload, headers, label or severity, alert_id))
+            self._cond.notify()
+
+    def flush(self, timeout=None):
+        '''Wait until all queued messages and summaries have been sent.'''
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._queue and not self._summaries and not self._retries and not self._inflight, timeout)
+
+    def _start(self):
+        # worker threads do not survive a fork so are started by the process using them
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name='SlackDispatcher-%d' % i, daemon=True).start()
+
+    def _limits(self, url, channel):
+        key = (url, channel)
+        if key not in self._buckets:
+            self._buckets[key] = TokenBucket(SLACK_CHANNEL_RATE, SLACK_CHANNEL_BURST)
+        if url not in self._buckets:
+            self._buckets[url] = TokenBucket(SLACK_WEBHOOK_RATE, SLACK_WEBHOOK_BURST)
+        return self._buckets[key], self._buckets[url]
+
+    def _delay(self, url, channel, now):
+        return max(bucket.delay(now) for bucket in self._limits(url, channel))
+
+    def _take(self, url, channel):
+        for bucket in self._limits(url, channel):
+            bucket.take()
+
+    def _merge(self, url, payload, headers, label):
+        '''Count a message, or the counts of a summary, in the summary
+        for its channel.
+        '''
+        key = (url, payload.get('channel', ''))
+        _, _, counts = self._summaries.get(key, (None, None, dict()))
+        for label, count in (label.items() if isinstance(label, dict) else [(label, 1)]):
+            counts[label] = counts.get(label, 0) + count
+        self._summaries[key] = (payload, headers, counts)
+
+    def _next(self):
+        '''Return the next message that the rate limits allow, merging
+        those they do not allow into summaries. Must hold the lock.
+        '''
+        while True:
+            now = time.time()
+            wait = None
+            for (url, channel), retries in list(self._retries.items()):
+                delay = self._delay(url, channel, now)
+                if delay == 0:
+                    self._take(url, channel)
+                    message = retries.popleft()
+                    if not retries:
+                        del self._retries[(url, channel)]
+                    return message
+                wait = delay if wait is None else min(wait, delay)
+
+            for (url, channel), (payload, headers, counts) in list(self._summaries.items()):
+                delay = self._delay(url, channel, now)
+                if delay == 0:
+                    self._take(url, channel)
+                    del self._summaries[(url, channel)]
+                    # the counts are the label, so a rate limited summary can be merged again
+                    return url, self._summary(payload, counts), headers, counts, None
+                wait = delay if wait is None else min(wait, delay)
+
+            while self._queue:
+                _, url, payload, headers, label, alert_id = self._queue.popleft()
+                channel = payload.get('channel', '')
+                if (url, channel) not in self._summaries and (url, channel) not in self._retries \
+                        and self._delay(url, channel, now) == 0:
+                    self._take(url, channel)
+                    return url, payload, headers, label, alert_id
+                self._merge(url, payload, headers, label)
+                wait = 0
+
+            self._cond.wait(wait)
+
+    @staticmethod
+    def _summary(payload, counts):
+        def order(label):
+            return SLACK_SEVERITY_PRIORITY.get(label.rsplit('/', 1)[-1], 10), label
+
+        text = ', '.join('+{} more alert{} in {}'.format(counts[label], 's' if counts[label] > 1 else '', label)
+                         for label in sorted(counts, key=order))
+        summary = {'text': text}
+        for field in ['channel', 'username', 'icon_emoji']:
+            if field in payload:
+                summary[field] = payload[field]
+        return summary
+
+    def _run(self):
+        while True:
+            with self._cond:
+                url, payload, headers, label, alert_id = self._next()
+                self._inflight += 1
+            try:
+                self._deliver(url, payload, headers, label, alert_id)
+            except RateLimited as e:
+                with self._cond:
+                    for bucket in self._limits(url, payload.get('channel', '')):
+                        bucket.block(time.time(), e.args[0])
+                    if isinstance(label, dict):
+                        self._merge(url, payload, headers, label)
+                    else:
+                        # the message itself is sent again, ahead of later ones to the channel
+                        key = (url, payload.get('channel', ''))
+                        self._retries.setdefault(key, deque()).appendleft((url, payload, headers, label, alert_id))
+            finally:
+                with self._cond:
+                    self._inflight -= 1
+                    self._cond.notify_all()
+
+    def _deliver(self, url, payload, headers, label, alert_id=None):
+        message = messages.get(alert_id) if alert_id and messages is not None else None
+        if message:
+            # Web API mode: update the earlier message for the alert or reply in its thread
+            channel_id, ts = message
+            if SLACK_UPDATE_MODE == 'update':
+                r = self._post(url.replace('chat.postMessage', 'chat.update'),
+                               dict(payload, channel=channel_id, ts=ts), headers)
+                if r is None or _slack_json(r).get('error') != 'message_not_found':
+                    return
+            else:
+                payload = dict(payload, thread_ts=ts)
+
+        r = self._post(url, payload, headers)
+        # replies in a thread keep the first message, a new message replaces a deleted one
+        if r is not None and alert_id and messages is not None and (not message or SLACK_UPDATE_MODE == 'update'):
+            body = _slack_json(r)
+            if body.get('ok') and 'ts' in body:
+                messages.set(alert_id, body['channel'], body['ts'])
+
+    def _post(self, url, payload, headers):
+        data = json.dumps(payload)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(SLACK_BACKOFF * 2 ** (attempt - 1))
+            try:
+                r = self.session.post(url, data=data, headers=headers, timeout=SLACK_TIMEOUT)
+            except Exception as e:
+                LOG.warning('Slack connection error: %s', e)
+                continue
+            LOG.debug('Slack response: {}\n{}'.format(r.status_code, r.text))
+            if r.status_code == 429:
+                retry_after = float(r.headers.get('Retry-After', 1))
+                LOG.warning('Slack rate limited, retry after %s seconds', retry_after)
+                raise RateLimited(retry_after)
+            if r.status_code < 500:
+                return r
+        LOG.error('Slack message not sent after %d attempts', self.retries + 1)
+
+
+def _slack_json(r):
+    '''Web API response body, or an empty dict for a webhook response.'''
+    try:
+        body = r.json()
+    except ValueError:
+        return dict()
+    return body if isinstance(body, dict) else dict()
+
+
+class SlackMessageStore:
+    '''Channel and timestamp of the Slack message posted for each alert
+    id, for the most recent alerts. Kept in memory and, if a path is
+    given, in an append-only file that is replayed at startup and
+    rewritten once it holds twice as many records as alerts.
+    '''
+
+    def __init__(self, path=None, size=10000):
+
+        self.path = path
+        self.size = size
+        self._messages = OrderedDict()  # alert id -> (channel id, ts)
+        self._records = 0
+        self._lock = threading.Lock()
+        self._file = None
+
+        if path:
+            if os.path.exists(path):
+                complete = 0  # bytes up to the end of the last complete record
+                with open(path, 'rb') as f:
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            break
+                        complete += len(line)
+                        try:
+                            alert_id, channel, ts = json.loads(line)
+                        except ValueError:
+                            continue
+                        self._put(alert_id, (channel, ts))
+                        self._records += 1
+                if complete < os.path.getsize(path):
+                    # a record torn by a crash while appending would swallow the next one
+                    os.truncate(path, complete)
+            self._file = open(path, 'a')
+
+    def __len__(self):
+        return len(self._messages)
+
+    def get(self, alert_id):
+        with self._lock:
+            message = self._messages.get(alert_id)
+            if message:
+                self._messages.move_to_end(alert_id)
+            return message
+
+    def set(self, alert_id, channel, ts):
+        with self._lock:
+            self._put(alert_id, (channel, ts))
+            if self._file:
+                self._file.write(json.dumps([alert_id, channel, ts]) + '\n')
+                self._file.flush()
+                self._records += 1
+                if self._records > 2 * self.size:
+                    self._compact()
+
+    def _put(self, alert_id, message):
+        self._messages[alert_id] = message
+        self._messages.move_to_end(alert_id)
+        while len(self._messages) > self.size:
+            self._messages.popitem(last=False)
+
+    def _compact(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for alert_id, (channel, ts) in self._messages.items():
+                f.write(json.dumps([alert_id, channel, ts]) + '\n')
+        self._file.close()
+        os.rename(tmp, self.path)
+        self._file = open(self.path, 'a')
+        self._records = len(self._messages)
+
+
+dispatcher = SlackDispatcher()
+messages = SlackMessageStore(SLACK_MESSAGE_STORE or None, SLACK_MESSAGE_STORE_SIZE) if SLACK_UPDATE_MODE else None
+
+
+@lru_cache(maxsize=128)
+def compile_template(templateFmt):
+    LOG.debug('SLACK: generating template: %s' % templateFmt)
+    return Template(templateFmt)
+
+
+@lru_cache(maxsize=4096)
+def route_channel(environment, severity, event, default):
+    '''Channel for an alert, most specific mapping first: environment and
+    severity, event, environment, severity.
+    '''
+    channel = SLACK_CHANNEL_SEVERITY_MAP.get(severity, default)
+    channel = SLACK_CHANNEL_ENV_MAP.get(environment, channel)
+    channel = SLACK_CHANNEL_EVENT_MAP.get(event, channel)
+    channel = SLACK_CHANNEL_MAP.get(environment, dict()).get(severity, channel)
+    return channel
+
 
 class ServiceIntegration(PluginBase):
 
@@ -80,6 +457,7 @@ class ServiceIntegration(PluginBase):
         # override user-defined severities
         self._severities = SLACK_DEFAULT_SEVERITY_MAP
         self._severities.update(SLACK_SEVERITY_MAP)
+        self._payload_cache = (None, None)
 
         super().__init__(name)
 
@@ -88,20 +466,31 @@ class ServiceIntegration(PluginBase):
 
     def _format_template(self, templateFmt, templateVars):
         try:
-            LOG.debug('SLACK: generating template: %s' % templateFmt)
-            template = Template(templateFmt)
+            template = compile_template(templateFmt)
         except Exception as e:
             LOG.error('SLACK: ERROR - Template init failed: %s', e)
             return
 
         try:
-            LOG.debug('SLACK: rendering template: %s' % templateFmt)
-            LOG.debug('SLACK: rendering variables: %s' % templateVars)
             return template.render(**templateVars)
         except Exception as e:
             LOG.error('SLACK: ERROR - Template render failed: %s', e)
             return
 
+    def _payload_template(self, payload):
+        # SLACK_PAYLOAD is the same object for every alert, so only encode it once
+        cached, payload_json = self._payload_cache
+        if cached is not payload:
+            payload_json = json.dumps(payload)
+            self._payload_cache = (payload, payload_json)
+        return payload_json
+
+    def _slack_headers(self, **kwargs):
+        SLACK_TOKEN = self.get_config('SLACK_TOKEN', type=str, **kwargs)
+        if SLACK_TOKEN:
+            return dict(SLACK_HEADERS, Authorization='Bearer ' + SLACK_TOKEN)
+        return SLACK_HEADERS
+
     def _slack_prepare_payload(self, alert, status=None, text=None, **kwargs):
         SLACK_CHANNEL = self.get_config(
             'SLACK_CHANNEL', default='', type=str, **kwargs)
@@ -114,35 +503,12 @@ class ServiceIntegration(PluginBase):
             'ALERTA_USERNAME', default='alerta', type=str, **kwargs)
         DASHBOARD_URL = self.get_config(
             'DASHBOARD_URL', default='', type=str, **kwargs)
-        SLACK_TOKEN = self.get_config('SLACK_TOKEN', type=str, **kwargs)
-        if SLACK_TOKEN:
-            SLACK_HEADERS['Authorization'] = 'Bearer ' + SLACK_TOKEN
-
         if alert.severity in self._severities:
             color = self._severities[alert.severity]
         else:
             color = '#00CC00'  # green
-        channel = SLACK_CHANNEL_SEVERITY_MAP.get(alert.severity, SLACK_CHANNEL)
-        if SLACK_CHANNEL_SEVERITY_MAP.get(alert.severity):
-            LOG.debug('Found severity mapping. Channel: %s' % channel)
-        else:
-            LOG.debug('No severity mapping. Channel: %s' % channel)
-        channel = SLACK_CHANNEL_ENV_MAP.get(alert.environment, channel)
-        if SLACK_CHANNEL_ENV_MAP.get(alert.environment):
-            LOG.debug('Found env mapping. Channel: %s' % channel)
-        else:
-            LOG.debug('No env mapping. Channel: %s' % channel)
-        channel = SLACK_CHANNEL_EVENT_MAP.get(alert.event, channel)
-        if SLACK_CHANNEL_EVENT_MAP.get(alert.event):
-            LOG.debug('Found event mapping. Channel: %s' % channel)
-        else:
-            LOG.debug('No event mapping. Channel: %s' % channel)
-        channel = SLACK_CHANNEL_MAP.get(
-            alert.environment, dict()).get(alert.severity, channel)
-        if SLACK_CHANNEL_MAP.get(alert.environment, dict()).get(alert.severity, channel):
-            LOG.debug('Found env-severity mapping. Channel: %s' % channel)
-        else:
-            LOG.debug('No env-severity mapping. Channel: %s' % channel)
+        channel = route_channel(alert.environment, alert.severity, alert.event, SLACK_CHANNEL)
+        LOG.debug('Slack channel: %s', channel)
 
         templateVars = {
             'alert': alert,
@@ -155,7 +521,7 @@ class ServiceIntegration(PluginBase):
 
         if SLACK_PAYLOAD:
             LOG.debug('Formatting with slack payload template')
-            formattedPayload = self._format_template(json.dumps(
+            formattedPayload = self._format_template(self._payload_template(
                 SLACK_PAYLOAD), templateVars).replace('\n', '\\n')
             LOG.debug('Formatted slack payload:\n%s' % formattedPayload)
             payload = json.loads(formattedPayload)
@@ -223,13 +589,8 @@ class ServiceIntegration(PluginBase):
                       (e, traceback.format_exc()))
             return
 
-        try:
-            r = requests.post(SLACK_WEBHOOK_URL,
-                              data=json.dumps(payload), headers=SLACK_HEADERS, timeout=2)
-        except Exception as e:
-            raise RuntimeError('Slack connection error: %s', e)
-
-        LOG.debug('Slack response: {}\n{}'.format(r.status_code, r.text))
+        dispatcher.submit(SLACK_WEBHOOK_URL, payload, self._slack_headers(**kwargs), alert.severity,
+                          label='{}/{}'.format(alert.environment, alert.severity), alert_id=alert.id)
 
     def status_change(self, alert, status, text, **kwargs):
         SLACK_WEBHOOK_URL = self.get_config(
@@ -248,10 +609,5 @@ class ServiceIntegration(PluginBase):
                       (e, traceback.format_exc()))
             return
 
-        try:
-            r = requests.post(SLACK_WEBHOOK_URL,
-                              data=json.dumps(payload), headers=SLACK_HEADERS, timeout=2)
-        except Exception as e:
-            raise RuntimeError('Slack connection error: %s', e)
-
-        LOG.debug('Slack response: {}\n{}'.format(r.status_code, r.text))
+        dispatcher.submit(SLACK_WEBHOOK_URL, payload, self._slack_headers(**kwargs), alert.severity,
+                          label='{}/{}'.format(alert.environment, alert.severity), alert_id=alert.id)
@@ -1,10 +1,17 @@
 import contextlib
 import json
 import os
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import alerta_slack
 from alerta.app import create_app, plugins
 from alerta_slack import ServiceIntegration
+from flask import Flask
 
 
 @contextlib.contextmanager
@@ -77,3 +84,361 @@ class SlackPluginTestCase(unittest.TestCase):
             self.assertEqual(data['status'], 'ok')
             self.assertRegex(
                 data['id'], '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+
+class SlackStub:
+    """
+    Local HTTP server standing in for a Slack webhook, recording the
+    payloads posted to it.
+    """
+
+    def __init__(self, delay=0, status=200, respond=None):
+        self.delay = delay
+        self.status = status
+        self.respond = respond or (lambda path, payload: b'ok')
+        self.payloads = []
+        self.paths = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                time.sleep(stub.delay)
+                payload = json.loads(body)
+                stub.payloads.append(payload)
+                stub.paths.append(self.path)
+                data, status = stub.respond(self.path, payload), stub.status
+                if isinstance(data, tuple):
+                    status, data = data
+                self.send_response(status)
+                if status == 429:
+                    self.send_header('Retry-After', '1')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/services/T0/B0/X' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SlackDispatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['ALERT_TIMEOUT'] = 86400
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def make_alert(self, i, severity='critical'):
+        from alerta.models.alert import Alert
+        return Alert(resource='net%d' % i, event='node_down', environment='Production',
+                     severity=severity, service=['Network'], status='open')
+
+    def test_post_receive_does_not_block(self):
+
+        stub = SlackStub(delay=0.2)
+        dispatcher = alerta_slack.SlackDispatcher(queue_size=100, workers=4)
+        with mod_env(SLACK_WEBHOOK_URL=stub.url), \
+                unittest.mock.patch.object(alerta_slack, 'dispatcher', dispatcher), \
+                unittest.mock.patch.multiple(alerta_slack, SLACK_CHANNEL_BURST=100, SLACK_WEBHOOK_BURST=100):
+            plugin = ServiceIntegration()
+            alerts = [self.make_alert(i) for i in range(20)]
+            start = time.time()
+            for alert in alerts:
+                plugin.post_receive(alert)
+            elapsed = time.time() - start
+            self.assertTrue(dispatcher.flush(timeout=10))
+        stub.close()
+
+        # posting synchronously would wait for each of the 20 webhook calls
+        self.assertLess(elapsed, 0.2 * 20 / 2)
+        self.assertEqual(sorted(p['text'].split(' on ')[1].split('_')[0] for p in stub.payloads),
+                         sorted('net%d' % i for i in range(20)))
+
+    def test_queue_full_drops_low_severity_first(self):
+
+        dispatcher = alerta_slack.SlackDispatcher(queue_size=3, workers=1)
+        dispatcher._pid = os.getpid()  # no workers, messages stay queued
+        for severity in ['warning', 'informational', 'critical', 'major', 'debug', 'minor']:
+            dispatcher.submit('http://slack', {'text': severity}, {}, severity)
+        self.assertEqual([m[2]['text'] for m in dispatcher._queue], ['critical', 'major', 'minor'])
+        self.assertEqual(dispatcher.dropped, 3)
+
+    def test_retry_server_errors(self):
+
+        stub = SlackStub(status=503)
+        dispatcher = alerta_slack.SlackDispatcher(workers=1, retries=2)
+        with unittest.mock.patch.object(alerta_slack, 'SLACK_BACKOFF', 0):
+            dispatcher.submit(stub.url, {'text': 'down'}, {}, 'critical')
+            self.assertTrue(dispatcher.flush(timeout=5))
+        stub.close()
+        self.assertEqual(len(stub.payloads), 3)
+
+    def test_rate_limited_messages_summarised(self):
+
+        stub = SlackStub()
+        dispatcher = alerta_slack.SlackDispatcher(workers=1)
+        with mod_env(SLACK_WEBHOOK_URL=stub.url, SLACK_CHANNEL='#ops'), \
+                unittest.mock.patch.object(alerta_slack, 'dispatcher', dispatcher), \
+                unittest.mock.patch.multiple(alerta_slack, SLACK_CHANNEL_RATE=5, SLACK_CHANNEL_BURST=2):
+            plugin = ServiceIntegration()
+            dispatcher._pid = os.getpid()  # queue all messages before starting a worker
+            for i, severity in enumerate(['critical'] * 4 + ['major'] * 3 + ['minor']):
+                plugin.post_receive(self.make_alert(i, severity))
+            dispatcher._pid = None
+            dispatcher._start()
+            self.assertTrue(dispatcher.flush(timeout=5))
+        stub.close()
+
+        self.assertEqual(len(stub.payloads), 3)
+        self.assertEqual(stub.payloads[2], {
+            'channel': '#ops', 'username': 'alerta',
+            'text': '+2 more alerts in Production/critical, +3 more alerts in Production/major, '
+                    '+1 more alert in Production/minor'
+        })
+
+    def test_retry_after_backs_off(self):
+
+        stub = SlackStub(status=429)
+        dispatcher = alerta_slack.SlackDispatcher(workers=1)
+        dispatcher.submit(stub.url, {'channel': '#ops', 'text': 'down'}, {}, 'critical', label='Production/critical')
+        time.sleep(0.2)
+        stub.status = 200
+        bucket = dispatcher._buckets[(stub.url, '#ops')]
+        self.assertGreater(bucket.delay(time.time()), 0.5)
+        self.assertTrue(dispatcher.flush(timeout=5))
+        stub.close()
+        self.assertEqual(stub.payloads, [{'channel': '#ops', 'text': 'down'}] * 2)
+
+    def test_rate_limited_message_sent_first(self):
+
+        def respond(path, payload):
+            stub.status = 429 if len(stub.payloads) == 1 else 200
+            return b'ok'
+
+        stub = SlackStub(status=429, respond=respond)
+        dispatcher = alerta_slack.SlackDispatcher(workers=1)
+        with unittest.mock.patch.multiple(alerta_slack, SLACK_CHANNEL_RATE=100, SLACK_CHANNEL_BURST=100):
+            dispatcher.submit(stub.url, {'channel': '#ops', 'text': 'down'}, {}, 'critical')
+            time.sleep(0.2)
+            dispatcher.submit(stub.url, {'channel': '#ops', 'text': 'slow'}, {}, 'major')
+            self.assertTrue(dispatcher.flush(timeout=5))
+        stub.close()
+
+        # the rejected message keeps its content and is sent ahead of the one over the limit
+        self.assertEqual([p['text'] for p in stub.payloads], ['down', 'down', '+1 more alert in major'])
+
+    def test_rate_limited_summary_kept(self):
+
+        def respond(path, payload):
+            stub.status = 429 if len(stub.payloads) == 1 else 200
+            return b'ok'
+
+        stub = SlackStub(status=429, respond=respond)
+        dispatcher = alerta_slack.SlackDispatcher(workers=1)
+        dispatcher._merge(stub.url, {'channel': '#ops', 'text': 'down'}, {}, 'Production/critical')
+        dispatcher._merge(stub.url, {'channel': '#ops', 'text': 'slow'}, {}, 'Production/major')
+        dispatcher._start()
+        self.assertTrue(dispatcher.flush(timeout=5))
+        stub.close()
+
+        # the summary was rejected once and sent again with the same counts
+        self.assertEqual(len(stub.payloads), 2)
+        self.assertEqual(stub.payloads[0], stub.payloads[1])
+        self.assertEqual(stub.payloads[1]['text'], '+1 more alert in Production/critical, '
+                                                   '+1 more alert in Production/major')
+
+
+class SlackPayloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['ALERT_TIMEOUT'] = 86400
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        alerta_slack.route_channel.cache_clear()
+
+    def tearDown(self):
+        self.ctx.pop()
+        alerta_slack.route_channel.cache_clear()
+
+    def test_channel_routing(self):
+
+        maps = {
+            'SLACK_CHANNEL_SEVERITY_MAP': {'critical': '#critical', 'minor': '#minor'},
+            'SLACK_CHANNEL_ENV_MAP': {'Development': '#dev'},
+            'SLACK_CHANNEL_EVENT_MAP': {'node_down': '#nodes'},
+            'SLACK_CHANNEL_MAP': {'Production': {'major': '#prod-major'}}
+        }
+        with unittest.mock.patch.multiple(alerta_slack, **maps):
+            route = alerta_slack.route_channel
+            self.assertEqual(route('Production', 'critical', 'disk_full', '#default'), '#critical')
+            self.assertEqual(route('Development', 'critical', 'disk_full', '#default'), '#dev')
+            self.assertEqual(route('Development', 'critical', 'node_down', '#default'), '#nodes')
+            self.assertEqual(route('Production', 'major', 'node_down', '#default'), '#prod-major')
+            self.assertEqual(route('Production', 'warning', 'disk_full', '#default'), '#default')
+
+    PAYLOAD_CONFIGS = {
+        'default': {},
+        'summary_fmt': {'SLACK_SUMMARY_FMT': '*[{{ alert.status|capitalize }}]* {{ alert.event }} on {{ alert.resource }}'},
+        'payload': {'SLACK_PAYLOAD': {
+            'channel': '{{ channel }}',
+            'text': '*[{{ alert.environment }}]* {{ alert.value }}\n```{{ alert.text }}```',
+            'attachments': [{'color': '{{ color }}', 'fields': [{'title': 'Resource', 'value': '{{ alert.resource }}'}]}]
+        }}
+    }
+
+    def make_alerts(self, count):
+        from alerta.models.alert import Alert
+        return [Alert(resource='net%d' % i, event='node_down', environment='Production', severity='critical',
+                      service=['Network'], status='open', value='%d' % i, text='line1\nline2') for i in range(count)]
+
+    def test_prepare_payload_templates_cached(self):
+
+        alerts = self.make_alerts(20)
+        plugin = ServiceIntegration()
+        for name in ['summary_fmt', 'payload']:
+            config = self.PAYLOAD_CONFIGS[name]
+            plugin._slack_prepare_payload(alerts[0], config=config)
+            before = alerta_slack.compile_template.cache_info()
+            for alert in alerts:
+                payload = plugin._slack_prepare_payload(alert, config=config)
+            after = alerta_slack.compile_template.cache_info()
+
+            # each payload is rendered from templates compiled for the first alert
+            self.assertEqual(after.misses, before.misses)
+            self.assertGreaterEqual(after.hits - before.hits, len(alerts))
+
+        self.assertEqual(payload['text'], '*[Production]* 19\n```line1\nline2```')
+
+    @unittest.skipUnless(os.environ.get('BENCHMARK'), 'set BENCHMARK=1 to run benchmarks')
+    def test_prepare_payload_benchmark(self):
+
+        alerts = self.make_alerts(2000)
+        plugin = ServiceIntegration()
+        for name, config in self.PAYLOAD_CONFIGS.items():
+            start = time.perf_counter()
+            for alert in alerts:
+                plugin._slack_prepare_payload(alert, config=config)
+            per_alert = (time.perf_counter() - start) / len(alerts)
+            print('{}: {:.1f} us per alert'.format(name, per_alert * 1e6))
+
+
+class SlackWebApiTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['ALERT_TIMEOUT'] = 86400
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    @staticmethod
+    def web_api(path, payload):
+        if path.endswith('chat.update') and payload['ts'] == 'deleted':
+            return json.dumps({'ok': False, 'error': 'message_not_found'}).encode()
+        return json.dumps({'ok': True, 'channel': 'C0001', 'ts': '1700000000.%06d' % len(payload['text'])}).encode()
+
+    def send(self, mode, store, severities, respond=None):
+        from alerta.models.alert import Alert
+        stub = SlackStub(respond=respond or self.web_api)
+        dispatcher = alerta_slack.SlackDispatcher(workers=1)
+        with mod_env(SLACK_WEBHOOK_URL=stub.url.replace('/services/T0/B0/X', '/api/chat.postMessage'),
+                     SLACK_CHANNEL='#ops', SLACK_TOKEN='xoxb-test'), \
+                unittest.mock.patch.multiple(alerta_slack, dispatcher=dispatcher, messages=store,
+                                             SLACK_UPDATE_MODE=mode):
+            plugin = ServiceIntegration()
+            alert = Alert(id='4e5fa3c6-0000-0000-0000-000000000000', resource='net5', event='node_down',
+                          environment='Production', severity='critical', service=['Network'], status='open')
+            for severity in severities:
+                alert.severity = severity
+                plugin.post_receive(alert)
+                self.assertTrue(dispatcher.flush(timeout=5))
+        stub.close()
+        return stub
+
+    def test_update_existing_message(self):
+
+        store = alerta_slack.SlackMessageStore()
+        stub = self.send('update', store, ['critical', 'major', 'ok'])
+        self.assertEqual([path.rsplit('/', 1)[1] for path in stub.paths],
+                         ['chat.postMessage', 'chat.update', 'chat.update'])
+        ts = store.get('4e5fa3c6-0000-0000-0000-000000000000')[1]
+        self.assertEqual(stub.payloads[2]['ts'], ts)
+        self.assertEqual(stub.payloads[2]['channel'], 'C0001')
+
+        # deleted messages are posted again
+        store.set('4e5fa3c6-0000-0000-0000-000000000000', 'C0001', 'deleted')
+        stub = self.send('update', store, ['critical', 'major'])
+        self.assertEqual([path.rsplit('/', 1)[1] for path in stub.paths],
+                         ['chat.update', 'chat.postMessage', 'chat.update'])
+        ts = store.get('4e5fa3c6-0000-0000-0000-000000000000')[1]
+        self.assertNotEqual(ts, 'deleted')
+        self.assertEqual(stub.payloads[2]['ts'], ts)
+
+    def test_rate_limited_update_sent_again(self):
+
+        def respond(path, payload):
+            calls.append(path)
+            if len(calls) == 1:
+                return 429, b''
+            return self.web_api(path, payload)
+
+        calls = []
+        store = alerta_slack.SlackMessageStore()
+        store.set('4e5fa3c6-0000-0000-0000-000000000000', 'C0001', '1700000000.000001')
+        stub = self.send('update', store, ['major'], respond=respond)
+
+        # the update itself is sent again once the Retry-After has passed, not a summary
+        self.assertEqual([path.rsplit('/', 1)[1] for path in stub.paths], ['chat.update', 'chat.update'])
+        self.assertEqual([p['ts'] for p in stub.payloads], ['1700000000.000001'] * 2)
+        self.assertEqual(stub.payloads[0], stub.payloads[1])
+
+    def test_reply_in_thread(self):
+
+        store = alerta_slack.SlackMessageStore()
+        stub = self.send('thread', store, ['critical', 'ok'])
+        self.assertEqual([path.rsplit('/', 1)[1] for path in stub.paths], ['chat.postMessage', 'chat.postMessage'])
+        self.assertNotIn('thread_ts', stub.payloads[0])
+        self.assertEqual(stub.payloads[1]['thread_ts'], store.get('4e5fa3c6-0000-0000-0000-000000000000')[1])
+
+    def test_message_store_bounded_and_persistent(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'slack.messages')
+            store = alerta_slack.SlackMessageStore(path, size=100)
+            for i in range(1000):
+                store.set('alert-%d' % (i % 150), 'C0001', '%d' % i)
+            self.assertEqual(len(store), 100)
+            with open(path) as f:
+                self.assertLessEqual(sum(1 for _ in f), 200)
+
+            restored = alerta_slack.SlackMessageStore(path, size=100)
+            self.assertEqual(len(restored), 100)
+            self.assertEqual(restored.get('alert-99'), ('C0001', '999'))
+            self.assertIsNone(restored.get('alert-149'))
+
+            # records written after a torn record survive the next restart
+            restored._file.write('["alert-torn", "C00')
+            restored._file.close()
+            restored = alerta_slack.SlackMessageStore(path, size=100)
+            restored.set('alert-new', 'C0001', '1000')
+            restored._file.close()
+            restored = alerta_slack.SlackMessageStore(path, size=100)
+            self.assertEqual(restored.get('alert-new'), ('C0001', '1000'))
+            restored._file.close()